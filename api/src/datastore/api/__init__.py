@@ -1,7 +1,8 @@
 from flask import Flask, g
 from flask.ext.login import current_user, LoginManager
 
-from datastore.api import config, encryption, errors, file_store, user_store
+from datastore.api import cipher, config, encryption, errors, file_store
+from datastore.api import notification, tree_cache, user_store
 from datastore.api.helpers import converters, session
 from datastore.models import session_maker
 
@@ -47,7 +48,11 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.session_protection = 'strong'
 
-# Setup file storage, login storage, and password encryption backends.
+# Setup file storage, login storage, password and file encryption, change
+# notification and tree cache backends.
+cipher = cipher.from_config(app, config)
+notification = notification.from_config(app, config)
+tree_cache = tree_cache.from_config(app, config)
 encryption = encryption.from_config(app, config)
 file_store = file_store.from_config(app, config)
 user_store = user_store.from_config(app, config)
@@ -0,0 +1,18 @@
+"""Cipher package implements the different AES-CTR backends used to encrypt
+and decrypt the stored files.
+
+Possible implementations:
+    - pycrypto: use PyCrypto (the default)
+    - openssl: use OpenSSL through the cryptography package, which benefits
+      from AES-NI when available
+
+Both produce the same output, which means that the backend can be changed
+without affecting the previously stored files.
+
+"""
+
+
+def from_config(app, config):
+    """Import the appropriate cipher module according to the config."""
+    cipher = config.storage.get('cipher', 'pycrypto')
+    return __import__('%s.aes_%s' % (__name__, cipher), fromlist=[None])
@@ -0,0 +1,31 @@
+"""AES-CTR using OpenSSL through the cryptography package.
+"""
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import algorithms, Cipher, modes
+
+
+block_size = algorithms.AES.block_size // 8
+
+
+class _CTRCipher(object):
+
+    def __init__(self, key, initial_value):
+        # PyCrypto handles negative initial values as a 128 bits two's
+        # complement (our IVs are signed integers): we do the same to stay
+        # compatible with the stored files.
+        nonce = ('%032x' % (initial_value % (1 << 128))).decode('hex')
+        cipher = Cipher(algorithms.AES(key), modes.CTR(nonce),
+                        backend=default_backend())
+        self._context = cipher.encryptor()
+
+    def encrypt(self, data):
+        return self._context.update(data)
+
+    # CTR mode decryption is the very same operation as encryption.
+    decrypt = encrypt
+
+
+def new_ctr(key, initial_value):
+    """Return an AES-CTR cipher which counter starts at initial_value."""
+    return _CTRCipher(key, initial_value)
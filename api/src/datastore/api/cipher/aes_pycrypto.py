@@ -0,0 +1,14 @@
+"""AES-CTR using PyCrypto.
+"""
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+
+block_size = AES.block_size
+
+
+def new_ctr(key, initial_value):
+    """Return an AES-CTR cipher which counter starts at initial_value."""
+    counter = Counter.new(128, initial_value=initial_value)
+    return AES.new(key, AES.MODE_CTR, counter=counter)
@@ -24,5 +24,7 @@ chunk_storage = '_chunked_uploads'
 storage_nodes = ['main', 'sandbox']
 
 # Storage policy regarding history (usefull if you want to revert any change
-# have a sort of 'time-machine', but at the cost of performance)
+# have a sort of 'time-machine'). Commits share the unchanged directories with
+# their parent: each change only costs new rows for the directories along the
+# modified path.
 enable_full_history = False
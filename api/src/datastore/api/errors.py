@@ -29,6 +29,9 @@ INVALID_RANGE = lambda f, l, h: '"%s" must be between %d and %d' % (f, l, h)
 
 E_ALREADY_DELETED = INVALID_OP + 'file already deleted'
 E_BAD_DESTINATION = INVALID_OP + 'bad destination path'
+E_BAD_OPERATION = INVALID_OP + 'bad batch operation'
+E_BATCH_FAILED = lambda i, m: 'Operation {0} failed: {1}'.format(i, m)
+E_CONCURRENT_COMMIT = 'Too many concurrent changes, please retry'
 E_CPY_BAD_PATHS = INVALID_OP + 'bad paths provided'
 E_DEST_EXISTS = INVALID_OP + 'destination already exists'
 E_DEST_DOES_NOT_EXIST = INVALID_OP + 'destination does not exist'
@@ -36,13 +39,18 @@ E_DIR_ALREADY_EXISTS = INVALID_OP + 'a directory with that name already exists'
 E_FILE_NOT_FOUND = INVALID_OP + 'file not found'
 E_EXPIRE_DAYS = partial(INVALID_RANGE, 'expire_days')
 E_FILE_LIMIT = partial(INVALID_RANGE, 'file_limit')
+E_INVALID_CURSOR = lambda c: 'Invalid cursor "{0}"'.format(c)
 E_INVALID_LINK = lambda d: 'Invalid file link "{0}"'.format(d)
 E_INVALID_PATH = lambda d: 'Invalid path "{0}"'.format(d)
 E_INVALID_ROOT = lambda d: 'Invalid root "{0}"'.format(d)
+E_LIMIT = partial(INVALID_RANGE, 'limit')
+E_MISSING_PART = lambda n: 'Missing upload part {0}'.format(n)
 E_NON_EXISTING_DESTINATION_PATH = 'Non existing destination path'
+E_OPERATIONS = partial(INVALID_RANGE, 'operations')
 E_QUERY_LEN = lambda l: '"query" must be at least %d characters long' % l
 E_REV_LIMIT = partial(INVALID_RANGE, 'rev_limit')
 E_SEARCH_DIR_NOT_FOUND = 'Search directory not found'
 E_SEARCH_PATH_NOT_A_DIR = 'Search path is not a directory'
 E_SOURCE_NOT_FOUND = 'Source file was not found'
 E_SOURCE_DELETED = 'Source file has been deleted'
+E_TIMEOUT = partial(INVALID_RANGE, 'timeout')
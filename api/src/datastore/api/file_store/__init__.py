@@ -1,7 +1,8 @@
 """Storage package implements the different ways to handle file storage.
 
 Possible implementations:
-    - filesystem: store files on disk
+    - fs: store files on disk
+    - pack: store files on disk, small files being grouped in pack files
     - memory: in memory storage, used for testing purposes
 
 """
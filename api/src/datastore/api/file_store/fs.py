@@ -11,14 +11,17 @@ import os
 import tempfile
 
 from flask import safe_join
-from werkzeug import FileStorage
 
 from datastore.api import config, tools
+from datastore.api.helpers import stream as stream_helpers
 
 
 storage_root = os.path.abspath(config.storage['fs_root'])
 storage_temp = os.path.join(storage_root, "_tmp")
 
+# Size of the blocks moved from the request to the disk.
+block_size = config.storage.get('block_size', 1024 * 1024)
+
 
 def _make_storage_key(root, content_hash):
     filepath = safe_join(storage_root, root)
@@ -27,9 +30,20 @@ def _make_storage_key(root, content_hash):
     return filepath
 
 
+def _make_part_key(upload_id, part):
+    return '{0}.{1}'.format(_make_storage_key(config.chunk_storage, upload_id),
+                            part)
+
+
 def _save_request_content(destination, stream):
-    file_storage = FileStorage(stream)
-    file_storage.save(destination)
+    # The data goes through a single buffer, which the stream decorators
+    # (checksum, encryption) process in place as they fill it.
+    buf = bytearray(block_size)
+    while True:
+        count = stream_helpers.readinto(stream, buf)
+        if not count:
+            break
+        destination.write(buffer(buf, 0, count))
 
 
 def initialize():
@@ -51,11 +65,14 @@ def register_blob(root, path, stream, hasher):
         filepath = _make_storage_key(root, hasher.hexdigest())
 
         # If the file already exists, there is no need to go further (assuming
-        # that SHA1 collisions are out of the picture).
+        # that SHA1 collisions are out of the picture). It is touched though,
+        # as the garbage collector spares recently modified files.
         if not os.path.exists(filepath):
             tools.make_dirs(os.path.dirname(filepath))
             os.rename(temp_file.name, filepath)
             temp_file.delete = False
+        else:
+            touch_blob(root, hasher.hexdigest())
 
     return hasher.hexdigest()
 
@@ -72,14 +89,65 @@ def register_chunk(upload_id, content):
         return upload_file.tell()
 
 
-def remove_chunked_upload(upload_id):
+def commit_chunked_upload(root, upload_id, content_hash):
+    # The chunked upload file already holds the final blob content: it only
+    # has to be moved to its final location (based on its hash).
+    filepath = _make_storage_key(root, content_hash)
+    if not os.path.exists(filepath):
+        tools.make_dirs(os.path.dirname(filepath))
+        os.rename(_make_storage_key(config.chunk_storage, upload_id), filepath)
+    os.utime(filepath, None)
+    return content_hash
+
+
+def list_blobs(root, prefix):
+    """Returns the hashes of the blobs stored for root which start with the
+    given two characters prefix.
+    """
+    dirpath = safe_join(safe_join(storage_root, root), prefix)
+    try:
+        return [prefix + filename for filename in os.listdir(dirpath)]
+    except OSError:
+        return []
+
+
+def purge_temp_files(max_mtime):
+    """Removes the temporary files last modified before max_mtime, and returns
+    their count.
+    """
+    count = 0
+    for filename in os.listdir(storage_temp):
+        filepath = os.path.join(storage_temp, filename)
+        try:
+            if os.stat(filepath).st_mtime < max_mtime:
+                os.remove(filepath)
+                count += 1
+        except OSError:  # pragma: no cover
+            pass  # The file was moved or removed in the meantime
+    return count
+
+
+def register_part(upload_id, part, content):
+    # Parts are stored next to the chunked upload file, each in its own file
+    # such that they can be written concurrently. Receiving a part again
+    # overwrites it, which allows clients to retry a failed part.
+    filepath = _make_part_key(upload_id, part)
+    tools.make_dirs(os.path.dirname(filepath))
+    with open(filepath, 'wb') as part_file:
+        _save_request_content(part_file, content)
+        return part_file.tell()
+
+
+def remove_chunked_upload(upload_id, parts=()):
     # Aborting a chunked upload consists of removing any temporary file that
     # may have been created.
-    filepath = _make_storage_key(config.chunk_storage, upload_id)
-    try:
-        os.remove(filepath)
-    except OSError:  # pragma: no cover
-        pass  # Silently ignore any removal error
+    filepaths = [_make_storage_key(config.chunk_storage, upload_id)]
+    filepaths.extend(_make_part_key(upload_id, part) for part in parts)
+    for filepath in filepaths:
+        try:
+            os.remove(filepath)
+        except OSError:  # pragma: no cover
+            pass  # Silently ignore any removal error
 
 
 def retrieve_blob_stream(root, content_hash):
@@ -88,11 +156,28 @@ def retrieve_blob_stream(root, content_hash):
     return open(filepath, 'rb')
 
 
+def remove_blob(root, content_hash):
+    try:
+        os.remove(_make_storage_key(root, content_hash))
+    except OSError:  # pragma: no cover
+        pass  # Silently ignore any removal error
+
+
+def retrieve_blob_path(root, content_hash):
+    """Returns the path of the data on the filesystem."""
+    return _make_storage_key(root, content_hash)
+
+
 def retrieve_chunk_stream(upload_id):
     """Returns data as a file-like object."""
     return retrieve_blob_stream(config.chunk_storage, upload_id)
 
 
+def retrieve_part_stream(upload_id, part):
+    """Returns data as a file-like object."""
+    return open(_make_part_key(upload_id, part), 'rb')
+
+
 def stat_blob(root, path, content_hash):
     filepath = _make_storage_key(root, content_hash)
     try:
@@ -100,3 +185,13 @@ def stat_blob(root, path, content_hash):
     except OSError:
         return None, None
     return fileinfo.st_mtime, fileinfo.st_size
+
+
+def touch_blob(root, content_hash):
+    """Refreshes the date of a blob, as the garbage collector spares recently
+    modified files.
+    """
+    try:
+        os.utime(_make_storage_key(root, content_hash), None)
+    except OSError:  # pragma: no cover
+        pass  # The blob was removed in the meantime
@@ -11,6 +11,10 @@ from datastore.api import config
 store = {}
 
 
+def _make_part_key(upload_id, part):
+    return '{0}.{1}'.format(upload_id, part)
+
+
 def initialize():
     pass
 
@@ -30,9 +34,33 @@ def register_chunk(upload_id, stream):
     return len(data[1]) + len(content_data)
 
 
-def remove_chunked_upload(upload_id):
+def commit_chunked_upload(root, upload_id, content_hash):
+    content_data = store[config.chunk_storage].pop(upload_id, (0, b''))[1]
+    store.setdefault(root, {})[content_hash] = (datetime.now(), content_data)
+    return content_hash
+
+
+def list_blobs(root, prefix):
+    return [key for key in store.get(root, {}) if key.startswith(prefix)]
+
+
+def purge_temp_files(max_mtime):
+    return 0
+
+
+def register_part(upload_id, part, stream):
+    storage_root = config.chunk_storage
+    content_data = stream.read()
+    part_key = _make_part_key(upload_id, part)
+    store.setdefault(storage_root, {})[part_key] = (0, content_data)
+    return len(content_data)
+
+
+def remove_chunked_upload(upload_id, parts=()):
     storage_root = config.chunk_storage
-    del store[storage_root][upload_id]
+    keys = [upload_id] + [_make_part_key(upload_id, part) for part in parts]
+    for key in keys:
+        store.get(storage_root, {}).pop(key, None)
 
 
 def retrieve_blob_stream(root, content_hash):
@@ -41,13 +69,34 @@ def retrieve_blob_stream(root, content_hash):
     return cStringIO.StringIO(stored_data[1]) if stored_data else None
 
 
+def remove_blob(root, content_hash):
+    store.get(root, {}).pop(content_hash, None)
+
+
+def retrieve_blob_path(root, content_hash):
+    """Data in memory is not reachable from the filesystem."""
+    return None
+
+
 def retrieve_chunk_stream(upload_id):
     """Returns data as a file-like object."""
     return retrieve_blob_stream(config.chunk_storage, upload_id)
 
 
+def retrieve_part_stream(upload_id, part):
+    """Returns data as a file-like object."""
+    part_key = _make_part_key(upload_id, part)
+    return retrieve_blob_stream(config.chunk_storage, part_key)
+
+
 def stat_blob(root, path, content_hash):
     stored_data = store.get(root, {}).get(content_hash)
     if not stored_data:
         return None, None
     return (stored_data[0], len(stored_data[1]))
+
+
+def touch_blob(root, content_hash):
+    stored_data = store.get(root, {}).get(content_hash)
+    if stored_data:
+        store[root][content_hash] = (datetime.now(), stored_data[1])
@@ -0,0 +1,265 @@
+"""Pack file storage: small blobs are appended to large pack files.
+
+Storing each small blob in its own file wastes inodes and makes us bound on
+metadata operations. This implementation relies on the filesystem storage, but
+blobs up to storage.pack_threshold bytes are appended to pack files instead:
+    - Each storage node has its own sequence of pack files, which are
+      append-only and rolled over past storage.pack_size bytes
+    - A SQLite index gives the (pack, offset, length) location of each hash
+    - Removed blobs are dead space, reclaimed by compact_packs.
+
+Each thread of a process keeps its own connection to the index.
+
+"""
+
+from __future__ import division
+
+import cStringIO
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+
+from flask import safe_join
+
+from datastore.api import config, tools
+from datastore.api.file_store import fs
+from datastore.api.file_store.fs import (list_blobs as _list_loose_blobs,
+                                         purge_temp_files,
+                                         register_chunk,
+                                         register_part,
+                                         remove_chunked_upload,
+                                         retrieve_chunk_stream,
+                                         retrieve_part_stream)
+
+
+# Blobs up to pack_threshold bytes are packed, in files of about pack_size.
+pack_threshold = config.storage.get('pack_threshold', 16 * 1024)
+pack_size = config.storage.get('pack_size', 64 * 1024 * 1024)
+
+_local = threading.local()
+
+
+class _HeadStream(object):
+    """Replays the data read ahead from a stream before the rest of it."""
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read(size)
+        if size < 0:
+            rv, self._head = self._head + self._stream.read(), b''
+        else:
+            rv, self._head = self._head[:size], self._head[size:]
+        return rv
+
+
+def _append_to_pack(db, root, content_hash, data):
+    # Appending is serialized by an exclusive lock on the pack file, which is
+    # held until the index is updated.
+    pack_id = _current_pack(root)
+    pack_path = _make_pack_path(root, pack_id)
+    tools.make_dirs(os.path.dirname(pack_path))
+    with open(pack_path, 'ab') as pack_file:
+        fcntl.flock(pack_file, fcntl.LOCK_EX)
+        pack_file.seek(0, os.SEEK_END)
+        offset = pack_file.tell()
+        pack_file.write(data)
+        pack_file.flush()
+        with db:
+            db.execute('INSERT OR REPLACE INTO blobs '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (root, content_hash, pack_id, offset, len(data),
+                        time.time()))
+
+
+def _connect():
+    # The connection is opened (and the schema created) on first use by each
+    # thread. A forked process, or a moved storage root, gets a new one.
+    key = (os.getpid(), os.path.join(_packs_root(), 'index.db'))
+    if getattr(_local, 'key', None) != key:
+        db = sqlite3.connect(key[1], timeout=60)
+        db.execute('CREATE TABLE IF NOT EXISTS blobs (root TEXT, hash TEXT, '
+                   'pack INTEGER, offset INTEGER, length INTEGER, '
+                   'created REAL, PRIMARY KEY (root, hash))')
+        _local.key, _local.db = key, db
+    return _local.db
+
+
+def _current_pack(root):
+    # The current pack is the last one, unless it is full.
+    pack_ids = _list_packs(root)
+    if not pack_ids:
+        return 0
+    pack_id = pack_ids[-1]
+    if os.path.getsize(_make_pack_path(root, pack_id)) >= pack_size:
+        pack_id += 1
+    return pack_id
+
+
+def _list_packs(root):
+    dirpath = safe_join(_packs_root(), root)
+    filenames = os.listdir(dirpath) if os.path.isdir(dirpath) else []
+    return sorted(int(name[:-5]) for name in filenames
+                  if name.endswith('.pack'))
+
+
+def _lookup(db, root, content_hash):
+    query = 'SELECT pack, offset, length, created FROM blobs ' \
+            'WHERE root = ? AND hash = ?'
+    return db.execute(query, (root, content_hash)).fetchone()
+
+
+def _make_pack_path(root, pack_id):
+    return safe_join(safe_join(_packs_root(), root), '%08d.pack' % pack_id)
+
+
+def _packs_root():
+    return os.path.join(fs.storage_root, '_packs')
+
+
+def _read_at_most(stream, size):
+    chunks, remaining = [], size
+    while remaining > 0:
+        rv = stream.read(remaining)
+        if not rv:
+            break
+        chunks.append(rv)
+        remaining -= len(rv)
+    return b''.join(chunks)
+
+
+def _read_packed(root, location):
+    pack_id, offset, length = location[:3]
+    with open(_make_pack_path(root, pack_id), 'rb') as pack_file:
+        pack_file.seek(offset)
+        return pack_file.read(length)
+
+
+def _register_small_blob(root, content_hash, data):
+    # As with loose files, registering a blob we already hold refreshes its
+    # date, as the garbage collector spares recent blobs.
+    db = _connect()
+    if _lookup(db, root, content_hash):
+        _touch_packed(db, root, content_hash)
+    elif fs.stat_blob(root, None, content_hash)[1] is None:
+        _append_to_pack(db, root, content_hash, data)
+    return content_hash
+
+
+def _touch_packed(db, root, content_hash):
+    # Returns whether the blob is packed.
+    with db:
+        cursor = db.execute('UPDATE blobs SET created = ? WHERE root = ? AND '
+                            'hash = ?', (time.time(), root, content_hash))
+    return cursor.rowcount > 0
+
+
+def initialize():
+    fs.initialize()
+    for storage_node in config.storage_nodes:
+        tools.make_dirs(os.path.join(_packs_root(), storage_node))
+    _connect()
+
+
+def commit_chunked_upload(root, upload_id, content_hash):
+    # The upload file is left for the caller to remove when it is packed.
+    with retrieve_chunk_stream(upload_id) as upload_stream:
+        data = _read_at_most(upload_stream, pack_threshold + 1)
+    if len(data) > pack_threshold:
+        return fs.commit_chunked_upload(root, upload_id, content_hash)
+    return _register_small_blob(root, content_hash, data)
+
+
+def compact_packs(min_dead_ratio, grace_period):
+    """Rewrite the live blobs of the packs which dead space ratio is at least
+    min_dead_ratio to the current pack. Readers may still hold a location in
+    a rewritten pack: it is only removed by a later run, once it has been
+    retired for grace_period seconds.
+    """
+    db = _connect()
+    max_mtime = time.time() - grace_period
+    roots = db.execute('SELECT DISTINCT root FROM blobs').fetchall()
+    for root, in roots:
+        current_pack = _current_pack(root)
+        for pack_id in _list_packs(root):
+            if pack_id >= current_pack:
+                continue
+
+            # A pack without live blobs has been retired (or only holds
+            # removed blobs) as of its modification date.
+            pack_path = _make_pack_path(root, pack_id)
+            query = 'SELECT hash, pack, offset, length FROM blobs ' \
+                    'WHERE root = ? AND pack = ?'
+            live = db.execute(query, (root, pack_id)).fetchall()
+            if not live:
+                if os.path.getmtime(pack_path) < max_mtime:
+                    os.remove(pack_path)
+                continue
+
+            size = os.path.getsize(pack_path)
+            live_size = sum(entry[3] for entry in live)
+            if size and (size - live_size) / size < min_dead_ratio:
+                continue
+
+            for entry in live:
+                data = _read_packed(root, entry[1:])
+                _append_to_pack(db, root, entry[0], data)
+            os.utime(pack_path, None)
+
+
+def list_blobs(root, prefix):
+    """Returns the hashes of the blobs stored for root which start with the
+    given two characters prefix, loose or packed.
+    """
+    query = 'SELECT hash FROM blobs WHERE root = ? AND hash LIKE ?'
+    rows = _connect().execute(query, (root, prefix + '%')).fetchall()
+    return _list_loose_blobs(root, prefix) + [row[0] for row in rows]
+
+
+def register_blob(root, path, stream, hasher):
+    # Read ahead up to the threshold: larger blobs are stored as loose files,
+    # whereas smaller ones are appended to a pack.
+    head = _read_at_most(stream, pack_threshold + 1)
+    if len(head) > pack_threshold:
+        return fs.register_blob(root, path, _HeadStream(head, stream), hasher)
+    return _register_small_blob(root, hasher.hexdigest(), head)
+
+
+def remove_blob(root, content_hash):
+    db = _connect()
+    with db:
+        db.execute('DELETE FROM blobs WHERE root = ? AND hash = ?',
+                   (root, content_hash))
+    fs.remove_blob(root, content_hash)
+
+
+def retrieve_blob_path(root, content_hash):
+    """Returns the path of the data on the filesystem, for loose blobs."""
+    location = _lookup(_connect(), root, content_hash)
+    return None if location else fs.retrieve_blob_path(root, content_hash)
+
+
+def retrieve_blob_stream(root, content_hash):
+    """Returns data as a file-like object."""
+    location = _lookup(_connect(), root, content_hash)
+    if not location:
+        return fs.retrieve_blob_stream(root, content_hash)
+    return cStringIO.StringIO(_read_packed(root, location))
+
+
+def stat_blob(root, path, content_hash):
+    location = _lookup(_connect(), root, content_hash)
+    if not location:
+        return fs.stat_blob(root, path, content_hash)
+    return location[3], location[2]
+
+
+def touch_blob(root, content_hash):
+    packed = _touch_packed(_connect(), root, content_hash)
+    if not packed:
+        fs.touch_blob(root, content_hash)
@@ -1,3 +1,4 @@
+import datastore.api.fileops.batch
 import datastore.api.fileops.copy
 import datastore.api.fileops.create_folder
 import datastore.api.fileops.delete
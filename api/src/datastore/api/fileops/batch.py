@@ -0,0 +1,86 @@
+import json
+
+from flask import request
+from flask.ext.login import login_required
+
+from datastore.api import app, tools
+from datastore.api.errors import *
+from datastore.api.files import metadata
+from datastore.api.fileops import copy, create_folder, delete, move
+from datastore.api.helpers import database, decorators
+
+
+# Maximum number of operations in a single batch.
+max_operations = 1000
+
+
+def _apply_copy(target_node, root, from_path, to_path):
+    return copy.do_copy(target_node, root, from_path, to_path)[1]
+
+
+def _apply_move(target_node, root, from_path, to_path):
+    return move.do_move(target_node, root, from_path, to_path)[1]
+
+
+# Each operation maps to the function applying it to the target node, and to
+# the parameters it expects. The last one is the path of the returned object.
+_operations = {
+    'copy': (_apply_copy, ('from_path', 'to_path')),
+    'create_folder': (create_folder.do_create_folder, ('path',)),
+    'delete': (delete.do_delete, ('path',)),
+    'move': (_apply_move, ('from_path', 'to_path')),
+}
+
+
+def _apply_operation(target_node, root, operation):
+    try:
+        apply_fn, params = _operations[operation['op']]
+        paths = tools.get_params(operation, *params)
+    except (KeyError, TypeError):
+        raise BasicError(400, E_BAD_OPERATION)
+    for path_ in paths:
+        tools.validate_path_or_abort(path_)
+    obj = apply_fn(target_node, root, *paths)
+    return metadata.make_metadata(root, paths[-1], obj)
+
+
+def _apply_operations(target_node, root, operations):
+    results = []
+    for index, operation in enumerate(operations):
+        try:
+            results.append(_apply_operation(target_node, root, operation))
+        except BasicError as e:
+            raise BasicError(e.status_code, E_BATCH_FAILED(index, e.message))
+    return results
+
+
+def _get_operations():
+    # Operations are passed as a JSON encoded list in the POST data.
+    try:
+        operations = json.loads(request.form['operations'])
+    except ValueError:
+        raise BasicError(400, E_BAD_OPERATION)
+    if not isinstance(operations, list):
+        raise BasicError(400, E_BAD_OPERATION)
+    if not (0 < len(operations) <= max_operations):
+        raise BasicError(406, E_OPERATIONS(1, max_operations))
+    return operations
+
+
+@app.route('/fileops/batch', methods=['POST'])
+@login_required
+@decorators.api_endpoint
+def fileops_batch():
+    """Apply a list of copy, create_folder, delete and move operations as a
+    single commit, and return the metadata resulting from each of them. The
+    operations are applied in order, such that each one sees the effects of
+    the previous ones. If any of them fails, none is applied.
+    """
+    root = request.form['root']
+    tools.validate_root_or_abort(root)
+    operations = _get_operations()
+
+    # The operations are applied to a single commit. Failing operations leave
+    # the database session to be rolled back along with the request.
+    results = database.run_commit(root, _apply_operations, root, operations)
+    return {'results': results}
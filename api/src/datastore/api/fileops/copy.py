@@ -40,7 +40,7 @@ def _get_source_object(root, from_path, target_node):
         source = database.get_stored_object(root, from_path, target_node)
     except database.MissingNodeException:
         raise BasicError(404, E_SOURCE_NOT_FOUND)
-    if source.is_deleted:
+    if database.is_deleted(root, from_path, source, target_node):
         raise BasicError(404, E_SOURCE_DELETED)
     return source
 
@@ -54,8 +54,9 @@ def _validate_paths(root, from_path, to_path, target_node):
 
     # Attempt to retrieve the parent directory for the destination file, and
     # fail with a 403 if it doesn't exist.
+    parent_path = '/'.join(p_to[:-1])
     try:
-        obj = database.get_stored_object(root, '/'.join(p_to[:-1]))
+        obj = database.get_stored_object(root, parent_path, target_node)
     except database.MissingNodeException:
         raise BasicError(403, E_DEST_DOES_NOT_EXIST)
 
@@ -70,9 +71,11 @@ def _validate_paths(root, from_path, to_path, target_node):
     source = _get_source_object(root, from_path, target_node)
     source_is_dir = source and (type(source) == models.TreeLink)
 
-    # We verify that there is no (undeleted) item at the destination path.
+    # We verify that there is no (undeleted) item at the destination path. The
+    # content of a deleted directory is deleted along with it.
     target = obj.tree.sub_trees if source_is_dir else obj.tree.sub_files
-    if p_to[-1] in target and not target[p_to[-1]].is_deleted:
+    if p_to[-1] in target and not target[p_to[-1]].is_deleted and \
+            not database.is_deleted(root, parent_path, obj, target_node):
         raise BasicError(403, E_DEST_EXISTS)
 
 
@@ -89,9 +92,13 @@ def do_copy(target_node, root, from_path, to_path):
     # deleted, we raise a 404.
     obj = _get_source_object(root, from_path, target_node)
 
-    # Do the copy and return both the original and the copy.
-    _, new_node = database.copy_hierarchy(root, to_path, target_node)
-    return obj, copy_object(obj, new_node, tools.last_element(to_path))
+    # Do the copy, register it to the path index along with its history and
+    # return both the original and the copy.
+    parent = database.copy_hierarchy(root, to_path, target_node)
+    obj_copy = copy_object(obj, parent, tools.last_element(to_path))
+    database.index_object(root, to_path, obj_copy)
+    database.copy_revisions(root, from_path, to_path, obj_copy)
+    return obj, obj_copy
 
 
 @app.route('/fileops/copy', methods=['POST'])
@@ -103,9 +110,8 @@ def fileops_copy():
 
     # A copy operation is always traduced by a new Commit object in order to
     # track the changes.
-    commit = database.create_commit(root)
-    obj, obj_copy = do_copy(commit.root, root, from_path, to_path)
+    obj, obj_copy = database.run_commit(root, do_copy, root, from_path,
+                                        to_path)
 
-    # Store the commit, and return the metadata for the new object.
-    database.store_commit(root, commit)
+    # Return the metadata for the new object.
     return metadata.make_metadata(root, to_path, obj_copy)
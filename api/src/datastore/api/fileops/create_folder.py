@@ -8,6 +8,26 @@ from datastore.api.helpers import database, decorators
 from datastore import models
 
 
+def do_create_folder(target_node, root, path_):
+    try:
+        parent = database.copy_hierarchy(root, path_, target_node)
+    except database.MissingNodeException:
+        raise BasicError(404, E_NON_EXISTING_DESTINATION_PATH)
+
+    # To stick with Dropbox behaviour, we raise a 403 if the directory already
+    # exists.
+    treename = tools.split_path(path_)[-1]
+    existing = parent.sub_trees.get(treename)
+    if existing and not existing.is_deleted:
+        raise BasicError(403, E_DIR_ALREADY_EXISTS)
+
+    # Create the new directory and register it to the path index.
+    output = models.TreeLink(tree=models.Tree(), path=treename)
+    parent.sub_trees[treename] = output
+    database.index_object(root, path_, output)
+    return output
+
+
 @app.route('/fileops/create_folder', methods=['POST'])
 @login_required
 @decorators.api_endpoint
@@ -20,21 +40,5 @@ def fileops_createfolder():
 
     # A file operation is always traduced by a new Commit object in order to
     # track the changes.
-    try:
-        commit = database.create_commit(root)
-        ref_node, new_node = database.copy_hierarchy(root, path_, commit.root)
-    except database.MissingNodeException:
-        raise BasicError(404, E_NON_EXISTING_DESTINATION_PATH)
-
-    # To stick with Dropbox behaviour, we raise a 403 if the directory already
-    # exists.
-    treename = tools.split_path(path_)[-1]
-    existing = ref_node and ref_node.sub_trees.get(treename)
-    if existing and not existing.is_deleted:
-        raise BasicError(403, E_DIR_ALREADY_EXISTS)
-
-    # Create the new directory and commit the change.
-    output = models.TreeLink(tree=models.Tree(), path=treename)
-    new_node.sub_trees[treename] = output
-    database.store_commit(root, commit)
+    output = database.run_commit(root, do_create_folder, root, path_)
     return metadata.make_metadata(root, path_, output)
@@ -5,7 +5,6 @@ from datastore.api import app, tools
 from datastore.api.errors import *
 from datastore.api.files import metadata
 from datastore.api.helpers import database, decorators
-from datastore import models
 
 
 def _get_params():
@@ -16,13 +15,24 @@ def _get_params():
     return root, path_
 
 
-def recursive_delete(obj):
-    obj.is_deleted = True
-    if type(obj) == models.TreeLink:
-        for subf in obj.tree.sub_files.values():
-            subf.is_deleted = True
-        for subd in obj.tree.sub_trees.values():
-            recursive_delete(subd)
+def do_delete(target_node, root, path_):
+    # Retrieve the stored object (could be a blob or tree link), or abort with
+    # a 404 if we fail or if it is already deleted.
+    try:
+        stored_object = database.get_stored_object(root, path_, target_node)
+    except database.MissingNodeException:
+        raise BasicError(404, E_FILE_NOT_FOUND)
+    if database.is_deleted(root, path_, stored_object, target_node):
+        raise BasicError(404, E_ALREADY_DELETED)
+
+    # Its parent directory is the one of the new commit. Only the object itself
+    # is flagged: the content of a directory is deleted along with it, and
+    # remains shared with its copies and with previous commits.
+    database.copy_hierarchy(root, path_, target_node)
+    stored_object = database.get_stored_object(root, path_, target_node)
+    stored_object.is_deleted = True
+    database.index_object(root, path_, stored_object, descendants=False)
+    return stored_object
 
 
 @app.route('/fileops/delete', methods=['POST'])
@@ -31,20 +41,5 @@ def recursive_delete(obj):
 def fileops_delete():
     root, path_ = _get_params()
     tools.validate_root_or_abort(root)
-    commit = database.create_commit(root)
-
-    # Retrieve the stored object (could be a blob or tree link) or abort with
-    # a 404 if we fail.
-    try:
-        stored_object = database.get_stored_object(root, path_, commit.root)
-    except database.MissingNodeException:
-        raise BasicError(404, E_FILE_NOT_FOUND)
-
-    # Mark the database object as deleted if it's not already.
-    if stored_object.is_deleted:
-        raise BasicError(404, E_ALREADY_DELETED)
-
-    # Recursively delete the object (if necessary), and commit the transaction.
-    recursive_delete(stored_object)
-    database.store_commit(root, commit)
+    stored_object = database.run_commit(root, do_delete, root, path_)
     return metadata.make_metadata(root, path_, stored_object)
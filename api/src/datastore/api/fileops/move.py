@@ -15,6 +15,16 @@ def _get_params():
     return items
 
 
+def do_move(target_node, root, from_path, to_path):
+    # Move is implemented in terms of copy.
+    obj, obj_copy = copy.do_copy(target_node, root, from_path, to_path)
+
+    # Delete the source object. The copy of a directory shares its content,
+    # which deleting the source leaves untouched.
+    delete.do_delete(target_node, root, from_path)
+    return obj, obj_copy
+
+
 @app.route('/fileops/move', methods=['POST'])
 @login_required
 @decorators.api_endpoint
@@ -22,14 +32,8 @@ def fileops_move():
     root, from_path, to_path = _get_params()
     tools.validate_root_or_abort(root)
 
-    # Move is implemented in terms of copy.
-    commit = database.create_commit(root)
-    obj, obj_copy = copy.do_copy(commit.root, root, from_path, to_path)
-
-    # Delete the source object.
-    source = database.get_stored_object(root, from_path, commit.root)
-    delete.recursive_delete(source)
+    obj, obj_copy = database.run_commit(root, do_move, root, from_path,
+                                        to_path)
 
-    # Store the commit, and return the metadata for the new object.
-    database.store_commit(root, commit)
+    # Return the metadata for the new object.
     return metadata.make_metadata(root, to_path, obj_copy)
@@ -1,4 +1,5 @@
 import datastore.api.files.chunked_upload
+import datastore.api.files.delta
 import datastore.api.files.get
 import datastore.api.files.metadata
 import datastore.api.files.put
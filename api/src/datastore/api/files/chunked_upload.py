@@ -1,13 +1,17 @@
 import datetime
+import functools
 import hashlib
 
 from flask import g, request
 from flask.ext.login import login_required
 
-from datastore.api import app, file_store, tools
-from datastore.api.errors import BasicError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import and_
+
+from datastore.api import app, config, file_store, tools
+from datastore.api.errors import BasicError, E_MISSING_PART
 from datastore.api.files import put
-from datastore.api.helpers import decorators, display, stream
+from datastore.api.helpers import decorators, display, hashing, stream
 from datastore import models
 
 
@@ -17,7 +21,10 @@ def _compute_expire_date():
 
 
 def _find_existing_upload(upload_id):
-    clause = models.ChunkedUpload.upload_id == upload_id
+    # Expired uploads are removed by a periodic job (see manage.sweep_expired),
+    # and may still be found in the meantime.
+    clause = and_(models.ChunkedUpload.upload_id == upload_id,
+                  models.ChunkedUpload.expires >= datetime.datetime.utcnow())
     return g.db_session.query(models.ChunkedUpload).filter(clause).first()
 
 
@@ -26,25 +33,128 @@ def _find_existing_upload(upload_id):
 # override the HTTP status code in some code paths.
 @decorators.as_json
 def _make_response(db_upload):
-    return {
+    response = {
         'expires': display.human_timestamp(db_upload.expires),
         'offset': db_upload.offset,
         'upload_id': db_upload.upload_id,
     }
+    if db_upload.parts:
+        response['parts'] = [part.number for part in db_upload.parts]
+    return response
+
+
+def _record_part(db_upload, number, size):
+    for part in db_upload.parts:
+        if part.number == number:
+            part.size = size
+            break
+    else:
+        part = models.ChunkedUploadPart(number=number, size=size)
+        db_upload.parts.append(part)
+    g.db_session.commit()
+
+
+def _register_part(db_upload, number, data_stream):
+    # Parts are stored independently of one another, and receiving a part
+    # number again replaces the previously received data.
+    size = file_store.register_part(db_upload.upload_id, number, data_stream)
+    try:
+        _record_part(db_upload, number, size)
+    except IntegrityError:
+        # A concurrent upload of the same part recorded it first: ours is
+        # recorded as an update of it.
+        g.db_session.rollback()
+        _record_part(db_upload, number, size)
+
+
+def _rehash_upload(db_upload):
+    # The hashes are computed again from the upload file, which holds the
+    # stored content: it is decrypted to hash the plaintext.
+    hasher, content_hasher = hashing.ResumableSHA1(), None
+    if db_upload.content_state is not None:
+        content_hasher = hashing.ResumableSHA1()
+    if not db_upload.offset:
+        return hasher, content_hasher
 
+    upload_stream = file_store.retrieve_chunk_stream(db_upload.upload_id)
+    data_stream = stream.ChecksumCalcStream(upload_stream, hasher)
+    if content_hasher and db_upload.iv is not None:
+        crypt_key = g.user.dbuser.password[:32]
+        data_stream = stream.AESDecryptionStream(data_stream, crypt_key,
+                                                 db_upload.iv)
+    if content_hasher:
+        data_stream = stream.ChecksumCalcStream(data_stream, content_hasher)
+    try:
+        for _ in iter(functools.partial(data_stream.read, 64 * 1024), ''):
+            pass
+    finally:
+        upload_stream.close()
+    return hasher, content_hasher
 
-def _purge_expired_uploads():
-    clause = models.ChunkedUpload.expires < datetime.datetime.utcnow()
-    expired_items = g.db_session.query(models.ChunkedUpload).filter(clause)
-    for expired_upload in expired_items.all():
-        file_store.remove_chunked_upload(expired_upload.upload_id or '')
-    expired_items.delete()
+
+def _resume_hashes(db_upload):
+    # Returns the SHA1 of the stored content and, when deduplication is
+    # enabled, that of the plaintext, resumed from their saved states. States
+    # which can't be restored (e.g. saved by a previous version) are rebuilt
+    # from the upload file.
+    content_hasher = None
+    try:
+        hasher = hashing.ResumableSHA1(db_upload.hash_state)
+        if db_upload.content_state is not None:
+            content_hasher = hashing.ResumableSHA1(db_upload.content_state)
+    except hashing.InvalidStateError:
+        return _rehash_upload(db_upload)
+    return hasher, content_hasher
+
+
+def _register_chunk(db_upload, data_stream):
+    # Sequential chunks are encrypted as they are received, resuming the
+    # cipher at the current offset, so that the upload file holds the final
+    # blob content. The SHA1 of the stored content, and that of the plaintext
+    # when deduplication is enabled, are resumed as well.
+    hasher, content_hasher = _resume_hashes(db_upload)
+    if content_hasher:
+        data_stream = stream.ChecksumCalcStream(data_stream, content_hasher)
+    if db_upload.iv is not None:
+        crypt_key = g.user.dbuser.password[:32]
+        data_stream = stream.AESEncryptionStream(data_stream, crypt_key,
+                                                 db_upload.iv, db_upload.offset)
+    hash_stream = stream.ChecksumCalcStream(data_stream, hasher)
+    offset = file_store.register_chunk(db_upload.upload_id, hash_stream)
+    db_upload.hash_state = hash_stream.hash.state
+    if content_hasher:
+        db_upload.content_state = content_hasher.state
+    db_upload.offset = offset
     g.db_session.commit()
 
 
+def _register_chunks(root, upload_id, filehash, content_hasher):
+    # The upload file of a deduplicated upload is removed along with the other
+    # temporary files.
+    if content_hasher:
+        duplicate = put.find_duplicate_blob(root, content_hasher)
+        if duplicate:
+            return duplicate
+    return file_store.commit_chunked_upload(root, upload_id, filehash)
+
+
 def _start_new_upload():
+    # Encryption at rest may be disabled by configuration, in which case the
+    # upload has no IV.
+    iv = None
+    if config.storage.get('encryption', True):
+        iv = stream.AESEncryptionStream.generate_IV()
+
+    # When deduplication is enabled, the plaintext is hashed as well in order
+    # to identify content we already hold.
+    content_state = None
+    if config.storage.get('deduplication', False):
+        content_state = hashing.ResumableSHA1().state
+
     expires = _compute_expire_date()
-    obj = models.ChunkedUpload(expires=expires, offset=0, owner=g.user.dbuser)
+    obj = models.ChunkedUpload(content_state=content_state, expires=expires,
+                               hash_state=hashing.ResumableSHA1().state, iv=iv,
+                               offset=0, owner=g.user.dbuser)
     g.db_session.add(obj)
     g.db_session.commit()
 
@@ -54,15 +164,69 @@ def _start_new_upload():
     return obj
 
 
+def _commit_chunks(root, path_, db_upload):
+    hasher, content_hasher = _resume_hashes(db_upload)
+    filehash = hasher.hexdigest()
+    if content_hasher:
+        content_hasher = put.make_content_hasher(root, content_hasher)
+    register_blob = functools.partial(_register_chunks, root,
+                                      db_upload.upload_id, filehash,
+                                      content_hasher)
+    return put.do_put(root, path_, register_blob, db_upload.iv, content_hasher)
+
+
+def _commit_parts(root, path_, upload_id, parts):
+    part_streams = (file_store.retrieve_part_stream(upload_id, part)
+                    for part in parts)
+    parts_stream = data_stream = stream.ConcatenatedStream(part_streams)
+
+    # With content-defined chunking, the assembled parts are split again into
+    # chunks which are encrypted independently (see put.files_put).
+    if config.storage.get('chunking', False):
+        register_blob = put.make_chunking_register_blob(root, path_,
+                                                        parts_stream)
+        try:
+            return put.do_put(root, path_, register_blob, None)
+        finally:
+            parts_stream.close()
+
+    # When deduplication is enabled, the plaintext is hashed as it is read in
+    # order to identify content we already hold, and only encrypted and stored
+    # if we don't.
+    content_hasher = put.make_content_hasher(root)
+    if content_hasher:
+        data_stream = stream.ChecksumCalcStream(data_stream, content_hasher)
+        register_blob, encryption_iv = put.make_deduplicating_register_blob(
+            root, path_, data_stream, content_hasher)
+        try:
+            return put.do_put(root, path_, register_blob, encryption_iv,
+                              content_hasher)
+        finally:
+            parts_stream.close()
+
+    # Install a SHA1 hash calculating stream on the request. This will
+    # allow us to compute the file's hash as it is written to disk.
+    enc_stream, encryption_iv = data_stream, None
+    if config.storage.get('encryption', True):
+        crypt_key = g.user.dbuser.password[:32]
+        enc_stream = stream.AESEncryptionStream(data_stream, crypt_key)
+        encryption_iv = enc_stream.IV
+    hash_stream = stream.ChecksumCalcStream(enc_stream)
+    register_blob = put.make_register_blob(root, path_, hash_stream,
+                                           hash_stream.hash)
+    try:
+        return put.do_put(root, path_, register_blob, encryption_iv)
+    finally:
+        parts_stream.close()
+
+
 @app.route('/chunked_upload', methods=['PUT'])
 @login_required
 def chunked_upload():
     # An offset without an upload_id doesn't mean anything.
     offset = request.args.get('offset', 0, type=int)
     upload_id = request.args.get('upload_id', '')
-
-    # Start by purging the table of all expired uploads.
-    _purge_expired_uploads()
+    part = request.args.get('part', None, type=int)
 
     # A request without an upload_id is a new upload and should be registered
     # as such.
@@ -74,17 +238,25 @@ def chunked_upload():
         if not obj:
             raise BasicError(404, 'Unknown upload_id {0}'.format(upload_id))
 
+    # A numbered part makes it a multipart upload, where parts may arrive in
+    # any order and are assembled at commit time. Mixing both kinds of chunks
+    # in a single upload is an error.
+    data_stream = stream.request_stream()
+    if part is not None:
+        if part < 0 or obj.offset:
+            return _make_response(obj), 400
+        _register_part(obj, part, data_stream)
+        return _make_response(obj)
+
     # Either it's a new upload, or a previously existing one, but in both case
     # we expect the offset to match our expected values. The response contains
     # the regular JSON data (containing our expected offset) but with a 400.
-    if offset != obj.offset:
+    if offset != obj.offset or obj.parts:
         return _make_response(obj), 400
 
     # We call our storage strategy to append the received data to previously
     # received chunks.
-    data_stream = request.stream or request.data
-    obj.offset = file_store.register_chunk(obj.upload_id, data_stream)
-    g.db_session.commit()
+    _register_chunk(obj, data_stream)
     return _make_response(obj)
 
 
@@ -101,26 +273,22 @@ def commit_chunked_upload(root, path_):
     if not db_upload:
         raise BasicError(400, 'Unknown upload_id {0}'.format(upload_id))
 
-    # Start by purging the table of all expired uploads.
-    _purge_expired_uploads()
-
-    # We retrieve a file-like object to the uploaded data, and use this as an
-    # input stream to a regular file upload request.
-    data_stream = file_store.retrieve_chunk_stream(upload_id)
-
-    # Install a SHA1 hash calculating stream on the request. This will
-    # allow us to compute the file's hash as it is written to disk.
-    crypt_key = g.user.dbuser.password[:32]
-    enc_stream = stream.AESEncryptionStream(data_stream, crypt_key)
-    hash_stream = stream.ChecksumCalcStream(enc_stream)
-    put_result = put.do_put(root, path_, hash_stream, hash_stream.hash,
-                            enc_stream.IV)
-
-    # Close the input stream.
-    data_stream.close()
+    # Sequential uploads were encrypted and hashed as they were received: the
+    # upload file only has to be moved to its final location. The parts of a
+    # multipart upload are instead read one after the other, and used as an
+    # input stream to a regular file upload request, and must be numbered
+    # from 0 without gaps.
+    parts = [part.number for part in db_upload.parts]
+    for index, number in enumerate(parts):
+        if index != number:
+            raise BasicError(400, E_MISSING_PART(index))
+    if not parts:
+        put_result = _commit_chunks(root, path_, db_upload)
+    else:
+        put_result = _commit_parts(root, path_, upload_id, parts)
 
-    # Delete the temporary upload file.
-    file_store.remove_chunked_upload(upload_id)
+    # Delete the temporary upload files.
+    file_store.remove_chunked_upload(upload_id, parts)
 
     # If we got here, it means that the storage is successful and the database
     # object can now be safely deleted.
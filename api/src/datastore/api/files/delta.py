@@ -0,0 +1,216 @@
+import threading
+import time
+
+from flask import g, request
+from flask.ext.login import login_required
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload_all
+from sqlalchemy.sql.expression import or_
+
+from datastore.api import app, config, notification, tools
+from datastore.api.errors import *
+from datastore.api.files import metadata
+from datastore.api.helpers import database, decorators
+from datastore import models
+
+
+_notification_config = getattr(config, 'notification', None) or {}
+
+# Waiting requests are notified of the changes made by the same process, and
+# check the database every poll_interval seconds for the others.
+poll_interval = _notification_config.get('poll_interval', 5)
+
+# Waiting requests hold a worker thread each: at most max_waiters of them wait
+# at a time in a process, the other threads being left to the rest of the API.
+max_waiters = _notification_config.get('max_waiters', 16)
+_waiters = threading.BoundedSemaphore(max_waiters)
+
+
+def _get_limit():
+    # Maximum number of journal (or index) entries to process (up to 1000).
+    limit = int(request.args.get('limit', '1000'))
+    if not (0 < limit <= 1000):
+        raise BasicError(406, E_LIMIT(0, 1000))
+    return limit
+
+
+def _make_entries(root, index_entries):
+    # A path may identify both a file and a directory: each gets an entry. The
+    # content of deleted directories is deleted along with them.
+    paths = [entry.path for entry in index_entries]
+    deleted = database.below_deleted_dirs(root, paths)
+    for entry in index_entries:
+        for link in (entry.tree_link, entry.blob_link):
+            if link:
+                md = metadata.make_metadata(root, entry.path, link, list=False)
+                if entry.path in deleted:
+                    md['is_deleted'] = True
+                yield [md['path'], md]
+
+
+def _parse_cursor(cursor):
+    # Cursors are either the id of the last change of the journal which was
+    # returned, optionally followed by a slash and the last returned path of
+    # the next change, or the id of the last change when the listing started
+    # and the id of the last index entry which was returned, separated by a
+    # dot.
+    change_id, _, after = cursor.partition('/')
+    try:
+        ids = [int(id_) for id_ in change_id.split('.')]
+    except ValueError:
+        raise BasicError(400, E_INVALID_CURSOR(cursor))
+    if len(ids) > 2 or (after and len(ids) > 1):
+        raise BasicError(400, E_INVALID_CURSOR(cursor))
+    return ids[0], (ids[1] if len(ids) == 2 else None), (after or None)
+
+
+def _query_index(node):
+    return g.db_session.query(models.PathIndex) \
+                       .options(joinedload_all('tree_link.tree')) \
+                       .filter(models.PathIndex.node_id == node.id)
+
+
+def _has_changes(node_id, change_id):
+    query = g.db_session.query(models.Change.id) \
+                        .filter(models.Change.node_id == node_id,
+                                models.Change.id > change_id)
+    return query.first() is not None
+
+
+def _list_changes(root, node, change_id, after, limit):
+    # Each change gives the current state of its path and of its descendants,
+    # or a null metadata for paths which don't exist anymore. A change which
+    # descendants don't fit in the page is split over several pages: the
+    # cursor then also holds the last returned path of the change.
+    query = g.db_session.query(models.Change) \
+                        .filter(models.Change.node_id == node.id,
+                                models.Change.id > change_id) \
+                        .order_by(models.Change.id)
+
+    entries, paths = [], set()
+    for change in query.limit(limit):
+        if len(entries) >= limit:
+            break
+        if change.path not in paths:
+            paths.add(change.path)
+            remaining = limit - len(entries)
+            clause = or_(models.PathIndex.path == change.path,
+                         database.descendants_clause(models.PathIndex.path,
+                                                     change.path))
+            index_entries = _query_index(node).filter(clause)
+            if after is not None:
+                index_entries = index_entries.filter(
+                    models.PathIndex.path > after)
+            index_entries = index_entries.order_by(models.PathIndex.path) \
+                                         .limit(remaining + 1).all()
+            if len(index_entries) > remaining:
+                index_entries = index_entries[:remaining]
+                entries.extend(_make_entries(root, index_entries))
+                cursor = '%d/%s' % (change_id, index_entries[-1].path)
+                return entries, cursor, True
+            change_entries = list(_make_entries(root, index_entries))
+            if not change_entries and after is None:
+                change_entries = [['/' + change.path, None]]
+            entries.extend(change_entries)
+        change_id, after = change.id, None
+
+    has_more = _has_changes(node.id, change_id)
+    return entries, str(change_id), has_more
+
+
+def _list_index(root, node, change_id, index_id, limit):
+    # The whole content of the storage node is listed from its path index. The
+    # changes which happen in the meantime are replayed afterwards.
+    query = _query_index(node).filter(models.PathIndex.id > index_id) \
+                              .order_by(models.PathIndex.id)
+    index_entries = query.limit(limit + 1).all()
+    has_more = len(index_entries) > limit
+    index_entries = index_entries[:limit]
+
+    entries = list(_make_entries(root, index_entries))
+    cursor = str(change_id)
+    if has_more:
+        cursor = '%d.%d' % (change_id, index_entries[-1].id)
+    return entries, cursor, has_more
+
+
+@app.route('/delta/<storage_node:root>', methods=['GET'])
+@login_required
+@decorators.api_endpoint
+def files_delta(root):
+    """Return the changes of a storage node since the provided cursor, as a
+    list of [path, metadata] entries where the metadata is null for removed
+    paths. Without a cursor, the whole content of the storage node is returned
+    and 'reset' is set, meaning that the client should start from scratch.
+    Results are paginated: clients call again with the returned cursor as long
+    as 'has_more' is set.
+    """
+    tools.validate_root_or_abort(root)
+    limit = _get_limit()
+    node = g.user.dbuser.nodes[root]
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        change_id, index_id, after = _parse_cursor(cursor)
+    else:
+        query = g.db_session.query(func.max(models.Change.id)) \
+                            .filter(models.Change.node_id == node.id)
+        change_id, index_id = query.scalar() or 0, 0
+
+    if index_id is None:
+        entries, cursor, has_more = _list_changes(root, node, change_id,
+                                                  after, limit)
+    else:
+        entries, cursor, has_more = _list_index(root, node, change_id,
+                                                index_id, limit)
+    return {
+        'entries': entries,
+        'cursor': cursor,
+        'has_more': has_more,
+        'reset': not request.args.get('cursor'),
+    }
+
+
+@app.route('/longpoll_delta/<storage_node:root>', methods=['GET'])
+@login_required
+@decorators.api_endpoint
+def files_longpoll_delta(root):
+    """Wait until the storage node changes after the provided cursor, or until
+    the timeout (in seconds) expires. 'changes' tells whether a call to /delta
+    would return new entries. When too many requests are already waiting, the
+    changes are checked without waiting, and 'backoff' gives the number of
+    seconds to wait before calling again.
+    """
+    tools.validate_root_or_abort(root)
+    change_id = _parse_cursor(request.args['cursor'])[0]
+    timeout = int(request.args.get('timeout', '30'))
+    if not (0 < timeout <= 60):
+        raise BasicError(406, E_TIMEOUT(0, 60))
+
+    # When all the waiting slots of the process are taken, the request doesn't
+    # wait: the client is told to back off instead.
+    node_id = g.user.dbuser.nodes[root].id
+    if not _waiters.acquire(False):
+        return {'changes': _has_changes(node_id, change_id),
+                'backoff': poll_interval}
+
+    # The notification version is retrieved before checking the database, so
+    # that a change committed in between is not missed. The database session
+    # is closed while waiting, which releases its connection and makes the
+    # next check see the latest changes.
+    try:
+        deadline = time.time() + timeout
+        while True:
+            version = notification.get_version(node_id)
+            if _has_changes(node_id, change_id):
+                return {'changes': True}
+            g.db_session.close()
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return {'changes': False}
+            notification.wait(node_id, version,
+                              min(remaining, poll_interval))
+    finally:
+        _waiters.release()
@@ -1,28 +1,154 @@
 import json
+import mimetypes
+import os
+import os.path
+import shutil
+import tempfile
 import urllib2
 
-from flask import g, send_file
+from flask import abort, g, request, safe_join, send_file, Response
 from flask.ext.login import login_required
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import LimitedStream
 
-from datastore.api import app, file_store, tools
+from datastore.api import app, config, file_store, tools
 from datastore.api.files import metadata, shares
 from datastore.api.errors import *
-from datastore.api.helpers import database
+from datastore.api.helpers import chunking, database, snapshot
 from datastore.api.helpers.stream import AESDecryptionStream
 
 
-def _send_file(stream, path, metadata, encryption_iv):
+def _cache_decrypted_blob(root, blob, cache_root, key, crypt_key):
+    # The decrypted file is written to a temporary file which is then renamed,
+    # so that the web server never serves a partially written file. Cached
+    # files are evicted once unused for a while (see manage.purge_cache), which
+    # serving them postpones.
+    filepath = safe_join(os.path.abspath(cache_root), key)
+    if os.path.exists(filepath):
+        os.utime(filepath, None)
+        return filepath
+
+    stream = file_store.retrieve_blob_stream(root, blob.hash)
     if not stream:
+        return None
+
+    tools.make_dirs(os.path.dirname(filepath))
+    temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(filepath),
+                                            delete=False)
+    try:
+        with temp_file:
+            decrypted = AESDecryptionStream(stream, crypt_key, blob.iv)
+            shutil.copyfileobj(decrypted, temp_file)
+        os.rename(temp_file.name, filepath)
+    except Exception:
+        os.remove(temp_file.name)
+        raise
+    finally:
+        stream.close()
+    return filepath
+
+
+def _get_byte_range(blob, size):
+    # Only single byte ranges are supported: anything else gets the whole file.
+    # This is also the case when the If-Range precondition doesn't hold, which
+    # can only be verified against our ETag (we don't send Last-Modified).
+    byte_range = request.range
+    if not byte_range or size is None or len(byte_range.ranges) != 1:
+        return None
+    if 'If-Range' in request.headers and request.if_range.etag != blob.hash:
+        return None
+
+    # A single range which doesn't match the file gets a 416.
+    start_stop = byte_range.range_for_length(size)
+    if not start_stop:
+        headers = {'Content-Range': ContentRange('bytes', None, None, size)}
+        abort(Response(status=416, headers=headers))
+    return start_stop
+
+
+def _offload_file(root, path, metadata, blob, crypt_key):
+    # When enabled, the transfer is offloaded to the front web server through
+    # an internal redirect. Files which are not encrypted are served right from
+    # the storage, others from a cache of decrypted files.
+    offload = config.storage.get('offload')
+    if not offload:
+        return None
+
+    # Blobs stored as chunks are always streamed.
+    key = '/'.join([root, blob.hash[:2], blob.hash[2:]])
+    if blob.chunks:
+        return None
+    elif blob.iv is None:
+        filepath = file_store.retrieve_blob_path(root, blob.hash)
+        location = offload.get('storage_location', '')
+    else:
+        cache_root = offload['cache_root']
+        filepath = _cache_decrypted_blob(root, blob, cache_root, key,
+                                         crypt_key)
+        location = offload.get('cache_location', '')
+    if not filepath or not os.path.exists(filepath):
+        return None
+
+    # X-Sendfile takes a filesystem path, whereas X-Accel-Redirect takes an
+    # URI which nginx maps to an internal location.
+    header = offload.get('header', 'X-Accel-Redirect')
+    filename = tools.split_path(path)[-1]
+    response = Response(mimetype=(mimetypes.guess_type(filename)[0] or
+                                  'application/octet-stream'))
+    response.headers[header] = (filepath if header.lower() == 'x-sendfile'
+                                else location + key)
+    response.headers.add('Content-Disposition', 'attachment',
+                         filename=filename)
+    return _set_file_headers(response, metadata, blob)
+
+
+def _send_file(root, path, metadata, blob, owner):
+    # Files are decrypted with the key of their owner, who may not be the user
+    # downloading them through a link.
+    crypt_key = owner.password[:32]
+    response = _offload_file(root, path, metadata, blob, crypt_key)
+    if response:
+        return response
+
+    chunks = blob.chunks
+    stream = None if chunks else file_store.retrieve_blob_stream(root,
+                                                                 blob.hash)
+    if not chunks and not stream:
         raise BasicError(404, E_FILE_NOT_FOUND)
 
-    # The file will be decrypted with the user's password as it is read.
-    crypt_key = g.user.dbuser.password[:32]
-    stream = AESDecryptionStream(stream, crypt_key, encryption_iv)
+    # AES-CTR is seekable: partial requests start decrypting the stream at the
+    # requested offset.
+    size = metadata['bytes']
+    byte_range = _get_byte_range(blob, size)
+    offset = byte_range[0] if byte_range else 0
+
+    # The file will be decrypted with the owner's password as it is read,
+    # unless it was stored without encryption. Blobs stored as chunks are
+    # decrypted chunk by chunk.
+    if chunks:
+        stream = chunking.open_manifest(root, chunks, crypt_key, offset)
+    elif blob.iv is not None:
+        stream = AESDecryptionStream(stream, crypt_key, blob.iv, offset)
+    elif offset:
+        stream.seek(offset)
+    if byte_range:
+        stream = LimitedStream(stream, byte_range[1] - byte_range[0])
 
     filename = tools.split_path(path)[-1]
     response = send_file(stream, add_etags=False, as_attachment=True,
                          attachment_filename=filename)
+    if byte_range:
+        response.status_code = 206
+        response.content_length = byte_range[1] - byte_range[0]
+        response.content_range = ContentRange('bytes', byte_range[0],
+                                              byte_range[1], size)
+    return _set_file_headers(response, metadata, blob)
+
+
+def _set_file_headers(response, metadata, blob):
     response.headers['x-datastore-metadata'] = json.dumps(metadata)
+    response.accept_ranges = 'bytes'
+    response.set_etag(blob.hash)
     return response
 
 
@@ -31,23 +157,22 @@ def _send_file(stream, path, metadata, encryption_iv):
 def files_get(root, path_):
     tools.validate_root_or_abort(root)
 
-    # Attempt to retrieve the database representation of the requested file
-    # from the database, and raise a 404 if we failed in doing so.
+    # Attempt to retrieve the snapshot of the requested file from the head
+    # commit, and raise a 404 if we failed in doing so.
     try:
-        dbobject = database.get_stored_object(root, path_)
+        dbobject = snapshot.get_stored_object(root, path_)
     except database.MissingNodeException:
         raise BasicError(404, E_FILE_NOT_FOUND)
 
     # Request the actual disk object to the file_store, and send the result as
     # a file to the client.
     fmdata = metadata.make_metadata(root, path_, dbobject)
-    stream = file_store.retrieve_blob_stream(root, dbobject.hash)
-    return _send_file(stream, path_, fmdata, dbobject.iv)
+    return _send_file(root, path_, fmdata, dbobject, g.user.dbuser)
 
 
 @app.route('/files/<key>', methods=['GET'])
 def files_get_key(key):
     db_ref = shares.retrieve_ref(urllib2.unquote(key))
     fmdata = metadata.make_metadata(db_ref.root, db_ref.path, db_ref.blob)
-    stream = file_store.retrieve_blob_stream(db_ref.root, db_ref.blob.hash)
-    return _send_file(stream, db_ref.path, fmdata, db_ref.blob.iv)
+    return _send_file(db_ref.root, db_ref.path, fmdata, db_ref.blob,
+                      db_ref.owner)
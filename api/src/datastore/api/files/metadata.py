@@ -3,13 +3,14 @@ import hashlib
 import mimetypes
 import urllib2
 
-from flask import request, Response
+from flask import jsonify, request, Response
 from flask.ext.login import login_required
 
 from datastore.api import app, file_store, tools
 from datastore.api.errors import *
 from datastore.api.files import shares
-from datastore.api.helpers import database, decorators, display
+from datastore.api.helpers import (database, decorators, display, snapshot,
+                                   streaming)
 from datastore import models
 
 
@@ -33,25 +34,68 @@ def _get_url_params():
 
 
 def _make_dir_content(root, path_, tree, **kwargs):
-    # Each directory listing contains a hash value which helps the client
-    # determine if anything has changed. This hash takes into account:
-    #   - each sub directory name and deleted status
-    #   - each sub file name, deleted status and hash.
-    #
-    # As a result, the hash will change only if any top level element changes,
-    # without taking sub directories content into account.
-    hash_ = hashlib.sha1()
     path_ = _append(path_)
     accept = lambda o: kwargs.get('include_deleted', False) or not o.is_deleted
 
     def _gen_md(collection):
         for _, obj in sorted(collection.items()):
-            hash_.update(_object_hash(obj))
             if accept(obj):
                 yield make_metadata(root, path_ + obj.path, obj, **kwargs)
 
     content = [m for c in [tree.sub_trees, tree.sub_files] for m in _gen_md(c)]
-    return content, hash_.hexdigest()[:hash_size]
+    return content, _make_dir_hash(tree)
+
+
+def _make_dir_hash(tree):
+    # Each directory listing contains a hash value which helps the client
+    # determine if anything has changed. It is maintained on commit, but we
+    # still compute it for directories which predate the stored hash.
+    return (tree.hash or tree.compute_hash())[:hash_size]
+
+
+def _get_page_params():
+    # Directory listings are paginated when a limit or a cursor is provided.
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if not (0 < limit <= 25000):
+            raise BasicError(406, E_LIMIT(0, 25000))
+
+    cursor = request.args.get('cursor')
+    after = cursor and streaming.decode_cursor(cursor)
+    if after and not (isinstance(after, list) and len(after) == 2 and
+                      after[0] in ('d', 'f')):
+        raise BasicError(400, E_INVALID_CURSOR(cursor))
+    return limit, after
+
+
+def _list_dir(root, path_, tree_link, limit, after, stream, **kwargs):
+    # The directory metadata is built without its content, which is then
+    # retrieved by batches and serialized one entry at a time.
+    options = dict(kwargs, list=False)
+    metadata = make_metadata(root, path_, tree_link, **options)
+    metadata.update(hash=_make_dir_hash(tree_link.tree))
+
+    include_deleted = kwargs.get('include_deleted', False)
+    links = database.iter_children(tree_link.tree, after, include_deleted)
+    if tree_link.is_deleted and not include_deleted:
+        links = iter([])
+    page = streaming.Page(links, limit)
+    contents = (make_metadata(root, _append(path_) + link.path, link, **options)
+                for link in page)
+
+    # The content of a deleted directory is deleted along with it.
+    if tree_link.is_deleted:
+        contents = (dict(md, is_deleted=True) for md in contents)
+    trailer = lambda: {'cursor': page.cursor, 'has_more': page.has_more}
+
+    metadata['api-version'] = decorators.api_version()
+    if stream:
+        return streaming.object_response(metadata, 'contents', contents,
+                                         trailer)
+    metadata['contents'] = list(contents)
+    metadata.update(trailer())
+    return jsonify(metadata)
 
 
 def _make_base_metadata(root, path_, obj):
@@ -88,8 +132,11 @@ def _make_dir_metadata(root, path_, tree_link, **kwargs):
 
 
 def _make_file_metadata(root, path_, blob, **kwargs):
-    # Retrieve the blob statistics from the file_store.
-    file_date, file_size = file_store.stat_blob(root, path_, blob.hash)
+    # Blob statistics are stored in database, although we fall back to the
+    # file_store for blobs which were registered before they were.
+    file_date, file_size = blob.created, blob.size
+    if file_size is None:
+        file_date, file_size = file_store.stat_blob(root, path_, blob.hash)
 
     # Build and return the metadata dictionary.
     metadata = _make_base_metadata(root, path_, blob)
@@ -118,22 +165,13 @@ def _make_tree_rev(tree):
     return hashlib.sha1(str(tree.id)).hexdigest()
 
 
-def _object_hash(obj):
-    hash_str = ''
-    if isinstance(obj, models.TreeLink):
-        hash_str = str((obj.path, obj.is_deleted))
-    elif isinstance(obj, models.BlobLink):
-        hash_str = str((obj.path, obj.is_deleted, obj.blob.hash))
-    return hash_str
-
-
 def make_metadata(root, path_, obj, **kwargs):
     # Retrieve the stored object and send the metadata depending on its type,
     # which can either be a Tree or a BlobLink.
     metadata = None
-    if isinstance(obj, models.TreeLink):
+    if isinstance(obj, (models.TreeLink, snapshot.TreeLinkSnapshot)):
         metadata = _make_dir_metadata(root, path_, obj, **kwargs)
-    elif isinstance(obj, models.BlobLink):
+    elif isinstance(obj, (models.BlobLink, snapshot.BlobLinkSnapshot)):
         metadata = _make_file_metadata(root, path_, obj, **kwargs)
     return metadata or {}
 
@@ -144,17 +182,29 @@ def make_metadata(root, path_, obj, **kwargs):
 def files_metadata(root, path_):
     tools.validate_root_or_abort(root)
 
+    # The object is retrieved from the snapshots of the head commit, which
+    # directories are loaded along with their content.
     try:
-        stored_object = database.get_stored_object(root, path_)
+        stored_object = snapshot.get_stored_object(root, path_)
     except database.MissingNodeException:
         raise BasicError(404, E_FILE_NOT_FOUND)
 
     # If the client has provided a hash value and it compares equal to the one
-    # we have just generated, return a 304 (Not Modified).
+    # of the requested directory, return a 304 (Not Modified).
     params = _get_url_params()
+    is_dir = isinstance(stored_object, snapshot.TreeLinkSnapshot)
+    if params.get('list', True) and is_dir:
+        if request.args.get('hash') == _make_dir_hash(stored_object.tree):
+            return Response(status=304)
+
+        # Listings may be paginated and streamed, in which case the content is
+        # retrieved as it is serialized.
+        limit, after = _get_page_params()
+        stream = tools.get_boolean_arg(request.args, 'stream')
+        if limit or after or stream:
+            return _list_dir(root, path_, stored_object, limit, after, stream,
+                             **params)
     metadata = make_metadata(root, path_, stored_object, **params)
-    if request.args.get('hash') == metadata.get('hash', ''):
-        return Response(status=304)
 
     # Little hack here: we cannot decorate files_metadata function as an json
     # api endpoint because it may return a 304 without data. We use this tiny
@@ -1,23 +1,60 @@
+from datetime import datetime
+import functools
+import hashlib
+import hmac
 import itertools
 import os.path
+import shutil
+import tempfile
 
 from flask import g, request
 from flask.ext.login import login_required
 
-from datastore.api import app, file_store, tools
+from sqlalchemy.exc import IntegrityError
+
+from datastore.api import app, config, file_store, tools
 from datastore.api.errors import *
 from datastore.api.files import metadata
-from datastore.api.helpers import database, decorators, stream
+from datastore.api.helpers import chunking, database, decorators, stream
 from datastore import models
 
 
-def _find_or_create_blob(filehash, encryption_iv):
+# When deduplication is enabled, the plaintext of uploads is spooled to a
+# temporary file, which is kept in memory up to spool_size bytes.
+spool_size = 1024 * 1024
+
+
+class _ContentHasher(object):
+    # The HMAC is computed over the SHA1 of the plaintext rather than over the
+    # plaintext itself: the plaintext can then be hashed before the storage
+    # node is known (see chunked_upload).
+
+    def __init__(self, crypt_key, root, hasher):
+        self._key = crypt_key
+        self._prefix = root.encode('utf-8') + '/'
+        self.hash = hasher
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def hexdigest(self):
+        message = self._prefix + self.hash.digest()
+        return hmac.new(self._key, message, hashlib.sha1).hexdigest()
+
+
+def _find_or_create_blob(root, path_, filehash, encryption_iv, content_key):
     # Check if we already hold the provided file, or create a new Blob object
     # as necessary.
     tabl = g.db_session.query(models.Blob)
     blob = tabl.filter(models.Blob.hash == filehash).first()
     if not blob:
-        blob = models.Blob(hash=filehash, iv=encryption_iv)
+        blob = models.Blob(hash=filehash, iv=encryption_iv,
+                           content_key=content_key)
+
+    # Record the blob statistics once and for all, so that the metadata can be
+    # served without accessing the file store.
+    if blob.size is None:
+        update_blob_stats(root, path_, blob)
     return blob
 
 
@@ -60,13 +97,11 @@ def _make_unique_filename(original, directory):
             return attempt
 
 
-def do_put(root, path_, stream, hasher, encryption_iv):
-    # A file operation is always traduced by a new Commit object in order to
-    # track the changes. If copying fails because of an incomplete source
-    # hierarchy we abort with a 404.
+def _put_blob(target_node, root, path_, fileblob):
+    # If copying fails because of an incomplete source hierarchy we abort with
+    # a 404.
     try:
-        commit = database.create_commit(root)
-        ref_node, new_node = database.copy_hierarchy(root, path_, commit.root)
+        parent = database.copy_hierarchy(root, path_, target_node)
     except database.MissingNodeException:
         raise BasicError(404, E_NON_EXISTING_DESTINATION_PATH)
 
@@ -79,30 +114,153 @@ def do_put(root, path_, stream, hasher, encryption_iv):
     filename = split_pt[-1]
 
     # It is an error to post a file named like an (non deleted) directory.
-    existing_dir = ref_node.sub_trees.get(filename)
+    existing_dir = parent.sub_trees.get(filename)
     if existing_dir and not existing_dir.is_deleted:
         raise BasicError(403, E_DIR_ALREADY_EXISTS)
 
-    if filename in ref_node.sub_files:
-        filename = _handle_conflict(ref_node, filename, **_get_url_params())
+    if filename in parent.sub_files:
+        filename = _handle_conflict(parent, filename, **_get_url_params())
         path_ = '/'.join(['/'.join(split_pt[:-1]), filename])
 
-    # We start by storing the provided content, and then we try and make the
-    # database structure reflect the requested change.
-    filehash = file_store.register_blob(root, path_, stream, hasher)
-    fileblob = _find_or_create_blob(filehash, encryption_iv)
-
-    # Update the blob entry if it's actually different from the previous one,
-    # and commit to the database. Considering that the on disk blobs are
-    # encrypted with a randomly generated IV, this is more than unlikely.
-    old_blob = ref_node and ref_node.sub_files.get(filename)
-    if old_blob and (old_blob.hash == fileblob.hash):  # pragma: no cover
+    # Update the blob entry if it's actually different from the previous one.
+    # Considering that the on disk blobs are encrypted with a randomly
+    # generated IV, this is more than unlikely unless blobs are deduplicated.
+    old_blob = parent.sub_files.get(filename)
+    if old_blob and (old_blob.hash == fileblob.hash):
         output = old_blob
         old_blob.is_deleted = False  # Restore the file if it was deleted
+        database.index_object(root, path_, output)
     else:
         output = models.BlobLink(blob=fileblob, path=filename, parent=old_blob)
-        new_node.sub_files[filename] = output
-        database.store_commit(root, commit)
+        parent.sub_files[filename] = output
+        database.index_object(root, path_, output)
+        database.record_revision(root, path_, output)
+    return path_, output
+
+
+def _register_deduplicated_blob(root, path_, data_stream, content_hasher,
+                                crypt_key, encryption_iv):
+    # The plaintext is spooled as it is hashed, such that duplicates are found
+    # before any data is encrypted or written to the file store.
+    with tempfile.SpooledTemporaryFile(spool_size) as spool:
+        shutil.copyfileobj(data_stream, spool)
+        existing_hash = find_duplicate_blob(root, content_hasher)
+        if existing_hash:
+            return existing_hash
+
+        spool.seek(0)
+        enc_stream = spool
+        if crypt_key:
+            enc_stream = stream.AESEncryptionStream(spool, crypt_key,
+                                                    encryption_iv)
+        hash_stream = stream.ChecksumCalcStream(enc_stream)
+        return file_store.register_blob(root, path_, hash_stream,
+                                        hash_stream.hash)
+
+
+def _store_blob(root, path_, filehash, encryption_iv, content_key):
+    fileblob = _find_or_create_blob(root, path_, filehash, encryption_iv,
+                                    content_key)
+    g.db_session.add(fileblob)
+    g.db_session.commit()
+    return fileblob
+
+
+def find_duplicate_blob(root, content_hasher):
+    """Return the hash of a blob with the same plaintext as the one hashed by
+    content_hasher, or None. Called once the content has been read, returning a
+    hash discards the new data. The duplicate may not be referenced yet: its
+    date is refreshed for the garbage collector to spare it until the new file
+    is committed.
+    """
+    content_key = content_hasher.hexdigest()
+    tabl = g.db_session.query(models.Blob)
+    blob = tabl.filter(models.Blob.content_key == content_key).first()
+    if not blob:
+        return None
+    file_store.touch_blob(root, blob.hash)
+    return blob.hash
+
+
+def make_content_hasher(root, hasher=None):
+    """Return a hasher for the plaintext of a blob when deduplication is
+    enabled, or None. Content keys are an HMAC using the user's encryption key,
+    such that identical content can only be matched for a given user and
+    storage node. The plaintext is hashed with hasher, which defaults to SHA1.
+    """
+    if not config.storage.get('deduplication', False):
+        return None
+    crypt_key = g.user.dbuser.password[:32]
+    return _ContentHasher(crypt_key, root, hasher or hashlib.sha1())
+
+
+def make_register_blob(root, path_, data_stream, hasher):
+    """Return a function storing data_stream to the file store, as expected by
+    do_put.
+    """
+    return functools.partial(file_store.register_blob, root, path_,
+                             data_stream, hasher)
+
+
+def make_deduplicating_register_blob(root, path_, data_stream,
+                                     content_hasher):
+    """Return a function storing the plaintext read from data_stream to the
+    file store unless content_hasher identifies it as a duplicate, as expected
+    by do_put, along with the IV it is encrypted with (None if encryption at
+    rest is disabled).
+    """
+    crypt_key = encryption_iv = None
+    if config.storage.get('encryption', True):
+        crypt_key = g.user.dbuser.password[:32]
+        encryption_iv = stream.AESEncryptionStream.generate_IV()
+    register_blob = functools.partial(_register_deduplicated_blob, root, path_,
+                                      data_stream, content_hasher, crypt_key,
+                                      encryption_iv)
+    return register_blob, encryption_iv
+
+
+def make_chunking_register_blob(root, path_, data_stream):
+    """Return a function storing data_stream to the file store as content-
+    defined chunks, as expected by do_put. Chunks are encrypted on their own
+    unless encryption at rest is disabled.
+    """
+    crypt_key = None
+    if config.storage.get('encryption', True):
+        crypt_key = g.user.dbuser.password[:32]
+    return functools.partial(chunking.register_chunks, root, path_,
+                             data_stream, crypt_key)
+
+
+def update_blob_stats(root, path_, blob):
+    """Fill the size and creation date of a Blob from the file store."""
+    file_date, file_size = file_store.stat_blob(root, path_, blob.hash)
+    if file_date is not None and not isinstance(file_date, datetime):
+        file_date = datetime.fromtimestamp(file_date)
+    blob.created, blob.size = file_date, file_size
+
+
+def do_put(root, path_, register_blob, encryption_iv, content_hasher=None):
+    # We start by storing the provided content (register_blob returns its
+    # hash) along with its Blob object, before any commit is started: the
+    # transfer doesn't hold back the concurrent changes to the storage node.
+    # Blobs which don't end up being referenced are garbage collected.
+    filehash = register_blob()
+    content_key = content_hasher.hexdigest() if content_hasher else None
+    try:
+        fileblob = _store_blob(root, path_, filehash, encryption_iv,
+                               content_key)
+    except IntegrityError:
+        # A concurrent upload of the same content stored the Blob (and its
+        # manifest) first: ours is dropped in favor of it.
+        g.db_session.rollback()
+        fileblob = _store_blob(root, path_, filehash, encryption_iv,
+                               content_key)
+
+    # A file operation is always traduced by a new Commit object in order to
+    # track the changes: we then try and make the database structure reflect
+    # the requested change.
+    path_, output = database.run_commit(root, _put_blob, root, path_,
+                                        fileblob)
     return metadata.make_metadata(root, path_, output)
 
 
@@ -112,17 +270,43 @@ def do_put(root, path_, stream, hasher, encryption_iv):
 def files_put(root, path_):
     tools.validate_root_or_abort(root)
 
+    # When content-defined chunking is enabled, the plaintext is split into
+    # chunks which are encrypted and stored independently: the stream decorators
+    # below don't apply.
+    if config.storage.get('chunking', False):
+        register_blob = make_chunking_register_blob(
+            root, path_, stream.request_stream())
+        return do_put(root, path_, register_blob, None)
+
+    # When deduplication is enabled, the plaintext is hashed as it is read in
+    # order to identify content we already hold, and only encrypted and stored
+    # if we don't.
+    content_hasher = make_content_hasher(root)
+    if content_hasher:
+        stream.install_stream(stream.ChecksumCalcStream, content_hasher)
+        register_blob, encryption_iv = make_deduplicating_register_blob(
+            root, path_, stream.request_stream(), content_hasher)
+        return do_put(root, path_, register_blob, encryption_iv,
+                      content_hasher)
+
     # Install a AES256 encrypting stream on the request. All the posted data
     # will be encrypted on the fly as it is read. A specific IV will be
     # generated in the process and inserted to the database later on. We use
     # the user's hashed password as encryption key: if a user believes if was
     # compromised and changes his password, all the files are made unusable.
-    crypt_key = g.user.dbuser.password[:32]
-    enc_stream = stream.install_stream(stream.AESEncryptionStream, crypt_key)
+    # Encryption at rest may be disabled by configuration, in which case the
+    # blob is stored with a null IV.
+    encryption_iv = None
+    if config.storage.get('encryption', True):
+        crypt_key = g.user.dbuser.password[:32]
+        enc_stream = stream.install_stream(stream.AESEncryptionStream,
+                                           crypt_key)
+        encryption_iv = enc_stream.IV
 
     # Install a SHA1 hash calculating stream on the request. This will allow us
     # to compute the file's hash as it is written to disk.
     hash_stream = stream.install_stream(stream.ChecksumCalcStream)
 
-    data_stream = request.stream or request.data
-    return do_put(root, path_, data_stream, hash_stream.hash, enc_stream.IV)
+    register_blob = make_register_blob(root, path_, hash_stream,
+                                       hash_stream.hash)
+    return do_put(root, path_, register_blob, encryption_iv)
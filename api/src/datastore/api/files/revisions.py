@@ -1,4 +1,3 @@
-import itertools
 import json
 
 from flask import request
@@ -7,8 +6,7 @@ from flask.ext.login import login_required
 from datastore.api import app, tools
 from datastore.api.errors import *
 from datastore.api.files import metadata
-from datastore.api.helpers import database
-from datastore import models
+from datastore.api.helpers import database, snapshot, streaming
 
 
 @app.route('/revisions/<storage_node:root>/<path:path_>', methods=['GET'])
@@ -17,11 +15,11 @@ def files_revisions(root, path_):
     tools.validate_root_or_abort(root)
 
     try:
-        stored_object = database.get_stored_object(root, path_)
+        stored_object = snapshot.get_stored_object(root, path_)
     except database.MissingNodeException:
         raise BasicError(404, E_FILE_NOT_FOUND)
     else:
-        if not isinstance(stored_object, models.BlobLink):
+        if not isinstance(stored_object, snapshot.BlobLinkSnapshot):
             raise BasicError(404, E_FILE_NOT_FOUND)
 
     # Maximum number of file revision to fetch (up to 1000).
@@ -29,14 +27,19 @@ def files_revisions(root, path_):
     if not (0 < rev_limit <= 1000):
         raise BasicError(406, E_REV_LIMIT(0, 1000))
 
-    def _revisions(stored_object):
-        while stored_object:
-            yield stored_object
-            stored_object = stored_object.parent
+    # Results are paginated by rev_limit: the cursor of the next page is sent
+    # as a header, and the last page is the first with less results. Each page
+    # is retrieved from the history of the file using a single query.
+    offset = streaming.get_offset(request.args)
+    revisions = snapshot.get_revisions(root, path_, stored_object, offset,
+                                       rev_limit)
+    results = (metadata.make_metadata(root, path_, obj) for obj in revisions)
+    headers = {'x-datastore-cursor': streaming.encode_cursor(offset +
+                                                             rev_limit)}
+    if tools.get_boolean_arg(request.args, 'stream'):
+        return streaming.list_response(results, headers)
 
     # Remark: we cannot use flask.jsonify here (through our usual api_endpoint
     # decorator), see http://flask.pocoo.org/docs/security/#json-security.
-    return json.dumps([
-        metadata.make_metadata(root, path_, obj)
-        for obj in itertools.islice(_revisions(stored_object), rev_limit)
-    ]), 200, {'content-type': 'application/json'}
+    headers['content-type'] = 'application/json'
+    return json.dumps(list(results)), 200, headers
@@ -1,5 +1,5 @@
+import itertools
 import json
-import os.path
 
 from flask import request
 from flask.ext.login import login_required
@@ -7,23 +7,15 @@ from flask.ext.login import login_required
 from datastore.api import app, tools
 from datastore.api.errors import *
 from datastore.api.files import metadata
-from datastore.api.helpers import database
+from datastore.api.helpers import database, snapshot, streaming
 from datastore.api.tools import get_boolean_arg
-from datastore import models
 
 
-def _gen_metadata(obj, root, path, query, **kwargs):
-    accept = lambda o: kwargs.get('include_deleted', False) or not o.is_deleted
-    if query in obj.path and accept(obj):
-        yield metadata.make_metadata(root, path, obj, **kwargs)
-    for _, subd in sorted(obj.tree.sub_trees.items()):
-        sub_path = os.path.join(path, subd.path)
-        for m in _gen_metadata(subd, root, sub_path, query, **kwargs):
-            yield m
-    for _, subf in sorted(obj.tree.sub_files.items()):
-        if query in subf.path and accept(subf):
-            sub_path = os.path.join(path, subf.path)
-            yield metadata.make_metadata(root, sub_path, subf, **kwargs)
+def _gen_metadata(root, path, query, **kwargs):
+    include_deleted = kwargs.get('include_deleted', False)
+    for obj_path, obj in snapshot.search_index(root, path, query,
+                                               include_deleted):
+        yield metadata.make_metadata(root, obj_path, obj, **kwargs)
 
 
 @app.route('/search/<storage_node:root>/<path:path_>')
@@ -38,13 +30,14 @@ def files_search(root, path_):
     if len(query) < 3:
         raise BasicError(400, E_QUERY_LEN(3))
 
-    # Find the root for the search, identified by the provided path.
+    # Find the root for the search, identified by the provided path. Matching
+    # objects below it are found using the path index.
     try:
-        stored_object = database.get_stored_object(root, path_)
+        stored_object = snapshot.get_stored_object(root, path_)
     except database.MissingNodeException:
         raise BasicError(404, E_SEARCH_DIR_NOT_FOUND)
     else:
-        if not isinstance(stored_object, models.TreeLink):
+        if not isinstance(stored_object, snapshot.TreeLinkSnapshot):
             raise BasicError(404, E_SEARCH_PATH_NOT_A_DIR)
 
     # Maximum number of results to fetch (up to 1000).
@@ -59,10 +52,20 @@ def files_search(root, path_):
         'include_deleted': get_boolean_arg(request.args, 'include_deleted')
     }
 
+    # Results are paginated by file_limit: the cursor of the next page is sent
+    # as a header, and the last page is the first with less results.
+    offset = streaming.get_offset(request.args)
+    results = itertools.islice(
+        _gen_metadata(root, path_, query, **kwargs),
+        offset, offset + file_limit)
+    headers = {'x-datastore-cursor': streaming.encode_cursor(offset +
+                                                             file_limit)}
+    if get_boolean_arg(request.args, 'stream'):
+        return streaming.list_response(results, headers)
+
     # Remark: we cannot use flask.jsonify here (through our usual api_endpoint
     # decorator), see http://flask.pocoo.org/docs/security/#json-security.
-    return json.dumps([
-        m for m in _gen_metadata(stored_object, root, path_, query, **kwargs)
-    ]), 200, {'content-type': 'application/json'}
+    headers['content-type'] = 'application/json'
+    return json.dumps(list(results)), 200, headers
 
 files_search.methods = ['GET']
@@ -34,15 +34,9 @@ def _make_file_ref(obj):
     return base64.urlsafe_b64encode(sha1.digest())
 
 
-def _purge_expired_links():
-    clause = models.BlobRef.expires < datetime.utcnow()
-    expired_items = g.db_session.query(models.BlobRef).filter(clause)
-    expired_items.delete()
-    g.db_session.commit()
-
-
 def find_obj_ref(obj):
-    clause = models.BlobRef.blob_id == obj.id
+    clause = and_(models.BlobRef.blob_id == obj.id,
+                  models.BlobRef.expires >= datetime.utcnow())
     if g.user.is_authenticated():
         clause = and_(clause, models.BlobRef.owner_id == g.user.dbuser.id)
     return g.db_session.query(models.BlobRef).filter(clause).first()
@@ -89,9 +83,6 @@ def files_shares(root, path_):
         if not stored_object or type(stored_object) != models.BlobLink:
             raise BasicError(404, E_FILE_NOT_FOUND)
 
-    # Start by purging the table of all expired uploads.
-    _purge_expired_links()
-
     # If we already have a reference to this file, no need to recreate one.
     db_ref = _find_ref_by_key(_make_file_ref(stored_object))
     if not db_ref:
@@ -0,0 +1,157 @@
+"""Content-defined chunking: files are split into variable-size chunks which
+boundaries depend on their content, such that a local change of a file only
+affects the chunks around it.
+
+Boundaries are found using the FastCDC algorithm: a Gear rolling hash is
+computed over the bytes following the minimum chunk size, and a boundary is
+declared where its high bits are all zeros. A stricter mask is used before the
+average size and a looser one after it, which narrows the size distribution.
+
+Each chunk is stored once per storage node, and blobs are described by the
+manifest of their chunks (see datastore.models.BlobChunk).
+
+"""
+
+import cStringIO
+from datetime import datetime
+import hashlib
+import hmac
+import struct
+
+from flask import g
+
+from datastore.api import cipher, config, file_store
+from datastore.api.helpers import stream as stream_helpers
+from datastore import models
+
+
+min_size = config.storage.get('chunk_min_size', 64 * 1024)
+avg_size = config.storage.get('chunk_avg_size', 256 * 1024)
+max_size = config.storage.get('chunk_max_size', 1024 * 1024)
+
+# The Gear table must never change, as it determines the boundaries (and thus
+# the identity) of the stored chunks.
+GEAR = [struct.unpack('<I', hashlib.sha1(chr(byte)).digest()[:4])[0]
+        for byte in range(256)]
+
+
+def _make_mask(bits):
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+# Chunks are cut with a stricter mask before avg_size, and a looser one after.
+# (The bit count of avg_size is taken from bin(): int.bit_length() is missing
+# from Python 2.6.)
+_avg_bits = len(bin(avg_size)) - 3
+_mask_s, _mask_l = _make_mask(_avg_bits + 2), _make_mask(_avg_bits - 2)
+
+
+def _cut_point(buf, size):
+    # Returns the length of the chunk starting at the beginning of buf, which
+    # holds size bytes of data.
+    if size <= min_size:
+        return size
+    limit = min(size, max_size)
+    normal = min(avg_size, limit)
+    mask_s, mask_l = _mask_s, _mask_l
+
+    gear, fingerprint, index = GEAR, 0, min_size
+    while index < normal:
+        fingerprint = ((fingerprint << 1) + gear[buf[index]]) & 0xffffffff
+        index += 1
+        if not fingerprint & mask_s:
+            return index
+    while index < limit:
+        fingerprint = ((fingerprint << 1) + gear[buf[index]]) & 0xffffffff
+        index += 1
+        if not fingerprint & mask_l:
+            return index
+    return limit
+
+
+def _encrypt_chunk(data, crypt_key):
+    # The counter is derived from a keyed hash of the chunk: a given user gets
+    # the same ciphertext for identical chunks, whereas the counters of other
+    # chunks are spread over the upper 64 bits of the counter space. The hash
+    # key is derived from the encryption key, so as not to use the same key
+    # for both purposes.
+    iv_key = hmac.new(crypt_key, 'chunk-iv', hashlib.sha1).digest()
+    digest = hmac.new(iv_key, data, hashlib.sha1).digest()
+    iv = struct.unpack('>Q', digest[:8])[0] << 64
+    return cipher.new_ctr(crypt_key, iv).encrypt(data), iv
+
+
+def _open_chunks(root, chunks, crypt_key, offset):
+    for chunk in chunks:
+        if offset >= chunk.size:
+            offset -= chunk.size
+            continue
+        stream = file_store.retrieve_blob_stream(root, chunk.chunk_hash)
+        if chunk.iv is not None:
+            stream = stream_helpers.AESDecryptionStream(
+                stream, crypt_key, int(chunk.iv, 16), offset)
+        elif offset:
+            stream.seek(offset)
+        offset = 0
+        yield stream
+
+
+def iter_chunks(stream):
+    """Split the content of stream into chunks. An empty stream gives a single
+    empty chunk, such that manifests are never empty.
+    """
+    buf, eof = bytearray(), False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = stream.read(max_size - len(buf))
+            eof = not data
+            buf.extend(data)
+        cut = _cut_point(buf, len(buf))
+        yield bytes(buf[:cut])
+        del buf[:cut]
+        if eof and not buf:
+            break
+
+
+def open_manifest(root, chunks, crypt_key, offset=0):
+    """Return the plaintext of a chunked blob starting at offset, as a
+    file-like object. Chunks are opened as they are read.
+    """
+    return stream_helpers.ConcatenatedStream(
+        _open_chunks(root, chunks, crypt_key, offset))
+
+
+def register_chunks(root, path, stream, crypt_key=None):
+    """Store the content of stream as chunks, and return the hash of its
+    manifest. The Blob describing the content is added to the database session
+    unless it already exists. Chunks are encrypted when crypt_key is provided.
+    """
+    manifest, size = [], 0
+    for number, data in enumerate(iter_chunks(stream)):
+        iv = None
+        chunk_size = len(data)
+        if crypt_key:
+            data, iv = _encrypt_chunk(data, crypt_key)
+
+        # Chunks we already hold are registered again nonetheless, as the file
+        # store refreshes their date for the garbage collector to spare them.
+        chunk_hash = file_store.register_blob(root, path,
+                                              cStringIO.StringIO(data),
+                                              hashlib.sha1(data))
+        manifest.append(models.BlobChunk(
+            number=number, chunk_hash=chunk_hash, size=chunk_size,
+            iv=None if iv is None else '%032x' % iv))
+        size += chunk_size
+
+    # The manifest hash covers the ciphertext of every chunk: a given content
+    # is described by a single Blob for a given user.
+    manifest_hash = hashlib.sha1('manifest\n' + '\n'.join(
+        chunk.chunk_hash for chunk in manifest)).hexdigest()
+    tabl = g.db_session.query(models.Blob)
+    if not tabl.filter(models.Blob.hash == manifest_hash).first():
+        for chunk in manifest:
+            chunk.blob_hash = manifest_hash
+        g.db_session.add_all(manifest)
+        g.db_session.add(models.Blob(hash=manifest_hash, size=size,
+                                     created=datetime.now()))
+    return manifest_hash
@@ -2,10 +2,35 @@
 
 """
 
+import itertools
+
 from flask import g
 
-from datastore.api import config, tools
-from datastore.models import Commit, Node, Tree, TreeLink
+from sqlalchemy import distinct, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import and_, or_
+
+from datastore.api import config, notification, tools
+from datastore.api.errors import *
+from datastore.models import (BlobLink, Change, Commit, Node, PathIndex,
+                              PathTrigram, Revision, Tree, TreeLink)
+
+
+# Maximum number of times a commit is attempted when concurrent commits are
+# stored in the meantime.
+commit_attempts = 5
+
+# Maximum number of paths looked up in the path index per query.
+index_batch_size = 500
+
+
+class ConcurrentCommitException(Exception):
+    """Raised when a commit can't be stored because another commit was stored
+    to the same storage node since it was started.
+    """
+    pass
 
 
 class MissingNodeException(Exception):
@@ -15,90 +40,320 @@ class MissingNodeException(Exception):
     pass
 
 
+def _ancestor_keys(path):
+    # The index keys of the directories above a path.
+    path_elements = tools.split_path(path)
+    return ['/'.join(path_elements[:index])
+            for index in range(1, len(path_elements))]
+
+
 def _as_tree_link(node, path=''):
     if type(node) is Tree:
         node = TreeLink(path=path, tree=node)
     return node
 
 
+def _get_head(root):
+    root_node = g.user.dbuser.nodes.get(root)
+    return root_node and root_node.head
+
+
 def _get_default_search_node(root):
     # If the search_node is unspecified, we start from the head of the user
     # which, if non existing, we use a dummy empty node.
-    root_node = g.user.dbuser.nodes.get(root)
-    return root_node.head.root if root_node and root_node.head else Tree()
+    head = _get_head(root)
+    return head.root if head else Tree()
+
+
+def _index_key(path):
+    return '/'.join(tools.split_path(path))
+
+
+def _lookup_index(root, path):
+    # The index holds every path of the head commit, so a missing entry means
+    # that the object doesn't exist.
+    node = g.user.dbuser.nodes[root]
+    entry = g.db_session.query(PathIndex).filter(
+        PathIndex.node_id == node.id,
+        PathIndex.path == _index_key(path)
+    ).first()
+    if not entry:
+        raise MissingNodeException()
+
+    # Same rules as for the tree walk: a trailing slash can only identify a
+    # directory, otherwise files have the priority.
+    if path.endswith('/'):
+        output = entry.tree_link
+    else:
+        output = entry.blob_link or entry.tree_link
+    if not output:
+        raise MissingNodeException()
+    return output
+
+
+def _make_trigrams(name):
+    return set(name[i:i + 3] for i in range(len(name) - 2))
+
+
+def _path_clause(column, key, obj):
+    # Select the entries of an object and, for a directory, of its descendants.
+    clause = column == key
+    if isinstance(obj, TreeLink):
+        clause = or_(clause, descendants_clause(column, key))
+    return clause
+
+
+def _reindex_children(root, path, tree):
+    # Point the index entries of the direct content of a directory to its
+    # links, without reindexing their own content.
+    links = {}
+    for link in tree.sub_trees.values() + tree.sub_files.values():
+        links.setdefault('/'.join([_index_key(path), link.path]), []) \
+             .append(link)
+    keys = sorted(links)
+    for index in range(0, len(keys), index_batch_size):
+        entries = g.db_session.query(PathIndex).filter(
+            PathIndex.node_id == g.user.dbuser.nodes[root].id,
+            PathIndex.path.in_(keys[index:index + index_batch_size]))
+        for entry in entries:
+            for link in links[entry.path]:
+                if isinstance(link, TreeLink):
+                    entry.tree_link = link
+                else:
+                    entry.blob_link = link
+
+
+def _reindex_link(root, path, link):
+    # Point the index entry of a directory to a new link, without reindexing
+    # its content.
+    entry = g.db_session.query(PathIndex).filter(
+        PathIndex.node_id == g.user.dbuser.nodes[root].id,
+        PathIndex.path == _index_key(path)
+    ).first()
+    if entry:
+        entry.tree_link = link
+
+
+def _restore_link(root, path, link):
+    # The content of a deleted directory is deleted along with it without
+    # being flagged, as it may be shared with other copies of the directory.
+    # Restoring the directory flags its direct content instead, in a new Tree.
+    tree, link.tree = link.tree, Tree(created=link.tree.created)
+    tree.copy_to(link.tree)
+    content = link.tree.sub_trees.values() + link.tree.sub_files.values()
+    for sub_link in content:
+        sub_link.is_deleted = True
+    link.is_deleted = False
+    _reindex_children(root, path, link.tree)
+    record_change(root, path)
+
+
+def _walk_links(path, obj):
+    # Yield the (path, link) pairs for an object and all of its descendants.
+    yield path, obj
+    if isinstance(obj, TreeLink):
+        for collection in (obj.tree.sub_trees, obj.tree.sub_files):
+            for sub_obj in collection.values():
+                sub_path = '/'.join([path, sub_obj.path])
+                for item in _walk_links(sub_path, sub_obj):
+                    yield item
+
+
+def _update_index(session, node, key, obj):
+    # Retrieve the existing entries for the path and, in the case of a
+    # directory, for all of its descendants: they are replaced by the content
+    # of the new directory (which we load at once).
+    clause = PathIndex.path == key
+    if isinstance(obj, TreeLink):
+        load_children([obj], session=session)
+        clause = or_(clause, descendants_clause(PathIndex.path, key))
+    existing = session.query(PathIndex).filter(PathIndex.node_id == node.id,
+                                               clause)
+    entries = dict((entry.path, entry) for entry in existing)
+    for entry in entries.values():
+        if entry.path != key:
+            entry.tree_link = entry.blob_link = None
+
+    for sub_path, link in _walk_links(key, obj):
+        entry = entries.get(sub_path)
+        if not entry:
+            entry = entries[sub_path] = PathIndex(node=node, path=sub_path)
+            entry.trigrams = [
+                PathTrigram(node_id=node.id, trigram=trigram)
+                for trigram in _make_trigrams(tools.last_element(sub_path))
+            ]
+        if isinstance(link, TreeLink):
+            entry.tree_link = link
+        else:
+            entry.blob_link = link
+        session.add(entry)
+
+    # Entries which don't point to anything anymore are simply dropped.
+    for entry in entries.values():
+        if not (entry.tree_link or entry.blob_link):
+            session.delete(entry)
+
+
+def _update_tree_hashes(session):
+    # Any directory which direct content was added or modified in the session
+    # gets its hash updated, including the newly created (empty) ones.
+    trees = set()
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, Tree):
+            trees.add(obj)
+        elif isinstance(obj, TreeLink):
+            trees.add(obj.parent)
+        elif isinstance(obj, BlobLink):
+            trees.add(obj.tree)
+    for tree in trees.difference([None]):
+        tree.update_hash()
+
+
+def below_deleted_dirs(root, paths):
+    """Return the paths of the head commit of a storage node, among the given
+    ones, which are below a deleted directory. The content of a deleted
+    directory isn't flagged itself, but is deleted along with it.
+
+    Args:
+        root: the storage node
+        paths: the full paths to check
+    """
+    node = g.user.dbuser.nodes[root]
+    keys = sorted(set(key for path in paths for key in _ancestor_keys(path)))
+    deleted = set()
+    for index in range(0, len(keys), index_batch_size):
+        batch = keys[index:index + index_batch_size]
+        query = g.db_session.query(PathIndex.path) \
+                            .join(TreeLink,
+                                  TreeLink.id == PathIndex.tree_link_id) \
+                            .filter(PathIndex.node_id == node.id,
+                                    PathIndex.path.in_(batch),
+                                    TreeLink.is_deleted == True)
+        deleted.update(key for key, in query)
+    return set(path for path in paths
+               if deleted.intersection(_ancestor_keys(path)))
 
 
 def copy_hierarchy(root, path, destination, source=None):
-    # If source node is not specifed, use latest logged user's head.
+    """Retrieve the parent directory of path in a new commit, in order to
+    modify it. When full history is enabled, the directories of the new commit
+    are copied on write: each directory of the path which is still shared with
+    the source commit gets a new Tree, holding links to the same content. Only
+    the modified path gets new rows, whereas the rest of the hierarchy is
+    shared by reference. Deleted directories of the path are restored, their
+    previous content remaining deleted.
+
+    Args:
+        root: the storage node
+        path: the path of the object to be modified
+        destination: the root Tree of the new commit
+        source: the root Tree of the commit it derives from (defaults to the
+            user's head)
+
+    Returns:
+        The Tree of the parent directory in the new commit.
+
+    Raises:
+        MissingNodeException if a directory of the path doesn't exist.
+    """
     if not source:
         r_node = g.user.dbuser.nodes.get(root)
         source = r_node.head.root
 
-    # Create current and reference nodes and successively clone as required. We
-    # try to preserve as much hierarchy as possible.
     path_elements = tools.split_path(path)
-    for directory in path_elements[:-1]:
-        # The impacted path is always composed of new tree objects. We don't
-        # create nodes which didn't exist previously (requires create_folder).
-        if not source or (directory not in source.sub_trees):
+    for index, directory in enumerate(path_elements[:-1]):
+        # We don't create nodes which didn't exist previously (requires
+        # create_folder).
+        link = destination.sub_trees.get(directory)
+        if not link:
             raise MissingNodeException()
 
-        if not config.enable_full_history:
-            destination = source.sub_trees[directory].tree
-        else:  # pragma: no cover
-            # Copy the previous node's content to a newly created one.
-            new_node = TreeLink(tree=Tree(), path=directory)
-            source.sub_trees[directory].tree.copy_to(new_node.tree)
-            destination.sub_trees[directory] = new_node
-            destination = new_node.tree
+        # Directories created as part of the new commit have no source, and
+        # directories which were already copied don't share it anymore.
+        source_link = source and source.sub_trees.get(directory)
+        source = source_link and source_link.tree
+        link_path = '/'.join(path_elements[:index + 1])
+        if link.is_deleted:
+            _restore_link(root, link_path, link)
+            _reindex_link(root, link_path, link)
+        elif config.enable_full_history and link.tree is source:
+            link.tree = Tree(created=source.created)
+            source.copy_to(link.tree)
+            _reindex_link(root, link_path, link)
+        destination = link.tree
+    return destination
 
-        # Move on to the next nodes.
-        source = source.sub_trees[directory].tree
 
-    # Return both the reference node and its new instance.
-    return source, destination
+def copy_revisions(root, from_path, to_path, obj):
+    """Replace the history of an object of a storage node by the one of the
+    object it was copied from. When the object is a directory, the history of
+    all of its descendants is copied as well.
+
+    Args:
+        root: the storage node
+        from_path: the full path of the original object
+        to_path: the full path of the copy
+        obj: the BlobLink or TreeLink of the copy
+    """
+    node = g.user.dbuser.nodes[root]
+    from_key, to_key = _index_key(from_path), _index_key(to_path)
+    clauses = [_path_clause(Revision.path, key, obj)
+               for key in (from_key, to_key)]
+    existing = g.db_session.query(Revision) \
+                           .filter(Revision.node_id == node.id, clauses[1])
+    existing.delete(synchronize_session=False)
+
+    # Revisions are copied in order, such that their ids keep ordering them.
+    query = g.db_session.query(Revision.path, Revision.blob_id) \
+                        .filter(Revision.node_id == node.id, clauses[0]) \
+                        .order_by(Revision.id)
+    for path, blob_id in query.all():
+        g.db_session.add(Revision(node=node, blob_id=blob_id,
+                                  path=to_key + path[len(from_key):]))
 
 
 def create_commit(root):
-    latest = g.db_session.query(Node).with_lockmode('update') \
+    # No lock is taken: the version of the node is checked when the commit is
+    # stored instead.
+    latest = g.db_session.query(Node) \
               .filter(Node.path==root, Node.owner_id==g.user.dbuser.id).first()
     if not latest or not latest.head:  # pragma: no cover
         raise MissingNodeException()
 
-    # Copy the previous node content if it existed.
+    # Copy the previous node content if it existed: the new root holds links
+    # to the same content (see copy_hierarchy).
     if not config.enable_full_history:
         commit = latest.head
-    else:  # pragma: no cover
+    else:
         commit = Commit(root=Tree(), parent=latest.head)
         if latest.head.root:
             latest.head.root.copy_to(commit.root)
     return commit
 
 
-def get_stored_object(root, path, search_node=None):
-    """Retrieve a database stored object.
-
-    Args:
-        root: the storage node
-        path: the storage path (down the provided root)
-        search_node: the starting point for the search (defaults to the user's
-            root if not provided)
-
-    Returns:
-        The requested node as a BlobLink, or a TreeLink for a directory.
-
-    Raises:
-        HTTP 404 if either the starting point for the search or the requested
-            node are not found.
+def descendants_clause(column, key):
+    """Return the clause matching the path keys below a given key. Prefixes
+    are compared exactly: LIKE would treat '_' and '%' as wildcards, and may
+    ignore case depending on the database.
     """
-    # Retrieve the search node (either as specified, or the user's head).
-    search_node = search_node or _get_default_search_node(root)
+    return func.substr(column, 1, len(key) + 1) == key + '/'
+
 
+def _get_stored_object(root, path, search_node=None):
     # Retrieving the root is a special case as the path is empty. However, the
     # root is a Tree rather than a TreeLink.
     path_elements = tools.split_path(path)
     if not path_elements:
-        return _as_tree_link(search_node)
+        return _as_tree_link(search_node or _get_default_search_node(root))
+
+    # Any lookup in the head commit goes through the path index. Other commits
+    # (i.e.: a new commit when full history is enabled) are walked.
+    head = _get_head(root)
+    if head and (search_node is None or search_node.id == head.root_id):
+        return _lookup_index(root, path)
+
+    # Retrieve the search node (either as specified, or the user's head).
+    search_node = search_node or _get_default_search_node(root)
 
     # Walk the user commit tree to find the requested path. We assume that any
     # part of the path but the last is necessarily a directory.
@@ -128,8 +383,315 @@ def get_stored_object(root, path, search_node=None):
     return output
 
 
-def store_commit(root, commit):
+def get_stored_object(root, path, search_node=None, depth=0):
+    """Retrieve a database stored object.
+
+    Args:
+        root: the storage node
+        path: the storage path (down the provided root)
+        search_node: the starting point for the search (defaults to the user's
+            root if not provided)
+        depth: the number of directory levels to load below the requested
+            node when it is a directory (0 to rely on lazy loading, None for
+            the whole hierarchy)
+
+    Returns:
+        The requested node as a BlobLink, or a TreeLink for a directory.
+
+    Raises:
+        HTTP 404 if either the starting point for the search or the requested
+            node are not found.
+    """
+    output = _get_stored_object(root, path, search_node)
+    if depth != 0 and isinstance(output, TreeLink):
+        load_children([output], depth)
+    return output
+
+
+def index_object(root, path, obj, descendants=True):
+    """Register an object to the path index of a storage node. When the object
+    is a directory, all of its descendants are (re)indexed as well.
+
+    Args:
+        root: the storage node
+        path: the full path of the object
+        obj: the BlobLink or TreeLink to register
+        descendants: whether to reindex the descendants of a directory, which
+            may be left out when its content is unchanged
+    """
+    if descendants or not isinstance(obj, TreeLink):
+        _update_index(g.db_session, g.user.dbuser.nodes[root],
+                      _index_key(path), obj)
+    else:
+        _reindex_link(root, path, obj)
+    record_change(root, path)
+
+
+def is_deleted(root, path, obj, search_node=None):
+    """Return whether an object retrieved by get_stored_object is deleted,
+    either flagged itself or below a deleted directory.
+
+    Args:
+        root: the storage node
+        path: the full path of the object
+        obj: the BlobLink or TreeLink of the object
+        search_node: the starting point of the search which found it
+    """
+    if obj.is_deleted:
+        return True
+
+    head = _get_head(root)
+    if head and (search_node is None or search_node.id == head.root_id):
+        return bool(below_deleted_dirs(root, [path]))
+
+    tree = search_node or _get_default_search_node(root)
+    for directory in tools.split_path(path)[:-1]:
+        link = tree.sub_trees[directory]
+        if link.is_deleted:
+            return True
+        tree = link.tree
+    return False
+
+
+def iter_children(tree, after=None, include_deleted=False, batch_size=1000):
+    """Iterate over the content of a directory in listing order: directories
+    and then files, each sorted by name. Links are retrieved by batches rather
+    than loading the whole directory at once.
+
+    Args:
+        tree: the Tree which content to iterate over
+        after: the position to start after, as yielded by a previous iteration
+        include_deleted: whether to include deleted objects
+        batch_size: the number of links to retrieve per query
+
+    Yields:
+        (position, link) pairs where position is a ('d' or 'f', name) pair.
+    """
+    kinds = (('d', TreeLink, TreeLink.parent_id),
+             ('f', BlobLink, BlobLink.parent_tree_id))
+    for kind, cls, column in kinds:
+        if after and kind < after[0]:
+            continue
+        start = after[1] if after and kind == after[0] else None
+        while True:
+            query = g.db_session.query(cls).filter(column == tree.id)
+            if start is not None:
+                query = query.filter(cls.path > start)
+            if not include_deleted:
+                query = query.filter(cls.is_deleted == False)
+            if cls is TreeLink:
+                query = query.options(joinedload('tree'))
+            links = query.order_by(cls.path).limit(batch_size).all()
+            for link in links:
+                yield (kind, link.path), link
+            if len(links) < batch_size:
+                break
+            start = links[-1].path
+
+
+def load_children(tree_links, depth=None, session=None):
+    """Load the content of directories down to the requested depth using one
+    batched query per level and per kind of object, rather than letting the
+    lazy loader issue one query per directory.
+
+    Args:
+        tree_links: the TreeLink objects which content should be loaded
+        depth: the number of levels to load (None for the whole hierarchy)
+        session: the database session (defaults to the request's one)
+    """
+    session = session or g.db_session
+    trees = dict((l.tree.id, l.tree) for l in tree_links if l.tree.id)
+
+    level = 0
+    while trees and (depth is None or level < depth):
+        # Collections which were previously loaded (and possibly modified) are
+        # left untouched, although we still descend into them.
+        for key, cls, column in (('sub_trees', TreeLink, TreeLink.parent_id),
+                                 ('sub_files', BlobLink,
+                                  BlobLink.parent_tree_id)):
+            ids = [i for i, t in trees.items() if key not in t.__dict__]
+            if not ids:
+                continue
+
+            query = session.query(cls).filter(column.in_(ids))
+            if cls is TreeLink:
+                query = query.options(joinedload('tree'))
+            content = dict((tree_id, []) for tree_id in ids)
+            for link in query:
+                content[getattr(link, column.key)].append(link)
+            for tree_id, links in content.items():
+                set_committed_value(trees[tree_id], key, links)
+
+        # Move on to the next level.
+        sub_trees = [l for t in trees.values() for l in t.sub_trees.values()]
+        trees = dict((l.tree.id, l.tree) for l in sub_trees if l.tree.id)
+        level += 1
+
+
+def rebuild_index(session, node):
+    """Rebuild the whole path index of a storage node from its head commit."""
+    for cls in (PathTrigram, PathIndex):
+        query = session.query(cls).filter(cls.node_id == node.id)
+        query.delete(synchronize_session=False)
+    if node.head and node.head.root:
+        root = node.head.root
+        load_children([_as_tree_link(root)], session=session)
+        for obj in root.sub_trees.values() + root.sub_files.values():
+            _update_index(session, node, obj.path, obj)
+
+
+def rebuild_revisions(session, node):
+    """Rebuild the history of the files of a storage node from the revisions
+    linked to the files of its head commit.
+    """
+    query = session.query(Revision).filter(Revision.node_id == node.id)
+    query.delete(synchronize_session=False)
+    if node.head and node.head.root:
+        root = node.head.root
+        load_children([_as_tree_link(root)], session=session)
+        for obj in root.sub_trees.values() + root.sub_files.values():
+            for path, link in _walk_links(obj.path, obj):
+                if not isinstance(link, BlobLink):
+                    continue
+                blobs = []
+                while link:
+                    blobs.append(link.blob)
+                    link = link.parent
+                for blob in reversed(blobs):
+                    session.add(Revision(node=node, path=path, blob=blob))
+
+
+def record_change(root, path):
+    """Record a change of the object at path (and of its descendants) to the
+    journal of a storage node. The record is committed along with the commit
+    which holds the change.
+
+    Args:
+        root: the storage node
+        path: the full path of the changed object
+    """
+    g.db_session.add(Change(node=g.user.dbuser.nodes[root],
+                            path=_index_key(path)))
+
+
+def record_revision(root, path, obj):
+    """Record a new revision of a file to the history of a storage node. The
+    record is committed along with the commit which holds the revision.
+
+    Args:
+        root: the storage node
+        path: the full path of the file
+        obj: the BlobLink holding the new content
+    """
+    g.db_session.add(Revision(node=g.user.dbuser.nodes[root],
+                              path=_index_key(path), blob=obj.blob))
+
+
+def revisions_clause(root, path):
+    """Return the clause selecting the revisions of the file at a given path of
+    a storage node, which are ordered by id.
+
+    Args:
+        root: the storage node
+        path: the full path of the file
+    """
+    return and_(Revision.node_id == g.user.dbuser.nodes[root].id,
+                Revision.path == _index_key(path))
+
+
+def run_commit(root, fn, *args):
+    """Apply a change to a new commit of a storage node and store it. The
+    change is applied again from the latest state of the storage node when a
+    concurrent commit was stored in the meantime, so it shouldn't have any side
+    effect outside of the database session.
+
+    Args:
+        root: the storage node
+        fn: the function applying the change, called as fn(tree, *args) where
+            tree is the root Tree of the new commit
+        args: additional arguments to fn
+
+    Returns:
+        The value returned by fn.
+
+    Raises:
+        HTTP 503 if the commit still conflicts after commit_attempts attempts.
+    """
+    # A concurrent commit adding the same path makes the insertion of its index
+    # entry fail, which may happen as the session is flushed before the
+    # compare-and-swap.
+    for _ in range(commit_attempts):
+        commit = create_commit(root)
+        version = g.user.dbuser.nodes[root].version
+        try:
+            output = fn(commit.root, *args)
+            store_commit(root, commit, version)
+        except (ConcurrentCommitException, IntegrityError):
+            g.db_session.rollback()
+            continue
+        return output
+    raise BasicError(503, E_CONCURRENT_COMMIT)
+
+
+def search_entries(root, path, query, batch_size=100):
+    """Yield the ids of the path index entries of a storage node which name
+    contains query (at least three characters long), below a given path,
+    ordered by path.
+
+    Candidates are the entries holding all of the query trigrams: they are
+    retrieved along with their path by pages of batch_size entries (following
+    the last path of the previous page), and checked against the actual query.
+    Pages are only queried as the ids are consumed.
+
+    Args:
+        root: the storage node
+        path: the path of the directory to search in
+        query: the string to search for
+        batch_size: the number of candidates to retrieve per query
+    """
+    node = g.user.dbuser.nodes[root]
+    trigrams = _make_trigrams(query)
+    matching = g.db_session.query(PathTrigram.entry_id) \
+                           .filter(PathTrigram.node_id == node.id,
+                                   PathTrigram.trigram.in_(trigrams)) \
+                           .group_by(PathTrigram.entry_id) \
+                           .having(func.count(distinct(PathTrigram.trigram)) ==
+                                   len(trigrams))
+    entries = g.db_session.query(PathIndex.id, PathIndex.path) \
+                          .filter(PathIndex.node_id == node.id,
+                                  PathIndex.id.in_(matching.subquery()))
+    key = _index_key(path)
+    if key:
+        entries = entries.filter(or_(PathIndex.path == key,
+                                     descendants_clause(PathIndex.path, key)))
+    entries = entries.order_by(PathIndex.path)
+
+    page = entries.limit(batch_size).all()
+    while page:
+        for id_, entry_path in page:
+            if query in tools.last_element(entry_path):
+                yield id_
+        if len(page) < batch_size:
+            break
+        page = entries.filter(PathIndex.path > page[-1][1]) \
+                      .limit(batch_size).all()
+
+
+def store_commit(root, commit, version):
     if root not in g.user.dbuser.nodes:  # pragma: no cover
         raise MissingNodeException()
-    g.user.dbuser.nodes[root].head = commit
+    node = g.user.dbuser.nodes[root]
+    node.head = commit
+    _update_tree_hashes(g.db_session)
+
+    # Compare-and-swap on the version of the node when the commit was started:
+    # the update only matches if no other commit was stored since.
+    swapped = g.db_session.query(Node) \
+                          .filter(Node.id == node.id,
+                                  Node.version == version) \
+                          .update({Node.version: Node.version + 1},
+                                  synchronize_session=False)
+    if not swapped:
+        raise ConcurrentCommitException()
     g.db_session.commit()
+    notification.publish(node.id)
@@ -16,10 +16,14 @@ def api_header(fn):
     @functools.wraps(fn)
     def wrapper(*args, **kwargs):
         result = fn(*args, **kwargs)
-        result['api-version'] = '.'.join(str(i) for i in config.api_version)
+        result['api-version'] = api_version()
         return result
     return wrapper
 
 
+def api_version():
+    return '.'.join(str(i) for i in config.api_version)
+
+
 def api_endpoint(fn):
     return as_json(api_header(fn))
@@ -0,0 +1,176 @@
+"""SHA1 hashing which state can be saved and restored later on, such that a
+single digest can be computed over data received across several requests.
+hashlib doesn't expose the state of its hash objects: the state is kept apart
+as the intermediate hash, the length of the data and its trailing partial
+block, and serialized in a versioned format which doesn't depend on the host.
+
+Data is hashed using OpenSSL's low-level SHA1 functions when libcrypto is
+available, and in pure Python otherwise (which is much slower).
+
+"""
+
+import ctypes
+import ctypes.util
+import struct
+
+
+# Serialized states start with a version marker, followed by the intermediate
+# hash and the length of the data (in bytes), and then the trailing partial
+# block.
+_STATE_MARKER = 'sha1:1:'
+_STATE_HEADER = struct.Struct('>5IQ')
+
+_INITIAL_HASH = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0)
+
+
+class InvalidStateError(ValueError):
+    """Raised when restoring a hash from a state which isn't valid, such as a
+    state saved by a previous version.
+    """
+    pass
+
+
+def _compress(h, block):
+    # The SHA1 compression function, applied to a single 64 bytes block.
+    w = list(struct.unpack('>16I', block))
+    for i in range(16, 80):
+        x = w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16]
+        w.append(((x << 1) | (x >> 31)) & 0xffffffff)
+
+    a, b, c, d, e = h
+    for i in range(80):
+        if i < 20:
+            f, k = (b & c) | (~b & d), 0x5a827999
+        elif i < 40:
+            f, k = b ^ c ^ d, 0x6ed9eba1
+        elif i < 60:
+            f, k = (b & c) | (b & d) | (c & d), 0x8f1bbcdc
+        else:
+            f, k = b ^ c ^ d, 0xca62c1d6
+        a, b, c, d, e = (
+            ((((a << 5) | (a >> 27)) & 0xffffffff) + f + e + k + w[i]) &
+            0xffffffff,
+            a, ((b << 30) | (b >> 2)) & 0xffffffff, c, d)
+    return tuple((x + y) & 0xffffffff for x, y in zip(h, (a, b, c, d, e)))
+
+
+class _PythonSHA1(object):
+
+    def __init__(self, h, length, tail):
+        self._h, self._length, self._tail = h, length, tail
+
+    def export(self):
+        return self._h, self._length, self._tail
+
+    def update(self, data):
+        self._length += len(data)
+        data = self._tail + data
+        blocks = len(data) - len(data) % 64
+        h = self._h
+        for index in range(0, blocks, 64):
+            h = _compress(h, data[index:index + 64])
+        self._h, self._tail = h, data[blocks:]
+
+
+class _SHA_CTX(ctypes.Structure):
+    _fields_ = [
+        ('h', ctypes.c_uint32 * 5),
+        ('Nl', ctypes.c_uint32),
+        ('Nh', ctypes.c_uint32),
+        ('data', ctypes.c_uint32 * 16),
+        ('num', ctypes.c_uint),
+    ]
+
+
+class _OpenSSLSHA1(object):
+    # Only the update is done by OpenSSL: the context is converted from and to
+    # the portable state, where the length is counted in bits (Nl and Nh) and
+    # the trailing partial block is held in data.
+
+    def __init__(self, h, length, tail):
+        self._ctx = _SHA_CTX()
+        self._ctx.h[:] = h
+        bits = length * 8
+        self._ctx.Nl, self._ctx.Nh = bits & 0xffffffff, bits >> 32
+        ctypes.memmove(self._ctx.data, tail, len(tail))
+        self._ctx.num = len(tail)
+
+    def export(self):
+        length = ((self._ctx.Nh << 32) | self._ctx.Nl) // 8
+        tail = ctypes.string_at(self._ctx.data, self._ctx.num)
+        return tuple(self._ctx.h), length, tail
+
+    def update(self, data):
+        _libcrypto.SHA1_Update(self._ctx, data, len(data))
+
+
+def _load_libcrypto():
+    # The low-level functions are deprecated, and may be missing from OpenSSL
+    # builds without deprecated APIs.
+    name = ctypes.util.find_library('crypto')
+    if not name:  # pragma: no cover
+        return None
+    try:
+        libcrypto = ctypes.CDLL(name)
+        libcrypto.SHA1_Update.argtypes = [ctypes.POINTER(_SHA_CTX),
+                                          ctypes.c_char_p, ctypes.c_size_t]
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+    return libcrypto
+
+
+_libcrypto = _load_libcrypto()
+_SHA1 = _OpenSSLSHA1 if _libcrypto else _PythonSHA1
+
+
+def _load_state(state):
+    state = str(state)
+    header_end = len(_STATE_MARKER) + _STATE_HEADER.size
+    if not state.startswith(_STATE_MARKER) or len(state) < header_end:
+        raise InvalidStateError('Unknown SHA1 state format')
+    values = _STATE_HEADER.unpack(state[len(_STATE_MARKER):header_end])
+    h, length, tail = values[:5], values[5], state[header_end:]
+    if len(tail) != length % 64:
+        raise InvalidStateError('Inconsistent SHA1 state')
+    return h, length, tail
+
+
+class ResumableSHA1(object):
+    """A hashlib-like SHA1 hash object, optionally created from the state of
+    a previous one.
+
+    Raises:
+        InvalidStateError if the state can't be restored.
+    """
+
+    digest_size = 20
+    block_size = 64
+
+    def __init__(self, state=None):
+        if state is None:
+            self._sha1 = _SHA1(_INITIAL_HASH, 0, '')
+        else:
+            self._sha1 = _SHA1(*_load_state(state))
+
+    @property
+    def state(self):
+        h, length, tail = self._sha1.export()
+        return _STATE_MARKER + _STATE_HEADER.pack(*(h + (length,))) + tail
+
+    def update(self, data):
+        self._sha1.update(str(data))  # The stream helpers may hash buffers
+
+    def copy(self):
+        return ResumableSHA1(self.state)
+
+    def digest(self):
+        # The padding is hashed separately, leaving this object unchanged.
+        h, length, tail = self._sha1.export()
+        padding = '\x80' + '\x00' * ((55 - length) % 64)
+        data = tail + padding + struct.pack('>Q', length * 8)
+        for index in range(0, len(data), 64):
+            h = _compress(h, data[index:index + 64])
+        return struct.pack('>5I', *h)
+
+    def hexdigest(self):
+        return self.digest().encode('hex')
@@ -0,0 +1,303 @@
+"""Read-only snapshots of the directories of the head commit.
+
+Read endpoints resolve paths, list directories and search from compact
+snapshots of the directories rather than from ORM objects. A snapshot holds the
+attributes of a directory and of its direct content, and is loaded using a
+single core query. Snapshots quack like the models they stand for (Tree,
+TreeLink and BlobLink) as far as the metadata is concerned.
+
+Snapshots are cached by (commit, version, tree): the head commit is updated in
+place unless full history is enabled, whereas the version of the storage node
+changes with each commit. They are kept deserialized in a process-local LRU
+cache, in front of a tier shared between processes (see api.tree_cache).
+
+"""
+
+import cPickle
+import hashlib
+import itertools
+
+from flask import g
+
+from sqlalchemy.sql.expression import (exists, join, literal, null, outerjoin,
+                                       select, type_coerce, union_all)
+
+from datastore.api import config, tools, tree_cache
+from datastore.api.helpers import database
+from datastore import models
+
+
+# Number of directory snapshots kept deserialized by each process.
+lru_size = (getattr(config, 'tree_cache', None) or {}).get('lru_size', 1000)
+
+
+class BlobLinkSnapshot(object):
+    """Snapshot of a file, along with the attributes of its blob."""
+
+    __slots__ = ('id', 'path', 'is_deleted', 'hash', 'iv', 'size', 'created',
+                 'chunked')
+
+    def __init__(self, id_, path, is_deleted, hash_, iv, size, created,
+                 chunked):
+        self.id = id_
+        self.path = path
+        self.is_deleted = is_deleted
+        self.hash = hash_
+        self.iv = iv
+        self.size = size
+        self.created = created
+        self.chunked = chunked
+
+    @property
+    def chunks(self):
+        # The manifest of chunked blobs is only needed to download them.
+        if not self.chunked:
+            return []
+        query = g.db_session.query(models.BlobChunk) \
+                            .filter(models.BlobChunk.blob_hash == self.hash)
+        return query.order_by(models.BlobChunk.number).all()
+
+
+class TreeLinkSnapshot(object):
+    """Snapshot of a directory entry. Unless it was retrieved on its own, its
+    tree only holds the attributes of the directory and not its content.
+    """
+
+    __slots__ = ('path', 'is_deleted', 'tree')
+
+    def __init__(self, path, is_deleted, tree):
+        self.path = path
+        self.is_deleted = is_deleted
+        self.tree = tree
+
+
+class TreeSnapshot(object):
+    """Snapshot of a directory: sub_trees and sub_files map the names of its
+    content to TreeLinkSnapshot and BlobLinkSnapshot objects, or are None for
+    directories which content was not loaded.
+    """
+
+    __slots__ = ('id', 'created', 'hash', 'sub_trees', 'sub_files')
+
+    def __init__(self, id_, created, hash_, sub_trees=None, sub_files=None):
+        self.id = id_
+        self.created = created
+        self.hash = hash_
+        self.sub_trees = sub_trees
+        self.sub_files = sub_files
+
+
+lru = tools.LRUCache(lru_size)
+
+
+def _as_deleted(obj):
+    # The content of a deleted directory is deleted along with it, although
+    # its links are only flagged when the directory is restored: snapshots
+    # below a deleted directory are returned as deleted copies. The listing
+    # hash of a deleted directory differs from the one of its live copies.
+    if isinstance(obj, BlobLinkSnapshot):
+        return BlobLinkSnapshot(obj.id, obj.path, True, obj.hash, obj.iv,
+                                obj.size, obj.created, obj.chunked)
+    tree = obj.tree
+    if tree.sub_trees is not None:
+        sub_trees = dict((name, _as_deleted(link))
+                         for name, link in tree.sub_trees.items())
+        sub_files = dict((name, _as_deleted(link))
+                         for name, link in tree.sub_files.items())
+        hash_ = hashlib.sha1('deleted:%s' % tree.hash).hexdigest()
+        tree = TreeSnapshot(tree.id, tree.created, hash_, sub_trees,
+                            sub_files)
+    return TreeLinkSnapshot(obj.path, True, tree)
+
+
+# Kinds of the rows returned by _load_tree.
+_FILE, _DIR, _SELF = range(3)
+
+
+def _blob_columns():
+    # The columns of a file snapshot which are attributes of its blob.
+    Blob = models.Blob
+    chunked = exists().where(models.BlobChunk.blob_hash == Blob.hash)
+    return [Blob.hash, Blob.iv, Blob.size, Blob.created,
+            chunked.label('chunked')]
+
+
+def _file_columns():
+    # The columns of a file snapshot, in the order of BlobLinkSnapshot.
+    BlobLink = models.BlobLink
+    return [BlobLink.id, BlobLink.path, BlobLink.is_deleted] + _blob_columns()
+
+
+def _load_tree(tree_id):
+    # The directory and its direct content are loaded using a single query,
+    # which rows share the columns of a file snapshot followed by the id of a
+    # tree. The files come first so that their column types apply to all rows.
+    Blob, BlobLink = models.Blob, models.BlobLink
+    Tree, TreeLink = models.Tree, models.TreeLink
+    nothing = lambda column: type_coerce(null(), column.type)
+
+    files = select([literal(_FILE)] + _file_columns() +
+                   [nothing(Tree.id)]) \
+        .select_from(join(BlobLink, Blob, Blob.id == BlobLink.blob_id)) \
+        .where(BlobLink.parent_tree_id == tree_id)
+    tree_columns = [nothing(Blob.iv), nothing(Blob.size), Tree.created,
+                    null(), Tree.id]
+    dirs = select([literal(_DIR), nothing(BlobLink.id), TreeLink.path,
+                   TreeLink.is_deleted, Tree.hash] + tree_columns) \
+        .select_from(join(TreeLink, Tree, Tree.id == TreeLink.tree_id)) \
+        .where(TreeLink.parent_id == tree_id)
+    self_ = select([literal(_SELF), nothing(BlobLink.id),
+                    nothing(TreeLink.path), nothing(TreeLink.is_deleted),
+                    Tree.hash] + tree_columns) \
+        .where(Tree.id == tree_id)
+
+    output, sub_trees, sub_files = None, {}, {}
+    for row in g.db_session.execute(union_all(files, dirs, self_)):
+        kind, row = row[0], tuple(row[1:])
+        if kind == _FILE:
+            sub_files[row[1]] = BlobLinkSnapshot(*row[:-1])
+        else:
+            tree = TreeSnapshot(row[-1], row[6], row[3])
+            if kind == _DIR:
+                sub_trees[row[1]] = TreeLinkSnapshot(row[1], row[2], tree)
+            else:
+                output = tree
+
+    # Directories which predate the stored hash get it computed.
+    if output.hash is None:
+        output.hash = g.db_session.query(Tree).get(tree_id).compute_hash()
+    output.sub_trees, output.sub_files = sub_trees, sub_files
+    return output
+
+
+def get_tree(root, tree_id):
+    """Return the snapshot of a directory of the head commit of a storage
+    node, from the cache or from the database.
+    """
+    node = g.user.dbuser.nodes[root]
+    key = 'tree:%d:%d:%d' % (node.head_id, node.version, tree_id)
+    tree = lru.get(key)
+    if tree is None:
+        value = tree_cache.get(key)
+        if value is not None:
+            tree = cPickle.loads(value)
+        else:
+            tree = _load_tree(tree_id)
+            tree_cache.set(key, cPickle.dumps(tree, cPickle.HIGHEST_PROTOCOL))
+        lru.set(key, tree)
+    return tree
+
+
+def get_stored_object(root, path):
+    """Retrieve the snapshot of an object of the head commit, following the
+    same rules as database.get_stored_object. Directories are returned along
+    with their content.
+
+    Raises:
+        database.MissingNodeException if the object is not found.
+    """
+    tree = get_tree(root, g.user.dbuser.nodes[root].head.root_id)
+    path_elements = tools.split_path(path)
+    if not path_elements:
+        return TreeLinkSnapshot('', False, tree)
+
+    deleted = False
+    for directory in path_elements[:-1]:
+        if directory not in tree.sub_trees:
+            raise database.MissingNodeException()
+        deleted = deleted or tree.sub_trees[directory].is_deleted
+        tree = get_tree(root, tree.sub_trees[directory].tree.id)
+
+    # A trailing slash can only identify a directory, otherwise files have the
+    # priority.
+    path_end = path_elements[-1].rstrip('/')
+    if path.endswith('/'):
+        output = tree.sub_trees.get(path_end)
+    else:
+        output = tree.sub_files.get(path_end) or tree.sub_trees.get(path_end)
+    if not output:
+        raise database.MissingNodeException()
+
+    if isinstance(output, TreeLinkSnapshot):
+        output = TreeLinkSnapshot(output.path, output.is_deleted,
+                                  get_tree(root, output.tree.id))
+    if deleted or (output.is_deleted and
+                   isinstance(output, TreeLinkSnapshot)):
+        output = _as_deleted(output)
+    return output
+
+
+def get_revisions(root, path, link, offset, limit):
+    """Return the snapshots of the revisions of a file, most recent first, as
+    recorded in its history. Only the latest revision shares the deleted flag
+    of the file.
+
+    Args:
+        root: the storage node
+        path: the full path of the file
+        link: the snapshot of the file
+        offset: the number of revisions to skip
+        limit: the maximum number of revisions to return
+    """
+    Blob, Revision = models.Blob, models.Revision
+    query = select([Revision.id] + _blob_columns()) \
+        .select_from(join(Revision, Blob, Blob.id == Revision.blob_id)) \
+        .where(database.revisions_clause(root, path)) \
+        .order_by(Revision.id.desc()).offset(offset).limit(limit)
+    return [BlobLinkSnapshot(row[0], link.path,
+                             link.is_deleted and not (offset or index),
+                             *row[1:])
+            for index, row in enumerate(g.db_session.execute(query))]
+
+
+def search_index(root, path, query, include_deleted=False, batch_size=100):
+    """Search the path index of a storage node for the objects which name
+    contains query (at least three characters long), below a given path.
+
+    The matching entries are found by pages (see database.search_entries),
+    and retrieved by batches along with the attributes of their objects: no
+    more entries are searched than the consumer of the results takes.
+
+    Args:
+        root: the storage node
+        path: the path of the directory to search in
+        query: the string to search for
+        include_deleted: whether to include deleted objects
+        batch_size: the number of entries to retrieve per query
+
+    Yields:
+        (path, snapshot) pairs ordered by path. Directories are returned
+        without their content.
+    """
+    Blob, BlobLink, PathIndex = models.Blob, models.BlobLink, models.PathIndex
+    Tree, TreeLink = models.Tree, models.TreeLink
+    entries = outerjoin(PathIndex, TreeLink,
+                        TreeLink.id == PathIndex.tree_link_id) \
+        .outerjoin(Tree, Tree.id == TreeLink.tree_id) \
+        .outerjoin(BlobLink, BlobLink.id == PathIndex.blob_link_id) \
+        .outerjoin(Blob, Blob.id == BlobLink.blob_id)
+    columns = [PathIndex.path, TreeLink.path, TreeLink.is_deleted, Tree.id,
+               Tree.created, Tree.hash] + _file_columns()
+    ids = database.search_entries(root, path, query, batch_size)
+
+    while True:
+        batch_ids = list(itertools.islice(ids, batch_size))
+        if not batch_ids:
+            break
+        batch = select(columns).select_from(entries) \
+            .where(PathIndex.id.in_(batch_ids)) \
+            .order_by(PathIndex.path)
+        rows = g.db_session.execute(batch).fetchall()
+        deleted = database.below_deleted_dirs(root, [row[0] for row in rows])
+        for row in rows:
+            links = []
+            if row[3] is not None:
+                links.append(TreeLinkSnapshot(row[1], row[2],
+                                              TreeSnapshot(*row[3:6])))
+            if row[6] is not None:
+                links.append(BlobLinkSnapshot(*row[6:]))
+            if row[0] in deleted:
+                links = [_as_deleted(link) for link in links]
+            for link in links:
+                if include_deleted or not link.is_deleted:
+                    yield row[0], link
@@ -3,39 +3,145 @@ import struct
 
 from flask import request
 
-from Crypto.Cipher import AES
 from Crypto import Random
-from Crypto.Util import Counter
+
+from datastore.api import cipher
+
+
+def readinto(stream, buf):
+    """Read up to len(buf) bytes from stream into the buf bytearray, and return
+    the number of bytes read. Streams which don't implement readinto (e.g. the
+    WSGI input) are read and copied.
+    """
+    if hasattr(stream, 'readinto'):
+        return stream.readinto(buf)
+    rv = stream.read(len(buf))
+    buf[:len(rv)] = rv
+    return len(rv)
 
 
 class ChecksumCalcStream(object):
 
-    def __init__(self, stream):
+    def __init__(self, stream, hasher=None):
         self._stream = stream
-        self.hash = hashlib.sha1()
+        self.hash = hasher or hashlib.sha1()
 
     def read(self, *args, **kwargs):
         rv = self._stream.read(*args, **kwargs)
         self.hash.update(rv)
         return rv
 
+    def readinto(self, buf):
+        count = readinto(self._stream, buf)
+        self.hash.update(buffer(buf, 0, count))
+        return count
+
     def readline(self, *args, **kwargs):  # pragma: no cover
         rv = self._stream.readline(*args, **kwargs)
         self.hash.update(rv)
         return rv
 
 
+class ConcatenatedStream(object):
+
+    def __init__(self, streams):
+        # Streams are pulled from the iterable as the previous one is exhausted,
+        # such that they may be opened lazily.
+        self._streams = iter(streams)
+        self._current = next(self._streams, None)
+
+    def _next_stream(self):
+        self._current.close()
+        self._current = next(self._streams, None)
+
+    def read(self, size=-1):
+        chunks = []
+        while self._current and size != 0:
+            rv = self._current.read(size)
+            if not rv or size < 0:
+                self._next_stream()
+            if rv and size > 0:
+                size -= len(rv)
+            chunks.append(rv)
+        return ''.join(chunks)
+
+    def readinto(self, buf):
+        # Reads never span several streams: a short read is returned instead.
+        while self._current:
+            count = readinto(self._current, buf)
+            if count:
+                return count
+            self._next_stream()
+        return 0
+
+    def readline(self, *args, **kwargs):  # pragma: no cover
+        while self._current:
+            rv = self._current.readline(*args, **kwargs)
+            if rv:
+                return rv
+            self._next_stream()
+        return ''
+
+    def close(self):
+        # Streams which were not pulled from the iterable are left untouched.
+        if self._current:
+            self._current.close()
+        self._current, self._streams = None, iter(())
+
+
+class LimitedStream(object):
+    """Reads up to limit bytes from stream. Unlike werkzeug's LimitedStream,
+    which guards request.stream, it supports readinto such that the streams
+    decorating the request input (see install_stream) can process it in place.
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._remaining = limit
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        rv = self._stream.read(size) if size else ''
+        self._remaining -= len(rv)
+        return rv
+
+    def readinto(self, buf):
+        # The end of the input is read on its own, so as not to read past it.
+        if len(buf) > self._remaining:
+            rv = self.read(len(buf))
+            buf[:len(rv)] = rv
+            return len(rv)
+        count = readinto(self._stream, buf)
+        self._remaining -= count
+        return count
+
+
 class AESDecryptionStream(object):
 
-    def __init__(self, stream, key, iv):
-        self._countr = Counter.new(128, initial_value=iv)
-        self._cipher = AES.new(key, AES.MODE_CTR, counter=self._countr)
+    def __init__(self, stream, key, iv, offset=0):
+        # CTR mode allows to start decrypting anywhere in the stream: we seek
+        # to the beginning of the block holding the requested offset, advance
+        # the counter accordingly, and drop the leading bytes of the block.
+        block, skip = divmod(offset, cipher.block_size)
+        self._cipher = cipher.new_ctr(key, iv + block)
         self._stream = stream
+        if offset:
+            self._stream.seek(block * cipher.block_size)
+            self.read(skip)
+
+    def close(self):
+        self._stream.close()
 
     def read(self, *args, **kwargs):
         rv = self._stream.read(*args, **kwargs)
         return self._cipher.decrypt(rv)
 
+    def readinto(self, buf):
+        count = readinto(self._stream, buf)
+        buf[:count] = self._cipher.decrypt(buffer(buf, 0, count))
+        return count
+
     def readline(self, *args, **kwargs):  # pragma: no cover
         rv = self._stream.readline(*args, **kwargs)
         return self._cipher.decrypt(rv)
@@ -43,27 +149,47 @@ class AESDecryptionStream(object):
 
 class AESEncryptionStream(object):
 
-    def __init__(self, stream, key):
-        self.IV = self._generate_IV()
-        self._countr = Counter.new(128, initial_value=self.IV)
-        self._cipher = AES.new(key, AES.MODE_CTR, counter=self._countr)
+    def __init__(self, stream, key, iv=None, offset=0):
+        # Just like for decryption, CTR mode allows to resume encrypting at any
+        # offset of a stream given its IV: we advance the counter to the block
+        # holding the offset, and consume the leading bytes of its keystream.
+        block, skip = divmod(offset, cipher.block_size)
+        self.IV = self.generate_IV() if iv is None else iv
+        self._cipher = cipher.new_ctr(key, self.IV + block)
+        self._cipher.encrypt(b'\0' * skip)
         self._stream = stream
 
     def read(self, *args, **kwargs):
         rv = self._stream.read(*args, **kwargs)
         return self._cipher.encrypt(rv)
 
+    def readinto(self, buf):
+        count = readinto(self._stream, buf)
+        buf[:count] = self._cipher.encrypt(buffer(buf, 0, count))
+        return count
+
     def readline(self, *args, **kwargs):  # pragma: no cover
         rv = self._stream.readline(*args, **kwargs)
         return self._cipher.encrypt(rv)
 
     @staticmethod
-    def _generate_IV():
+    def generate_IV():
         randstr = Random.new().read(4)
         return struct.unpack("i", randstr)[0]
 
 def install_stream(decorator, *args, **kwargs):
-    env = request.environ
-    stream = decorator(env['wsgi.input'], *args, **kwargs)
-    env['wsgi.input'] = stream
+    """Decorate the request input, as returned by request_stream."""
+    stream = decorator(request_stream(), *args, **kwargs)
+    request.environ['datastore.input'] = stream
     return stream
+
+
+def request_stream():
+    """Return the request input, bounded by the request content length, along
+    with the decorators installed on it.
+    """
+    env = request.environ
+    if 'datastore.input' not in env:
+        env['datastore.input'] = LimitedStream(env['wsgi.input'],
+                                               request.content_length or 0)
+    return env['datastore.input']
@@ -0,0 +1,93 @@
+"""Paginated and streamed JSON responses.
+
+Listings are paginated using opaque cursors, which encode the position of the
+last returned entry. They may also be streamed: entries are serialized as they
+are produced, rather than building the whole response in memory.
+
+"""
+
+import base64
+import json
+
+from flask import Response, stream_with_context
+
+from datastore.api.errors import *
+
+
+class Page(object):
+    """Iterates over at most limit items of an iterable of (position, item)
+    pairs. Once exhausted, cursor identifies the position of the last item if
+    more items follow, and is None otherwise.
+    """
+
+    def __init__(self, items, limit=None):
+        self._items = items
+        self._limit = limit
+        self.cursor = None
+        self.has_more = False
+
+    def __iter__(self):
+        position = None
+        for index, (item_position, item) in enumerate(self._items):
+            if index == self._limit:
+                self.cursor = encode_cursor(position)
+                self.has_more = True
+                break
+            position = item_position
+            yield item
+
+
+def _iter_list(items):
+    yield '['
+    for index, item in enumerate(items):
+        yield (', ' if index else '') + json.dumps(item)
+    yield ']'
+
+
+def _iter_object(obj, key, items, trailer):
+    # The object is serialized up to its closing brace, followed by the list
+    # and by the trailing keys, which may depend on the listed items.
+    yield json.dumps(obj)[:-1] + (', ' if obj else '') + json.dumps(key) + ': '
+    for chunk in _iter_list(items):
+        yield chunk
+    trailing = trailer() if trailer else {}
+    yield (', ' + json.dumps(trailing)[1:]) if trailing else '}'
+
+
+def decode_cursor(cursor):
+    """Return the position encoded by a cursor, or raise a 400."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise BasicError(400, E_INVALID_CURSOR(cursor))
+
+
+def encode_cursor(position):
+    """Return the cursor for a JSON serializable position."""
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+
+def get_offset(args):
+    """Return the offset encoded by the cursor argument of list endpoints which
+    are paginated by offset, or 0.
+    """
+    cursor = args.get('cursor')
+    offset = decode_cursor(cursor) if cursor else 0
+    if not isinstance(offset, int) or offset < 0:
+        raise BasicError(400, E_INVALID_CURSOR(cursor))
+    return offset
+
+
+def list_response(items, headers=None):
+    """Return a response streaming items as a JSON list."""
+    return Response(stream_with_context(_iter_list(items)), headers=headers,
+                    mimetype='application/json')
+
+
+def object_response(obj, key, items, trailer=None):
+    """Return a response streaming obj as a JSON object, which key entry is the
+    list of items. The keys returned by trailer are added once the list is
+    complete.
+    """
+    chunks = _iter_object(obj, key, items, trailer)
+    return Response(stream_with_context(chunks), mimetype='application/json')
@@ -0,0 +1,238 @@
+"""Maintenance commands, meant to be run from the command line or from a cron
+job using the same configuration file as the API:
+
+    python -m datastore.api.manage <command>
+
+"""
+
+import argparse
+from datetime import datetime
+import os
+import time
+
+from datastore.api import config, file_store, Session
+from datastore.api.files import put
+from datastore.api.helpers import database
+from datastore import models
+
+
+def backfill_blob_stats(session, args):
+    """Record the size and creation date of blobs which don't have them."""
+    last_id = 0
+    while True:
+        query = session.query(models.Blob).filter(models.Blob.size == None,
+                                                  models.Blob.id > last_id)
+        blobs = query.order_by(models.Blob.id).limit(args.batch_size).all()
+        if not blobs:
+            break
+
+        # Blobs don't know which storage node they belong to, so we try each
+        # of them in turn.
+        for blob in blobs:
+            for root in config.storage_nodes:
+                put.update_blob_stats(root, None, blob)
+                if blob.size is not None:
+                    break
+        session.commit()
+        last_id = blobs[-1].id
+
+
+def _blob_age(root, content_hash):
+    file_date, _ = file_store.stat_blob(root, None, content_hash)
+    if file_date is None:
+        return None
+    if isinstance(file_date, datetime):
+        # timedelta.total_seconds() is missing from Python 2.6.
+        delta = datetime.now() - file_date
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+    return time.time() - file_date
+
+
+def _collect_blobs(session, root, hashes, min_age):
+    # Blobs are reachable as long as a BlobLink refers to them, which covers
+    # every revision of every file (deleted or not) in any storage node. Files
+    # which were recently written may belong to an upload which has not been
+    # committed yet: they are spared. The chunks of blobs stored as chunks are
+    # reachable through their manifest.
+    query = session.query(models.Blob.hash).join(models.BlobLink) \
+                   .filter(models.Blob.hash.in_(hashes))
+    reachable = set(hash_ for hash_, in query)
+    query = session.query(models.BlobChunk.chunk_hash) \
+                   .join(models.Blob,
+                         models.Blob.hash == models.BlobChunk.blob_hash) \
+                   .join(models.BlobLink,
+                         models.BlobLink.blob_id == models.Blob.id) \
+                   .filter(models.BlobChunk.chunk_hash.in_(hashes))
+    reachable.update(hash_ for hash_, in query)
+    orphans = [hash_ for hash_ in hashes
+               if hash_ not in reachable and _blob_age(root, hash_) >= min_age]
+
+    # The Blob rows of orphaned files are removed along with them, such that
+    # they can't be reused as duplicates.
+    for hash_ in orphans:
+        file_store.remove_blob(root, hash_)
+    if orphans:
+        session.query(models.Blob).filter(models.Blob.hash.in_(orphans)) \
+               .delete(synchronize_session=False)
+        session.commit()
+
+
+def collect_uncommitted_blobs(session, args):
+    """Remove the stored files which no file revision refers to."""
+    # Every revision of every file is kept, deleted or not, as they are all
+    # listed by /revisions (and by the previous commits with full history).
+    # The files reclaimed here are those of uploads which were never committed
+    # (failed commits, aborted transfers or unused duplicates).
+    prefixes = ['%02x' % index for index in range(256)]
+    prefixes = [prefix for prefix in prefixes if prefix >= args.prefix]
+
+    # Blobs are examined by batches, one storage directory after the other,
+    # such that the process can be throttled and resumed from a given prefix.
+    for prefix in prefixes:
+        for root in config.storage_nodes:
+            hashes = file_store.list_blobs(root, prefix)
+            for index in range(0, len(hashes), args.batch_size):
+                batch = hashes[index:index + args.batch_size]
+                _collect_blobs(session, root, batch, args.min_age)
+                if args.rate:
+                    time.sleep(len(batch) / float(args.rate))
+
+    # Remove the temporary files left behind by failed uploads.
+    file_store.purge_temp_files(time.time() - args.min_age)
+
+
+def compact_packs(session, args):
+    """Reclaim the space of removed blobs in pack files (pack backend)."""
+    if hasattr(file_store, 'compact_packs'):
+        file_store.compact_packs(args.min_dead_ratio, args.grace_period)
+
+
+def purge_cache(session, args):
+    """Remove the decrypted files of the offload cache unused for a while."""
+    # The cache holds plaintext: it must be purged regularly for the files
+    # not to remain decrypted on disk (see files.get._cache_decrypted_blob).
+    offload = config.storage.get('offload') or {}
+    if not offload.get('cache_root'):
+        return
+    max_mtime = time.time() - args.max_age
+    for dirpath, _, filenames in os.walk(offload['cache_root']):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                if os.stat(filepath).st_mtime < max_mtime:
+                    os.remove(filepath)
+            except OSError:  # pragma: no cover
+                pass  # The file was removed in the meantime
+
+
+def rebuild_path_index(session, args):
+    """Rebuild the path index of every storage node of every user."""
+    for node in session.query(models.Node):
+        database.rebuild_index(session, node)
+    session.commit()
+
+
+def rebuild_revisions(session, args):
+    """Rebuild the history of the files of every storage node of every user."""
+    for node in session.query(models.Node):
+        database.rebuild_revisions(session, node)
+    session.commit()
+
+
+def _sweep_expired_links(session, batch_size):
+    clause = models.BlobRef.expires < datetime.utcnow()
+    while True:
+        query = session.query(models.BlobRef.id).filter(clause)
+        ids = [id_ for id_, in query.limit(batch_size)]
+        if not ids:
+            break
+        # The links may have been renewed since they were selected.
+        session.query(models.BlobRef).filter(models.BlobRef.id.in_(ids)) \
+               .filter(clause).delete(synchronize_session=False)
+        session.commit()
+
+
+def _sweep_expired_uploads(session, batch_size):
+    clause = models.ChunkedUpload.expires < datetime.utcnow()
+    while True:
+        query = session.query(models.ChunkedUpload).filter(clause)
+        uploads = query.limit(batch_size).all()
+        if not uploads:
+            break
+
+        # Files are removed first: should anything fail, the database rows
+        # remain and the upload will be swept again.
+        for upload in uploads:
+            parts = [part.number for part in upload.parts]
+            file_store.remove_chunked_upload(upload.upload_id or '', parts)
+        for upload in uploads:
+            session.delete(upload)
+        session.commit()
+
+
+def sweep_expired(session, args):
+    """Remove expired share links and chunked uploads."""
+    _sweep_expired_links(session, args.batch_size)
+    _sweep_expired_uploads(session, args.batch_size)
+
+
+def parse_arguments():  # pragma: no cover
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    subparser = subparsers.add_parser('backfill_blob_stats',
+                                      help=backfill_blob_stats.__doc__)
+    subparser.add_argument('--batch-size', default=1000, type=int)
+    subparser.set_defaults(command=backfill_blob_stats)
+
+    subparser = subparsers.add_parser('collect_uncommitted_blobs',
+                                      help=collect_uncommitted_blobs.__doc__)
+    subparser.add_argument('--batch-size', default=500, type=int)
+    subparser.add_argument('--min-age', default=3600, type=int,
+                           help='Minimum age of the removed files (seconds)')
+    subparser.add_argument('--prefix', default='00',
+                           help='Hash prefix to start from')
+    subparser.add_argument('--rate', default=1000, type=int,
+                           help='Maximum files examined per second (0: none)')
+    subparser.set_defaults(command=collect_uncommitted_blobs)
+
+    subparser = subparsers.add_parser('compact_packs',
+                                      help=compact_packs.__doc__)
+    subparser.add_argument('--min-dead-ratio', default=0.5, type=float,
+                           help='Minimum ratio of dead space of a pack')
+    subparser.add_argument('--grace-period', default=600, type=int,
+                           help='Time before a rewritten pack is removed '
+                                '(seconds)')
+    subparser.set_defaults(command=compact_packs)
+
+    subparser = subparsers.add_parser('purge_cache',
+                                      help=purge_cache.__doc__)
+    subparser.add_argument('--max-age', default=3600, type=int,
+                           help='Maximum time since last use (seconds)')
+    subparser.set_defaults(command=purge_cache)
+
+    subparser = subparsers.add_parser('rebuild_path_index',
+                                      help=rebuild_path_index.__doc__)
+    subparser.set_defaults(command=rebuild_path_index)
+
+    subparser = subparsers.add_parser('rebuild_revisions',
+                                      help=rebuild_revisions.__doc__)
+    subparser.set_defaults(command=rebuild_revisions)
+
+    subparser = subparsers.add_parser('sweep_expired',
+                                      help=sweep_expired.__doc__)
+    subparser.add_argument('--batch-size', default=1000, type=int)
+    subparser.set_defaults(command=sweep_expired)
+    return parser.parse_args()
+
+
+def main():  # pragma: no cover
+    args = parse_arguments()
+    try:
+        args.command(Session(), args)
+    finally:
+        Session.remove()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
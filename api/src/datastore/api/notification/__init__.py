@@ -0,0 +1,21 @@
+"""Notification package implements the different ways to notify the requests
+waiting for a change of a storage node (see files.delta.files_longpoll_delta).
+
+Possible implementations:
+    - local: notify the requests of the current process only, which is enough
+      as waiting requests also check the database periodically
+
+Channels are storage node ids, and each backend provides:
+    - get_version(channel): the number of notifications published so far
+    - publish(channel): notify the requests waiting on channel
+    - wait(channel, version, timeout): wait until the version of channel is
+      not version anymore, and return whether it changed before the timeout
+
+"""
+
+
+def from_config(app, config):
+    """Import the appropriate notification module according to the config."""
+    options = getattr(config, 'notification', None) or {}
+    backend = options.get('backend', 'local')
+    return __import__('%s.%s' % (__name__, backend), fromlist=[None])
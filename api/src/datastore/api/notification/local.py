@@ -0,0 +1,33 @@
+"""In-process notifications: requests waiting in other processes are not
+notified, and only see the change when they check the database.
+"""
+
+import collections
+import threading
+import time
+
+
+_condition = threading.Condition()
+_versions = collections.defaultdict(int)
+
+
+def get_version(channel):
+    with _condition:
+        return _versions[channel]
+
+
+def publish(channel):
+    with _condition:
+        _versions[channel] += 1
+        _condition.notify_all()
+
+
+def wait(channel, version, timeout):
+    deadline = time.time() + timeout
+    with _condition:
+        while _versions[channel] == version:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            _condition.wait(remaining)
+        return True
@@ -1,13 +1,60 @@
 """Miscellaneous general purpose utilities.
 """
 
+import collections
 import os
 import os.path
+import threading
 
 from datastore.api import config
 from datastore.api.errors import *
 
 
+class LRUCache(object):
+    """A thread-safe mapping which evicts its least recently used values past
+    size entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._tick = 0
+        self._values = {}  # key -> (tick of the last access, value)
+        self._order = collections.deque()  # (tick, key), one per access
+
+    def _touch(self, key, value):
+        # Accesses are appended to the order, where the previous accesses of
+        # the key become stale: they are skipped when evicting, and dropped
+        # once they outnumber the values.
+        self._tick += 1
+        self._values[key] = (self._tick, value)
+        self._order.append((self._tick, key))
+        if len(self._order) > 2 * max(self.size, len(self._values)):
+            self._order = collections.deque(sorted(
+                (tick, k) for k, (tick, _) in self._values.iteritems()))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._order.clear()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            self._touch(key, entry[1])
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._touch(key, value)
+            while len(self._values) > self.size:
+                tick, key = self._order.popleft()
+                if self._values[key][0] == tick:
+                    del self._values[key]
+
+
 def get_boolean_arg(args, var, default=False):
     values = ['false', 'true']
     urlval = args.get(var, values[default]).lower()
@@ -0,0 +1,20 @@
+"""Tree cache package implements the shared tier of the cache of directory
+snapshots (see helpers.snapshot), which is looked up by the processes when
+their own cache misses.
+
+Possible implementations:
+    - local: a bounded in-process dictionary, which stands in for a cache
+      shared between the processes (e.g. memcached)
+
+Keys and values are strings, and each backend provides:
+    - get(key): the value stored for key, or None
+    - set(key, value): store value for key, possibly evicting other keys
+
+"""
+
+
+def from_config(app, config):
+    """Import the appropriate tree cache module according to the config."""
+    options = getattr(config, 'tree_cache', None) or {}
+    backend = options.get('backend', 'local')
+    return __import__('%s.%s' % (__name__, backend), fromlist=[None])
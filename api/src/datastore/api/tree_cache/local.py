@@ -0,0 +1,19 @@
+"""In-process stand-in for a shared cache: values are kept serialized, as they
+would be by a shared backend, and the least recently used ones are evicted past
+tree_cache.shared_size entries.
+"""
+
+from datastore.api import config, tools
+
+
+size = (getattr(config, 'tree_cache', None) or {}).get('shared_size', 10000)
+
+store = tools.LRUCache(size)
+
+
+def get(key):
+    return store.get(key)
+
+
+def set(key, value):
+    store.set(key, value)
@@ -19,10 +19,13 @@ random.seed()
 
 # Import all test fixtures
 from test_chunked import *
+from test_cipher import *
 from test_encryption import *
 from test_file_store import *
 from test_files import *
 from test_fileops import *
+from test_manage import *
+from test_tools import *
 from test_users import *
 
 
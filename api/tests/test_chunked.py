@@ -1,11 +1,58 @@
 from datetime import datetime, timedelta
+import hashlib
 import mock
+import os
+import random
+from . import unittest
 
-from datastore.api import file_store
+from flask import g
+
+import datastore.api
+from datastore.api import config, file_store
+from datastore.api.helpers import hashing
+from datastore import models
 
 import tools
 
 
+class ResumableSHA1TestCase(unittest.TestCase):
+
+    def _check_resume(self):
+        data = os.urandom(1000)
+        hasher, index = hashing.ResumableSHA1(), 0
+        while index < len(data):
+            size = random.randint(1, 150)
+            hasher = hashing.ResumableSHA1(hasher.state)
+            hasher.update(data[index:index + size])
+            index += size
+        self.assertEqual(hasher.hexdigest(), hashlib.sha1(data).hexdigest())
+        self.assertEqual(hasher.copy().digest(), hasher.digest())
+
+    def test_resume(self):
+        self._check_resume()
+
+    def test_resume_python(self):
+        with mock.patch.object(hashing, '_SHA1', hashing._PythonSHA1):
+            self._check_resume()
+
+    def test_portable_state(self):
+        hasher = hashing.ResumableSHA1()
+        hasher.update('a' * 100)
+        with mock.patch.object(hashing, '_SHA1', hashing._PythonSHA1):
+            hasher = hashing.ResumableSHA1(hasher.state)
+        hasher.update('b')
+        self.assertEqual(hasher.state, hashing.ResumableSHA1(
+            hasher.state).state)
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.sha1('a' * 100 + 'b').hexdigest())
+
+    def test_invalid_state(self):
+        state = hashing.ResumableSHA1().state
+        for invalid in ['\x00' * 96, state + 'a']:
+            self.assertRaises(hashing.InvalidStateError,
+                              hashing.ResumableSHA1, invalid)
+
+
 class ChunkedUploadTestCase(tools.FiledepotLoggedInTestCase):
 
     def clear_store(self):
@@ -76,3 +123,198 @@ class ChunkedUploadTestCase(tools.FiledepotLoggedInTestCase):
         rv = self.file.commit_chunked_upload(tools.root, '/f1', upload_id=id_)
         self.assertEqual(rv.status_code, 200)
         self.assertValidFileMetadata(rv.json, tools.root, '/f1', ''.join(data))
+
+    def test_parts(self):
+        data = [tools.generate_random_data() for _ in range(5)]
+
+        rv = self.file.chunked_upload(data[3], part=3)
+        self.assertEqual(rv.status_code, 200)
+        self.assertValidChunkResponse(rv.json, offset=0)
+        self.assertEqual(rv.json['parts'], [3])
+
+        id_ = rv.json['upload_id']
+        for index in [1, 4, 0, 2]:
+            rv = self.file.chunked_upload(data[index], part=index,
+                                          upload_id=id_)
+            self.assertEqual(rv.status_code, 200)
+            self.assertValidChunkResponse(rv.json, offset=0, upload_id=id_)
+        self.assertEqual(rv.json['parts'], range(5))
+
+        rv = self.file.commit_chunked_upload(tools.root, '/f1', upload_id=id_)
+        self.assertEqual(rv.status_code, 200)
+        self.assertValidFileMetadata(rv.json, tools.root, '/f1', ''.join(data))
+
+    def test_parts_retry(self):
+        data = [tools.generate_random_data() for _ in range(2)]
+        rv = self.file.chunked_upload('_', part=0)
+        id_ = rv.json['upload_id']
+        for index, chunk in enumerate(data):
+            rv = self.file.chunked_upload(chunk, part=index, upload_id=id_)
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['parts'], [0, 1])
+
+        rv = self.file.commit_chunked_upload(tools.root, '/f1', upload_id=id_)
+        self.assertEqual(rv.status_code, 200)
+        self.assertValidFileMetadata(rv.json, tools.root, '/f1', ''.join(data))
+
+    def test_parts_missing(self):
+        rv = self.file.chunked_upload('_', part=0)
+        id_ = rv.json['upload_id']
+        rv = self.file.chunked_upload('_', part=2, upload_id=id_)
+        rv = self.file.commit_chunked_upload(tools.root, '/f1', upload_id=id_)
+        self.assertEqual(rv.status_code, 400)
+
+        # The upload may still be completed.
+        rv = self.file.chunked_upload('_', part=1, upload_id=id_)
+        rv = self.file.commit_chunked_upload(tools.root, '/f1', upload_id=id_)
+        self.assertEqual(rv.status_code, 200)
+
+    def test_parts_concurrent(self):
+        # Simulates a concurrent upload of the same part, which records it
+        # right after our lookup of the received parts.
+        register_part = file_store.register_part
+
+        def wrapper(upload_id, part, stream):
+            size = register_part(upload_id, part, stream)
+            g.db_session.query(models.ChunkedUpload) \
+                        .filter_by(upload_id=upload_id).one().parts
+            session = datastore.api.Session.session_factory()
+            db_upload = session.query(models.ChunkedUpload) \
+                               .filter_by(upload_id=upload_id).one()
+            session.add(models.ChunkedUploadPart(number=part, size=1,
+                                                 upload=db_upload))
+            session.commit()
+            session.close()
+            return size
+
+        rv = self.file.chunked_upload('_', part=0)
+        id_ = rv.json['upload_id']
+        with mock.patch.object(file_store, 'register_part', wrapper):
+            rv = self.file.chunked_upload('abc', part=1, upload_id=id_)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['parts'], [0, 1])
+
+        rv = self.file.commit_chunked_upload(tools.root, '/f1', upload_id=id_)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['bytes'], 4)
+
+    def test_parts_mixed(self):
+        rv = self.file.chunked_upload('_')
+        id_ = rv.json['upload_id']
+        rv = self.file.chunked_upload('_', part=1, upload_id=id_)
+        self.assertEqual(rv.status_code, 400)
+
+        rv = self.file.chunked_upload('_', part=1)
+        id_ = rv.json['upload_id']
+        rv = self.file.chunked_upload('_', offset=0, upload_id=id_)
+        self.assertEqual(rv.status_code, 400)
+        rv = self.file.chunked_upload('_', part=-1, upload_id=id_)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_content(self):
+        data = [tools.generate_random_data(random.randint(1, 40))
+                for _ in range(8)]
+        rv = self.file.chunked_upload(data[0])
+        id_ = rv.json['upload_id']
+        for chunk in data[1:]:
+            offset = rv.json['offset']
+            rv = self.file.chunked_upload(chunk, offset=offset, upload_id=id_)
+
+        # Commit doesn't read the uploaded data back.
+        with mock.patch.object(file_store, 'retrieve_chunk_stream') as m:
+            rv = self.file.commit_chunked_upload(tools.root, '/f1',
+                                                 upload_id=id_)
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(m.called)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, ''.join(data))
+
+    def test_content_unencrypted(self):
+        data = [tools.generate_random_data() for _ in range(3)]
+        with mock.patch.dict(config.storage, encryption=False):
+            rv = self.file.chunked_upload(data[0])
+            id_ = rv.json['upload_id']
+            for chunk in data[1:]:
+                offset = rv.json['offset']
+                rv = self.file.chunked_upload(chunk, offset=offset,
+                                              upload_id=id_)
+            rv = self.file.commit_chunked_upload(tools.root, '/f1',
+                                                 upload_id=id_)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, ''.join(data))
+
+    def test_parts_deduplication(self):
+        data = [tools.generate_random_data() for _ in range(2)]
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', ''.join(data))
+            rev = rv.json['rev']
+
+            rv = self.file.chunked_upload(data[1], part=1)
+            id_ = rv.json['upload_id']
+            rv = self.file.chunked_upload(data[0], part=0, upload_id=id_)
+            rv = self.file.commit_chunked_upload(tools.root, '/f2',
+                                                 upload_id=id_)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.json['rev'], rev)
+
+    def _upload_chunks(self, chunks):
+        rv = self.file.chunked_upload(chunks[0])
+        id_ = rv.json['upload_id']
+        for chunk in chunks[1:]:
+            offset = rv.json['offset']
+            rv = self.file.chunked_upload(chunk, offset=offset, upload_id=id_)
+        return id_
+
+    def test_content_split(self):
+        # The blob hash is that of the content, not of the way it was split.
+        data = tools.generate_random_data(30)
+        with mock.patch.dict(config.storage, encryption=False):
+            rv = self.file.put(tools.root, '/f1', data)
+            rev = rv.json['rev']
+            for chunks in ([data[:10], data[10:]], [data[:25], data[25:]]):
+                id_ = self._upload_chunks(chunks)
+                rv = self.file.commit_chunked_upload(tools.root, '/f2',
+                                                     upload_id=id_)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.json['rev'], rev)
+
+    def test_invalid_hash_state(self):
+        # Hash states which can't be restored are rebuilt from the upload.
+        data = [tools.generate_random_data() for _ in range(3)]
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', ''.join(data))
+            rev = rv.json['rev']
+
+            id_ = self._upload_chunks(data[:2])
+            session = datastore.api.Session()
+            session.query(models.ChunkedUpload) \
+                   .filter(models.ChunkedUpload.upload_id == id_) \
+                   .update({'hash_state': '\x00' * 96,
+                            'content_state': '\x00' * 96})
+            session.commit()
+            datastore.api.Session.remove()
+
+            offset = len(data[0]) + len(data[1])
+            rv = self.file.chunked_upload(data[2], offset=offset,
+                                          upload_id=id_)
+            rv = self.file.commit_chunked_upload(tools.root, '/f2',
+                                                 upload_id=id_)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.json['rev'], rev)
+        rv = self.file.get(tools.root, '/f2')
+        self.assertEqual(rv.data, ''.join(data))
+
+    def test_deduplication(self):
+        data = [tools.generate_random_data() for _ in range(3)]
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', ''.join(data))
+            rev = rv.json['rev']
+
+            id_ = self._upload_chunks(data)
+            rv = self.file.commit_chunked_upload(tools.root, '/f2',
+                                                 upload_id=id_)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.json['rev'], rev)
+        rv = self.file.get(tools.root, '/f2')
+        self.assertEqual(rv.data, ''.join(data))
@@ -0,0 +1,52 @@
+import os
+from . import unittest
+
+from datastore.api.cipher import aes_pycrypto
+
+
+class CipherTestCase(object):
+
+    # NIST SP 800-38A, F.5.5 (CTR-AES256.Encrypt)
+    key = ('603deb1015ca71be2b73aef0857d7781'
+           '1f352c073b6108d72d9810a30914dff4').decode('hex')
+    counter = int('f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff', 16)
+    plaintext = ('6bc1bee22e409f96e93d7e117393172a'
+                 'ae2d8a571e03ac9c9eb76fac45af8e51').decode('hex')
+    ciphertext = ('601ec313775789a5b7a7f504bbf3d228'
+                  'f443e3ca4d62b59aca84e990cacaf5c5').decode('hex')
+
+    def test_block_size(self):
+        self.assertEqual(self.backend.block_size, 16)
+
+    def test_encrypt(self):
+        ctr = self.backend.new_ctr(self.key, self.counter)
+        self.assertEqual(ctr.encrypt(self.plaintext), self.ciphertext)
+
+    def test_decrypt_partial(self):
+        ctr = self.backend.new_ctr(self.key, self.counter)
+        chunks = [self.ciphertext[:5], self.ciphertext[5:21],
+                  self.ciphertext[21:]]
+        plaintext = ''.join(ctr.decrypt(chunk) for chunk in chunks)
+        self.assertEqual(plaintext, self.plaintext)
+
+    def test_negative_initial_value(self):
+        data = os.urandom(64)
+        ctr = aes_pycrypto.new_ctr(self.key, -1 << 20)
+        encrypted = ctr.encrypt(data)
+        ctr = self.backend.new_ctr(self.key, -1 << 20)
+        self.assertEqual(ctr.decrypt(encrypted), data)
+
+
+class PyCryptoTestCase(CipherTestCase, unittest.TestCase):
+    backend = aes_pycrypto
+
+
+try:
+    from datastore.api.cipher import aes_openssl
+except ImportError:  # pragma: no cover
+    aes_openssl = None
+
+
+@unittest.skipIf(aes_openssl is None, 'cryptography is not installed')
+class OpenSSLTestCase(CipherTestCase, unittest.TestCase):
+    backend = aes_openssl
@@ -1,9 +1,14 @@
 import cStringIO
 import hashlib
+import hmac
+import mock
 import os.path
 import random
 import shutil
+import struct
 import tempfile
+import threading
+import time
 from . import unittest
 
 from flask import request
@@ -12,8 +17,8 @@ from flask import request
 from datastore.api import app, config
 config.storage['fs_root'] = ''
 
-from datastore.api.helpers import stream
-from datastore.api.file_store import fs
+from datastore.api.helpers import chunking, stream
+from datastore.api.file_store import fs, pack
 
 
 class FilesystemChunkTestCase(unittest.TestCase):
@@ -67,6 +72,28 @@ class FilesystemChunkTestCase(unittest.TestCase):
         with fs.retrieve_chunk_stream(self.id_) as s:
             self.assertEqual(s.read(), data)
 
+    def test_commit_chunked_upload(self):
+        data = os.urandom(64)
+        fs.register_chunk(self.id_, cStringIO.StringIO(data))
+        f_hash = fs.commit_chunked_upload(self.root, self.id_, self.id_)
+        self.assertEqual(f_hash, self.id_)
+        with fs.retrieve_blob_stream(self.root, f_hash) as s:
+            self.assertEqual(s.read(), data)
+        self.assertRaises(IOError, fs.retrieve_chunk_stream, self.id_)
+
+    def test_register_part(self):
+        data = [os.urandom(64) for _ in range(2)]
+        for part, chunk in reversed(list(enumerate(data))):
+            size = fs.register_part(self.id_, part, cStringIO.StringIO(chunk))
+            self.assertEqual(size, len(chunk))
+        for part, chunk in enumerate(data):
+            with fs.retrieve_part_stream(self.id_, part) as s:
+                self.assertEqual(s.read(), chunk)
+
+        fs.remove_chunked_upload(self.id_, range(2))
+        for part in range(2):
+            self.assertRaises(IOError, fs.retrieve_part_stream, self.id_, part)
+
 
 class ChecksumCalcStreamTestCase(unittest.TestCase):
 
@@ -84,6 +111,66 @@ class ChecksumCalcStreamTestCase(unittest.TestCase):
             f_hash = fs.register_blob('root', 'f', s, s.hash)
             self.assertEqual(f_hash, hashlib.sha1(data).hexdigest())
 
+    def test_block_pipeline(self):
+        # Blocks smaller than the data and than the AES block size exercise
+        # the counter continuity across reads.
+        data = os.urandom(100)
+        key = os.urandom(32)
+        with mock.patch.object(fs, 'block_size', 7):
+            enc = stream.AESEncryptionStream(cStringIO.StringIO(data), key)
+            s = stream.ChecksumCalcStream(enc)
+            f_hash = fs.register_blob('root', 'f', s, s.hash)
+
+        with fs.retrieve_blob_stream('root', f_hash) as f:
+            encrypted = f.read()
+        self.assertEqual(f_hash, hashlib.sha1(encrypted).hexdigest())
+        dec = stream.AESDecryptionStream(cStringIO.StringIO(encrypted), key,
+                                         enc.IV)
+        self.assertEqual(dec.read(), data)
+
+
+class ChunkingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patcher = mock.patch.multiple(
+            chunking, min_size=64, avg_size=256, max_size=1024,
+            _mask_s=chunking._make_mask(10), _mask_l=chunking._make_mask(6))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _chunk(self, data):
+        return list(chunking.iter_chunks(cStringIO.StringIO(data)))
+
+    def test_iter_chunks(self):
+        data = os.urandom(16384)
+        chunks = self._chunk(data)
+        self.assertEqual(''.join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(64 < len(chunk) <= 1024)
+        self.assertEqual(self._chunk(''), [''])
+
+    def test_boundaries_shift(self):
+        # Inserting data only affects the first chunks, as boundaries depend
+        # on the content and not on the offsets. The data is seeded, as it
+        # occasionally takes a few more chunks for the boundaries to match.
+        rng = random.Random(0)
+        data = ''.join(chr(rng.randrange(256)) for _ in range(16394))
+        chunks = self._chunk(data[10:])
+        shifted = self._chunk(data)
+        self.assertGreater(len(set(chunks) & set(shifted)), len(chunks) - 3)
+
+    def test_encrypt_chunk(self):
+        # Identical chunks get the same counter, which isn't a hash keyed by
+        # the encryption key itself.
+        data, key = os.urandom(256), os.urandom(32)
+        encrypted, iv = chunking._encrypt_chunk(data, key)
+        self.assertEqual(chunking._encrypt_chunk(data, key), (encrypted, iv))
+        digest = hmac.new(key, data, hashlib.sha1).digest()
+        self.assertNotEqual(iv >> 64, struct.unpack('>Q', digest[:8])[0])
+        self.assertNotEqual(encrypted, data)
+
 
 class FilesystemStoreTestCase(unittest.TestCase):
 
@@ -135,3 +222,113 @@ class FilesystemStoreTestCase(unittest.TestCase):
 
     def test_stat_missing_blob(self):
         self.assertEqual(fs.stat_blob(self.root, self.path, '_'), (None, None))
+
+    def test_list_remove_blob(self):
+        f_hash = fs.register_blob(self.root, self.path, self.stream, self.hash)
+        self.assertEqual(fs.list_blobs(self.root, f_hash[:2]), [f_hash])
+        fs.remove_blob(self.root, f_hash)
+        self.assertEqual(fs.list_blobs(self.root, f_hash[:2]), [])
+        self.assertEqual(fs.list_blobs(self.root, '__'), [])
+
+    def test_purge_temp_files(self):
+        storage_temp = os.path.join(fs.storage_root, '_tmp')
+        os.mkdir(storage_temp)
+        for delta in [-60, 60]:
+            temp_file = tempfile.NamedTemporaryFile(dir=storage_temp,
+                                                    delete=False)
+            temp_file.close()
+            os.utime(temp_file.name, (0, time.time() + delta))
+        with mock.patch.object(fs, 'storage_temp', storage_temp):
+            self.assertEqual(fs.purge_temp_files(time.time()), 1)
+        self.assertEqual(len(os.listdir(storage_temp)), 1)
+
+
+class PackStoreTestCase(unittest.TestCase):
+
+    root = 'root'
+    path = 'path'
+
+    def setUp(self):
+        fs.storage_root = tempfile.mkdtemp()
+        fs.initialize()
+        pack.initialize()
+
+        self.patchers = [mock.patch.object(pack, 'pack_threshold', 64),
+                         mock.patch.object(pack, 'pack_size', 256)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(fs.storage_root)
+
+    def _register(self, data):
+        s = stream.ChecksumCalcStream(cStringIO.StringIO(data))
+        f_hash = pack.register_blob(self.root, self.path, s, s.hash)
+        self.assertEqual(f_hash, hashlib.sha1(data).hexdigest())
+        return f_hash
+
+    def test_register_small_blob(self):
+        data = os.urandom(64)
+        f_hash = self._register(data)
+        self.assertIsNone(fs.retrieve_blob_path(self.root, f_hash) and
+                          pack.retrieve_blob_path(self.root, f_hash))
+        self.assertEqual(fs.stat_blob(self.root, self.path, f_hash),
+                         (None, None))
+        s = pack.retrieve_blob_stream(self.root, f_hash)
+        self.assertEqual(s.read(), data)
+        self.assertEqual(pack.stat_blob(self.root, self.path, f_hash)[1], 64)
+        self.assertEqual(pack.list_blobs(self.root, f_hash[:2]), [f_hash])
+
+    def test_register_large_blob(self):
+        data = os.urandom(65)
+        f_hash = self._register(data)
+        self.assertEqual(fs.stat_blob(self.root, self.path, f_hash)[1], 65)
+        with pack.retrieve_blob_stream(self.root, f_hash) as s:
+            self.assertEqual(s.read(), data)
+        self.assertIsNotNone(pack.retrieve_blob_path(self.root, f_hash))
+
+    def test_register_dup_blob(self):
+        data = os.urandom(32)
+        f_hash = self._register(data)
+        self.assertEqual(self._register(data), f_hash)
+        pack_path = pack._make_pack_path(self.root, 0)
+        self.assertEqual(os.path.getsize(pack_path), 32)
+
+    def test_connect(self):
+        # The index connection is shared by the calls of a thread.
+        self.assertIs(pack._connect(), pack._connect())
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(pack._connect()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], pack._connect())
+
+    def test_compact_packs(self):
+        data = [os.urandom(64) for _ in range(8)]
+        hashes = [self._register(chunk) for chunk in data]
+        self.assertEqual(pack._list_packs(self.root), [0, 1])
+
+        # Remove 3 out of 4 blobs from the first pack. A reader may still
+        # hold the location of the remaining one in the rewritten pack.
+        for f_hash in hashes[:3]:
+            pack.remove_blob(self.root, f_hash)
+        location = pack._lookup(pack._connect(), self.root, hashes[3])
+        pack.compact_packs(0.5, 600)
+        self.assertEqual(pack._list_packs(self.root), [0, 1, 2])
+        self.assertEqual(pack._read_packed(self.root, location), data[3])
+
+        # The rewritten pack is removed once retired for the grace period.
+        pack.compact_packs(0.5, 600)
+        self.assertEqual(pack._list_packs(self.root), [0, 1, 2])
+        os.utime(pack._make_pack_path(self.root, 0), (0, 0))
+        pack.compact_packs(0.5, 600)
+        self.assertEqual(pack._list_packs(self.root), [1, 2])
+        for chunk, f_hash in zip(data, hashes)[3:]:
+            s = pack.retrieve_blob_stream(self.root, f_hash)
+            self.assertEqual(s.read(), chunk)
+        for f_hash in hashes[:3]:
+            self.assertEqual(pack.stat_blob(self.root, self.path, f_hash),
+                             (None, None))
@@ -1,3 +1,9 @@
+import mock
+
+import datastore.api
+from datastore.api import config
+from datastore import models
+
 import tools
 
 
@@ -66,6 +72,17 @@ class FileopsCreateFolderTestCase(tools.FiledepotLoggedInTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.json.get('is_deleted', False), False)
 
+    def test_recreate_deleted_with_content(self):
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.file.put(tools.root, '/d1/f1', tools.generate_random_data())
+        rv = self.fileops.delete(tools.root, 'd1')
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.file.metadata(tools.root, '/d1/f1')
+        self.assertEqual(rv.status_code, 404)
+
     def test_create_same_name_file(self):
         rv = self.file.put(tools.root, 'd1', tools.generate_random_data())
         self.assertEqual(rv.status_code, 200)
@@ -188,6 +205,23 @@ class FileopsCopyTestCase(tools.FiledepotLoggedInTestCase):
         self.assertEqual(dst_metadata['contents'][1].pop('path'), '/d2/f2')
         self.assertDictEqual(src_metadata, dst_metadata)
 
+    def test_nested_dir(self):
+        data = tools.generate_random_data()
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.fileops.create_folder(tools.root, '/d1/d2')
+        rv = self.file.put(tools.root, '/d1/d2/f1', data)
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.fileops.copy(tools.root, '/d1', '/d3')
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.file.get(tools.root, '/d3/d2/f1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, data)
+        rv = self.file.metadata(tools.root, '/d3/d2/')
+        self.assertEqual(rv.status_code, 200)
+        self.assertValidDirMetadata(rv.json, tools.root, '/d3/d2')
+
     def test_missing(self):
         rv = self.fileops.create_folder(tools.root, '/d1')
         self.assertEqual(rv.status_code, 200)
@@ -302,6 +336,30 @@ class FileopsDeleteTestCase(tools.FiledepotLoggedInTestCase):
             rv = self.file.metadata(tools.root, item)
             self.assertTrue(rv.json['is_deleted'])
 
+    def test_restore_folder(self):
+        for path_ in ['/d1', '/d1/d2']:
+            rv = self.fileops.create_folder(tools.root, path_)
+        for path_ in ['/d1/file1', '/d1/d2/file2']:
+            rv = self.file.put(tools.root, path_, tools.generate_random_data())
+        rv = self.fileops.delete(tools.root, '/d1')
+        rv = self.fileops.delete(tools.root, '/d1/d2/file2')
+        self.assertEqual(rv.status_code, 404)
+        rv = self.fileops.copy(tools.root, '/d1/file1', '/file1')
+        self.assertEqual(rv.status_code, 404)
+
+        # Writing to a deleted directory restores it, without its content.
+        data = tools.generate_random_data()
+        rv = self.file.put(tools.root, '/d1/file3', data)
+        self.assertEqual(rv.status_code, 200)
+        for item in ['/d1', '/d1/file3']:
+            rv = self.file.metadata(tools.root, item)
+            self.assertNotIn('is_deleted', rv.json)
+        for item in ['/d1/file1', '/d1/d2', '/d1/d2/file2']:
+            rv = self.file.metadata(tools.root, item)
+            self.assertTrue(rv.json['is_deleted'])
+        rv = self.file.search(tools.root, '', query='file1')
+        self.assertEqual(rv.json, [])
+
     def test_unexistant(self):
         rv = self.fileops.delete(tools.root, '_')
         self.assertEqual(rv.status_code, 404)
@@ -351,6 +409,8 @@ class FileopsMoveTestCase(tools.FiledepotLoggedInTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertDictContainsSubset({'is_deleted': True}, rv.json)
 
+        rv = self.file.metadata(tools.root, '/d2/f1')
+        self.assertNotIn('is_deleted', rv.json)
         rv = self.file.get(tools.root, '/d2/f1')
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.data, data)
@@ -374,3 +434,172 @@ class FileopsMoveTestCase(tools.FiledepotLoggedInTestCase):
         rv = self.file.get(tools.root, '/d2/f2')
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.data, data)
+
+
+class FileopsBatchTestCase(tools.FiledepotLoggedInTestCase):
+
+    def test_bad_operations(self):
+        for operations in [[], {'op': 'delete'}, [{'op': 'rename'}],
+                           [{'op': 'delete', 'from_path': '/f1'}]]:
+            rv = self.fileops.batch(tools.root, operations)
+            self.assertIn(rv.status_code, (400, 406))
+        rv = self.fileops.batch('bad_root', [{'op': 'delete', 'path': '/f1'}])
+        self.assertEqual(rv.status_code, 403)
+
+    def test_failure_rollback(self):
+        rv = self.fileops.batch(tools.root, [
+            {'op': 'create_folder', 'path': '/d1'},
+            {'op': 'delete', 'path': '/d2'},
+        ])
+        self.assertEqual(rv.status_code, 404)
+        self.assertTrue(rv.json['message'].startswith('Operation 1 failed'))
+
+        rv = self.file.metadata(tools.root, '/d1')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_std(self):
+        data = tools.generate_random_data()
+        rv = self.file.put(tools.root, '/f1', data)
+
+        # Each operation sees the effect of the previous ones.
+        rv = self.fileops.batch(tools.root, [
+            {'op': 'create_folder', 'path': '/d1'},
+            {'op': 'copy', 'from_path': '/f1', 'to_path': '/d1/f2'},
+            {'op': 'move', 'from_path': '/f1', 'to_path': '/d1/f3'},
+            {'op': 'delete', 'path': '/d1/f2'},
+        ])
+        self.assertEqual(rv.status_code, 200)
+        results = rv.json['results']
+        self.assertEqual(len(results), 4)
+        self.assertValidDirMetadata(results[0], tools.root, '/d1')
+        self.assertValidFileMetadata(results[1], tools.root, '/d1/f2', data)
+        self.assertValidFileMetadata(results[2], tools.root, '/d1/f3', data)
+        self.assertDictContainsSubset({'is_deleted': True}, results[3])
+
+        rv = self.file.metadata(tools.root, '/f1')
+        self.assertDictContainsSubset({'is_deleted': True}, rv.json)
+        rv = self.file.get(tools.root, '/d1/f3')
+        self.assertEqual(rv.data, data)
+        rv = self.file.metadata(tools.root, '/d1/f2')
+        self.assertDictContainsSubset({'is_deleted': True}, rv.json)
+
+
+class FileopsFullHistoryTestCase(tools.FiledepotLoggedInTestCase):
+
+    def setUp(self):
+        super(FileopsFullHistoryTestCase, self).setUp()
+        self.patcher = mock.patch.object(config, 'enable_full_history', True)
+        self.patcher.start()
+        self.session = datastore.api.Session()
+
+    def tearDown(self):
+        datastore.api.Session.remove()
+        self.patcher.stop()
+        super(FileopsFullHistoryTestCase, self).tearDown()
+
+    def _count_trees(self):
+        self.session.expire_all()
+        return self.session.query(models.Tree).count()
+
+    def _get_head(self):
+        self.session.expire_all()
+        return self.session.query(models.Node).filter_by(path=tools.root) \
+                           .one().head
+
+    def test_copy_on_write(self):
+        data = [tools.generate_random_data() for _ in range(2)]
+        for path_ in ['/d1', '/d1/d2', '/d3']:
+            rv = self.fileops.create_folder(tools.root, path_)
+        rv = self.file.put(tools.root, '/d3/f1', data[0])
+        rv = self.file.put(tools.root, '/d1/d2/f1', data[0])
+
+        # Only the directories of the modified path get new trees, and the
+        # previous commit is left untouched.
+        count = self._count_trees()
+        rv = self.file.put(tools.root, '/d1/d2/f1', data[1])
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self._count_trees(), count + 3)
+
+        head = self._get_head()
+        previous = head.parent.root.sub_trees['d1'].tree.sub_trees['d2'].tree
+        current = head.root.sub_trees['d1'].tree.sub_trees['d2'].tree
+        self.assertNotEqual(previous.sub_files['f1'].hash,
+                            current.sub_files['f1'].hash)
+        self.assertIs(head.parent.root.sub_trees['d3'].tree,
+                      head.root.sub_trees['d3'].tree)
+
+        rv = self.file.get(tools.root, '/d1/d2/f1')
+        self.assertEqual(rv.data, data[1])
+        rv = self.file.metadata(tools.root, '/d1/d2', list=True)
+        self.assertEqual([md['path'] for md in rv.json['contents']],
+                         ['/d1/d2/f1'])
+
+    def test_restore_deleted(self):
+        # Restoring a file points the index to the link of the new commit.
+        data = tools.generate_random_data()
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/file1', data)
+            rv = self.fileops.delete(tools.root, '/file1')
+            rv = self.file.put(tools.root, '/file1', data)
+            self.assertEqual(rv.status_code, 200)
+
+        rv = self.file.search(tools.root, '', query='file1')
+        self.assertEqual([md['path'] for md in rv.json], ['/file1'])
+        rv = self.file.delta(tools.root)
+        self.assertEqual([md for _, md in rv.json['entries']
+                          if md.get('is_deleted')], [])
+
+    def test_delete_dir(self):
+        # Only the directories of the path get new trees: the content of the
+        # deleted directory is shared with the previous commit.
+        for path_ in ['/d1', '/d1/d2']:
+            rv = self.fileops.create_folder(tools.root, path_)
+        for path_ in ['/d1/file1', '/d1/d2/file2']:
+            rv = self.file.put(tools.root, path_, tools.generate_random_data())
+        cursor = self.file.delta(tools.root).json['cursor']
+
+        count = self._count_trees()
+        rv = self.fileops.delete(tools.root, '/d1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self._count_trees(), count + 1)
+        head = self._get_head()
+        self.assertIs(head.parent.root.sub_trees['d1'].tree,
+                      head.root.sub_trees['d1'].tree)
+
+        rv = self.file.metadata(tools.root, '/d1/d2/file2')
+        self.assertTrue(rv.json['is_deleted'])
+        rv = self.file.metadata(tools.root, '/d1')
+        self.assertEqual(rv.json['contents'], [])
+        for options in [{}, {'limit': 10}]:
+            rv = self.file.metadata(tools.root, '/d1', include_deleted='true',
+                                    **options)
+            self.assertEqual([md.get('is_deleted')
+                              for md in rv.json['contents']], [True, True])
+        rv = self.file.search(tools.root, '', query='file2')
+        self.assertEqual(rv.json, [])
+        rv = self.file.delta(tools.root, cursor=cursor)
+        self.assertEqual(sorted(path for path, md in rv.json['entries']
+                                if md.get('is_deleted')),
+                         ['/d1', '/d1/d2', '/d1/d2/file2', '/d1/file1'])
+
+    def test_move_dir(self):
+        data = tools.generate_random_data()
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.fileops.create_folder(tools.root, '/d1/d2')
+        rv = self.file.put(tools.root, '/d1/d2/f1', data)
+
+        rv = self.fileops.move(tools.root, '/d1', '/d3')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.file.metadata(tools.root, '/d1/d2/f1')
+        self.assertDictContainsSubset({'is_deleted': True}, rv.json)
+        rv = self.file.metadata(tools.root, '/d3/d2/f1')
+        self.assertNotIn('is_deleted', rv.json)
+        rv = self.file.get(tools.root, '/d3/d2/f1')
+        self.assertEqual(rv.data, data)
+
+        # The previous commit still holds the original directory.
+        head = self._get_head()
+        link = head.parent.root.sub_trees['d1']
+        self.assertFalse(link.is_deleted)
+        self.assertFalse(link.tree.sub_trees['d2'].tree.sub_files['f1']
+                         .is_deleted)
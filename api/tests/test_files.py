@@ -1,11 +1,23 @@
+import cStringIO
 from datetime import datetime, timedelta
+import functools
 import json
 import mock
+import os
 import random
+import shutil
+import tempfile
+import threading
 import tools
 import urllib2
 
-from datastore.api import config, file_store
+from flask import g
+
+import datastore.api
+from datastore.api import config, file_store, notification
+from datastore.api.files import delta, put
+from datastore.api.helpers import chunking, database, snapshot, stream
+from datastore import models
 
 
 class FileTestCase(tools.FiledepotLoggedInTestCase):
@@ -22,6 +34,124 @@ class FileTestCase(tools.FiledepotLoggedInTestCase):
             file_store.store.clear()
 
 
+class FileDeltaTestCase(FileTestCase):
+
+    def _paths(self, rv):
+        return [path for path, _ in rv.json['entries']]
+
+    def test_reset(self):
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.file.put(tools.root, '/d1/f1', tools.generate_random_data())
+        rv = self.file.delta(tools.root)
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.json['reset'])
+        self.assertFalse(rv.json['has_more'])
+        self.assertEqual(sorted(self._paths(rv)), ['/d1', '/d1/f1'])
+
+        rv = self.file.delta(tools.root, cursor=rv.json['cursor'])
+        self.assertFalse(rv.json['reset'])
+        self.assertEqual(rv.json['entries'], [])
+
+    def test_changes(self):
+        rv = self.file.put(tools.root, '/f1', tools.generate_random_data())
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        cursor = self.file.delta(tools.root).json['cursor']
+
+        rv = self.file.put(tools.root, '/d1/f2', tools.generate_random_data())
+        rv = self.fileops.delete(tools.root, '/f1')
+        rv = self.fileops.move(tools.root, '/d1/f2', '/f3')
+        rv = self.file.delta(tools.root, cursor=cursor)
+        self.assertEqual(rv.status_code, 200)
+        entries = dict(rv.json['entries'])
+        self.assertEqual(sorted(entries), ['/d1/f2', '/f1', '/f3'])
+        self.assertTrue(entries['/f1']['is_deleted'])
+        self.assertTrue(entries['/d1/f2']['is_deleted'])
+        self.assertFalse(entries['/f3'].get('is_deleted', False))
+
+    def test_pagination(self):
+        for index in range(3):
+            rv = self.fileops.create_folder(tools.root, '/d%d' % index)
+        paths, kwargs = [], {'limit': 2}
+        for has_more in [True, False]:
+            rv = self.file.delta(tools.root, **kwargs)
+            self.assertEqual(rv.json['has_more'], has_more)
+            paths.extend(self._paths(rv))
+            kwargs['cursor'] = rv.json['cursor']
+        self.assertEqual(sorted(paths), ['/d0', '/d1', '/d2'])
+
+        for index in range(3):
+            rv = self.fileops.delete(tools.root, '/d%d' % index)
+        rv = self.file.delta(tools.root, **kwargs)
+        self.assertTrue(rv.json['has_more'])
+        self.assertEqual(self._paths(rv), ['/d0', '/d1'])
+        kwargs['cursor'] = rv.json['cursor']
+        rv = self.file.delta(tools.root, **kwargs)
+        self.assertFalse(rv.json['has_more'])
+        self.assertEqual(self._paths(rv), ['/d2'])
+
+    def test_pagination_large_change(self):
+        # The descendants of a single change are split over several pages.
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        for index in range(3):
+            rv = self.file.put(tools.root, '/d1/f%d' % index, str(index))
+        cursor = self.file.delta(tools.root).json['cursor']
+        rv = self.fileops.copy(tools.root, '/d1', '/d2')
+        rv = self.fileops.create_folder(tools.root, '/d3')
+
+        pages, kwargs = [], {'cursor': cursor, 'limit': 2}
+        for has_more in [True, True, False]:
+            rv = self.file.delta(tools.root, **kwargs)
+            self.assertEqual(rv.json['has_more'], has_more)
+            pages.append(self._paths(rv))
+            kwargs['cursor'] = rv.json['cursor']
+        self.assertEqual(pages, [['/d2', '/d2/f0'], ['/d2/f1', '/d2/f2'],
+                                 ['/d3']])
+
+    def test_longpoll(self):
+        cursor = self.file.delta(tools.root).json['cursor']
+        rv = self.file.longpoll_delta(tools.root, cursor=cursor, timeout=1)
+        self.assertEqual(rv.status_code, 200)
+        self.assertFalse(rv.json['changes'])
+
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.file.longpoll_delta(tools.root, cursor=cursor)
+        self.assertTrue(rv.json['changes'])
+        rv = self.file.longpoll_delta(tools.root, cursor=cursor, timeout=0)
+        self.assertEqual(rv.status_code, 406)
+        rv = self.file.longpoll_delta(tools.root, cursor=cursor, timeout=61)
+        self.assertEqual(rv.status_code, 406)
+
+    def test_longpoll_backoff(self):
+        # Requests don't wait when all the waiting slots are taken.
+        cursor = self.file.delta(tools.root).json['cursor']
+        waiters = threading.BoundedSemaphore(1)
+        waiters.acquire()
+        with mock.patch.object(delta, '_waiters', waiters):
+            rv = self.file.longpoll_delta(tools.root, cursor=cursor,
+                                          timeout=60)
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(rv.json['changes'])
+            self.assertEqual(rv.json['backoff'], delta.poll_interval)
+        waiters.release()
+        rv = self.file.longpoll_delta(tools.root, cursor=cursor, timeout=1)
+        self.assertNotIn('backoff', rv.json)
+
+    def test_longpoll_notification(self):
+        version = notification.get_version(-1)
+        self.assertFalse(notification.wait(-1, version, 0.01))
+        threading.Timer(0.05, notification.publish, [-1]).start()
+        self.assertTrue(notification.wait(-1, version, 5))
+        self.assertEqual(notification.get_version(-1), version + 1)
+
+    def test_bad_params(self):
+        rv = self.file.delta(tools.root, cursor='x')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.file.delta(tools.root, limit=0)
+        self.assertEqual(rv.status_code, 406)
+        rv = self.file.delta('dummy')
+        self.assertEqual(rv.status_code, 403)
+
+
 class FileGetTestCase(FileTestCase):
 
     def test_std(self):
@@ -86,6 +216,100 @@ class FileGetTestCase(FileTestCase):
         rv = self.file.get(tools.root, 'f1')
         self.assertEqual(rv.status_code, 404)
 
+    def test_range(self):
+        data = tools.generate_random_data(4096)
+        rv = self.file.put(tools.root, 'f1', data)
+        for start, stop in [(0, 1), (5, 17), (1000, 4096), (4095, 4096)]:
+            headers = {'Range': 'bytes=%d-%d' % (start, stop - 1)}
+            rv = self.file.get(tools.root, 'f1', headers=headers)
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(rv.data, data[start:stop])
+            self.assertEqual(rv.headers['Content-Length'], str(stop - start))
+            self.assertEqual(rv.headers['Content-Range'],
+                             'bytes %d-%d/4096' % (start, stop - 1))
+
+    def test_range_suffix(self):
+        data = tools.generate_random_data(4096)
+        rv = self.file.put(tools.root, 'f1', data)
+        rv = self.file.get(tools.root, 'f1', headers={'Range': 'bytes=-100'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, data[-100:])
+
+    def test_range_not_satisfiable(self):
+        data = tools.generate_random_data(64)
+        rv = self.file.put(tools.root, 'f1', data)
+        rv = self.file.get(tools.root, 'f1', headers={'Range': 'bytes=64-'})
+        self.assertEqual(rv.status_code, 416)
+        self.assertEqual(rv.headers['Content-Range'], 'bytes */64')
+
+    def test_if_range(self):
+        data = tools.generate_random_data(64)
+        rv = self.file.put(tools.root, 'f1', data)
+        rv = self.file.get(tools.root, 'f1')
+        etag = rv.headers['ETag']
+
+        headers = {'Range': 'bytes=10-19', 'If-Range': etag}
+        rv = self.file.get(tools.root, 'f1', headers=headers)
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, data[10:20])
+
+        headers['If-Range'] = '"dummy"'
+        rv = self.file.get(tools.root, 'f1', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, data)
+
+    def test_unencrypted(self):
+        data = tools.generate_random_data(64)
+        with mock.patch.dict(config.storage, encryption=False):
+            rv = self.file.put(tools.root, 'f1', data)
+        rv = self.file.get(tools.root, 'f1', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, data[10:20])
+
+    def test_offload_storage(self):
+        data = tools.generate_random_data()
+        with mock.patch.dict(config.storage, encryption=False):
+            rv = self.file.put(tools.root, 'f1', data)
+        blob_hash = rv.json['rev']
+
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        filepath = os.path.join(cache_root, 'blob')
+        with open(filepath, 'wb') as blob_file:
+            blob_file.write(data)
+
+        offload = {'header': 'X-Sendfile', 'cache_root': cache_root}
+        with mock.patch.dict(config.storage, offload=offload):
+            with mock.patch.object(file_store, 'retrieve_blob_path',
+                                   return_value=filepath):
+                rv = self.file.get(tools.root, 'f1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, '')
+        self.assertEqual(rv.headers['X-Sendfile'], filepath)
+        self.assertTrue(rv.headers['ETag'].startswith('"' + blob_hash))
+
+    def test_offload_cache(self):
+        data = tools.generate_random_data()
+        rv = self.file.put(tools.root, 'f1', data)
+        blob_hash = rv.json['rev']
+
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        offload = {'cache_location': '/_cache/', 'cache_root': cache_root}
+        with mock.patch.dict(config.storage, offload=offload):
+            rv = self.file.get(tools.root, 'f1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, '')
+        self.assertIn('attachment', rv.headers['Content-Disposition'])
+
+        # The decrypted file is served by the front web server.
+        location = rv.headers['X-Accel-Redirect']
+        self.assertTrue(location.startswith('/_cache/' + tools.root + '/'))
+        filepath = os.path.join(cache_root, location[len('/_cache/'):])
+        with open(filepath, 'rb') as cached_file:
+            self.assertEqual(cached_file.read(), data)
+        self.assertIn(blob_hash[2:], filepath)
+
     def test_embedded_metadata(self):
         data = tools.generate_random_data()
         rv = self.file.put(tools.root, 'f1', data)
@@ -183,6 +407,36 @@ class FileMetadataTestCase(FileTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertValidDirMetadata(rv.json, tools.root, '/d1')
 
+    def test_hash_copy_file(self):
+        rv = self.fileops.create_folder(tools.root, 'd1')
+        rv = self.file.put(tools.root, '/f1', tools.generate_random_data())
+        rv = self.file.metadata(tools.root, 'd1')
+        self.assertEqual(rv.status_code, 200)
+
+        options = {'hash': rv.json['hash']}
+        rv = self.fileops.copy(tools.root, '/f1', '/d1/f1')
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.file.metadata(tools.root, 'd1', **options)
+        self.assertEqual(rv.status_code, 200)
+        options = {'hash': rv.json['hash']}
+        rv = self.file.metadata(tools.root, 'd1', **options)
+        self.assertEqual(rv.status_code, 304)
+
+    def test_hash_move_file(self):
+        rv = self.fileops.create_folder(tools.root, 'd1')
+        rv = self.file.put(tools.root, '/d1/f1', tools.generate_random_data())
+        rv = self.file.metadata(tools.root, 'd1')
+        self.assertEqual(rv.status_code, 200)
+
+        options = {'hash': rv.json['hash']}
+        rv = self.fileops.move(tools.root, '/d1/f1', '/f1')
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.file.metadata(tools.root, 'd1', **options)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['contents'], [])
+
     def test_hash_change_subdir(self):
         rv = self.fileops.create_folder(tools.root, 'd1')
         rv = self.fileops.create_folder(tools.root, 'd1/d2')
@@ -244,6 +498,51 @@ class FileMetadataTestCase(FileTestCase):
         self.assertEqual(len(content), 1)
         self.assertValidFileMetadata(content[0], tools.root, '/d1/f1', '')
 
+    def test_listing_paginated(self):
+        for path in ['d2', 'd1', 'd1/d3']:
+            rv = self.fileops.create_folder(tools.root, path)
+        for path in ['f2', 'f1', 'f3', 'd1/f4']:
+            rv = self.file.put(tools.root, path, tools.generate_random_data())
+        rv = self.fileops.delete(tools.root, 'f3')
+
+        contents, kwargs = [], {'limit': 2}
+        for has_more in [True, False]:
+            rv = self.file.metadata(tools.root, '/', **kwargs)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.json['has_more'], has_more)
+            self.assertLessEqual(len(rv.json['contents']), 2)
+            contents.extend(rv.json['contents'])
+            kwargs['cursor'] = rv.json['cursor']
+        self.assertIsNone(kwargs['cursor'])
+
+        paths = [md['path'] for md in contents]
+        self.assertEqual(paths, ['/d1', '/d2', '/f1', '/f2'])
+        self.assertEqual(contents, self.file.metadata(tools.root, '/').json[
+            'contents'])
+
+    def test_listing_stream(self):
+        for path in ['d1', 'd1/d2']:
+            rv = self.fileops.create_folder(tools.root, path)
+        rv = self.file.put(tools.root, 'd1/f1', tools.generate_random_data())
+
+        expected = self.file.metadata(tools.root, '/d1').json
+        rv = self.file.metadata(tools.root, '/d1', stream='true')
+        self.assertEqual(rv.status_code, 200)
+        self.assertFalse(rv.json.pop('has_more'))
+        self.assertIsNone(rv.json.pop('cursor'))
+        self.assertEqual(rv.json, expected)
+
+        rv = self.file.metadata(tools.root, '/d1', stream='true', limit=1)
+        self.assertTrue(rv.json['has_more'])
+        self.assertEqual(rv.json['contents'], expected['contents'][:1])
+
+    def test_listing_bad_params(self):
+        rv = self.file.metadata(tools.root, '/', limit=0)
+        self.assertEqual(rv.status_code, 406)
+        for cursor in ['_', 'Mw==']:
+            rv = self.file.metadata(tools.root, '/', cursor=cursor)
+            self.assertEqual(rv.status_code, 400)
+
     def test_listing_off(self):
         rv = self.fileops.create_folder(tools.root, 'd1')
         rv = self.file.put(tools.root, '/d1/f1', '')
@@ -303,6 +602,19 @@ class FileMetadataTestCase(FileTestCase):
         self.assertValidFileMetadata(content[1], tools.root, '/d1/f1', 'f1')
         self.assertValidFileMetadata(content[2], tools.root, '/d1/f2', 'f2')
 
+    def test_stored_stats(self):
+        data = tools.generate_random_data()
+        rv = self.fileops.create_folder(tools.root, 'd1')
+        rv = self.file.put(tools.root, '/d1/f1', data)
+        self.assertEqual(rv.status_code, 200)
+
+        with mock.patch.object(file_store, 'stat_blob') as mock_stat:
+            rv = self.file.metadata(tools.root, '/d1/')
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(mock_stat.called)
+        content = rv.json.get('contents')
+        self.assertValidFileMetadata(content[0], tools.root, '/d1/f1', data)
+
     def test_from_key(self):
         rv = self.file.put(tools.root, 'f1', 'f1')
         rv = self.file.shares(tools.root, 'f1')
@@ -326,6 +638,32 @@ class FileMetadataTestCase(FileTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn('link', rv.json['contents'][0])
 
+    def test_snapshot_cache(self):
+        data = tools.generate_random_data()
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.file.put(tools.root, '/d1/f1', data)
+
+        with mock.patch.object(snapshot, '_load_tree',
+                               wraps=snapshot._load_tree) as load_tree:
+            rv = self.file.metadata(tools.root, '/d1')
+            self.assertEqual(load_tree.call_count, 2)
+            rv = self.file.metadata(tools.root, '/d1')
+            self.assertEqual(load_tree.call_count, 2)
+
+            # Other processes are served by the shared tier.
+            snapshot.lru.clear()
+            rv = self.file.get(tools.root, '/d1/f1')
+            self.assertEqual(rv.data, data)
+            self.assertEqual(load_tree.call_count, 2)
+
+            # Snapshots are not reused once the head has moved.
+            rv = self.file.put(tools.root, '/d1/f2', data)
+            rv = self.file.metadata(tools.root, '/d1')
+            self.assertEqual(load_tree.call_count, 4)
+        self.assertEqual([md['path'] for md in rv.json['contents']],
+                         ['/d1/f1', '/d1/f2'])
+
+
 
 class FilePutTestCase(FileTestCase):
 
@@ -475,6 +813,204 @@ class FilePutTestCase(FileTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertFalse(rv.json.get('is_deleted', False))
 
+    def test_deduplication(self):
+        data = tools.generate_random_data()
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', data)
+            rev = rv.json['rev']
+            rv = self.file.put(tools.root, '/f2', data)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.json['rev'], rev)
+            rv = self.file.put(tools.root, '/f3', data + '_')
+            self.assertNotEqual(rv.json['rev'], rev)
+        self.assertEqual(len(file_store.store[tools.root]), 2)
+
+        rv = self.file.get(tools.root, '/f2')
+        self.assertEqual(rv.data, data)
+
+    def test_deduplication_not_stored(self):
+        # A duplicate is identified before it is encrypted and stored.
+        data = tools.generate_random_data()
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', data)
+            rev = rv.json['rev']
+            with mock.patch.object(file_store, 'register_blob') as mock_reg:
+                rv = self.file.put(tools.root, '/f2', data)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.json['rev'], rev)
+                self.assertFalse(mock_reg.called)
+
+    def test_deduplication_restores_deleted(self):
+        data = tools.generate_random_data()
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', data)
+            rv = self.fileops.delete(tools.root, '/f1')
+            rv = self.file.put(tools.root, '/f1', data)
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(rv.json.get('is_deleted', False))
+        rv = self.file.metadata(tools.root, '/f1')
+        self.assertFalse(rv.json.get('is_deleted', False))
+
+    def test_chunking(self):
+        data = tools.generate_random_data(8192)
+        edited = data[:4000] + '_' + data[4001:]
+        sizes = dict(min_size=64, avg_size=256, max_size=1024)
+        with mock.patch.dict(config.storage, chunking=True):
+            with mock.patch.multiple(chunking, **sizes):
+                rv = self.file.put(tools.root, '/f1', data)
+                self.assertEqual(rv.json['bytes'], 8192)
+                count = len(file_store.store[tools.root])
+                rv = self.file.put(tools.root, '/f1', edited)
+                self.assertEqual(rv.status_code, 200)
+
+        # Only the chunks around the change are stored again.
+        new_chunks = len(file_store.store[tools.root]) - count
+        self.assertLess(new_chunks, rv.json['bytes'] / 256 / 2)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, edited)
+        rv = self.file.get(tools.root, '/f1', headers={'Range': 'bytes=3000-'})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.data, edited[3000:])
+
+    def test_chunking_null_content(self):
+        with mock.patch.dict(config.storage, chunking=True):
+            rv = self.file.put(tools.root, '/f1', '')
+        self.assertEqual(rv.json['bytes'], 0)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, '')
+
+    def _concurrent_copy_hierarchy(self, conflicts):
+        # Simulates a commit stored concurrently to each of the first attempts
+        # by bumping the version of the storage nodes.
+        copy_hierarchy = database.copy_hierarchy
+        calls = []
+
+        def wrapper(*args):
+            calls.append(args)
+            if len(calls) <= conflicts:
+                g.db_session.query(models.Node).update(
+                    {models.Node.version: models.Node.version + 1},
+                    synchronize_session=False)
+            return copy_hierarchy(*args)
+        return mock.patch.object(database, 'copy_hierarchy', wrapper), calls
+
+    def test_put_concurrent_commit(self):
+        data = tools.generate_random_data()
+        patcher, calls = self._concurrent_copy_hierarchy(2)
+        with patcher:
+            rv = self.file.put(tools.root, '/f1', data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(calls), 3)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data)
+
+    def test_put_too_many_concurrent_commits(self):
+        patcher, calls = self._concurrent_copy_hierarchy(
+            database.commit_attempts)
+        with patcher:
+            rv = self.file.put(tools.root, '/f1', tools.generate_random_data())
+        self.assertEqual(rv.status_code, 503)
+        rv = self.file.metadata(tools.root, '/f1')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_put_block_pipeline(self):
+        # The request body goes through the stream decorators in place, a
+        # block at a time (see file_store.fs._save_request_content).
+        data = tools.generate_random_data(100)
+        register_blob = file_store.register_blob
+
+        def wrapper(root, path_, data_stream, hasher):
+            content, buf = [], bytearray(7)
+            count = stream.readinto(data_stream, buf)
+            while count:
+                content.append(str(buf[:count]))
+                count = stream.readinto(data_stream, buf)
+            return register_blob(root, path_, cStringIO.StringIO(
+                ''.join(content)), hasher)
+
+        with mock.patch.object(file_store, 'register_blob', wrapper), \
+                mock.patch.object(stream.ChecksumCalcStream, 'read') as m1, \
+                mock.patch.object(stream.AESEncryptionStream, 'read') as m2:
+            rv = self.file.put(tools.root, '/f1', data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertFalse(m1.called or m2.called)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data)
+
+    def test_put_concurrent_index_entry(self):
+        # Simulates a concurrent commit adding the same path, which inserts
+        # its index entry right after our lookup, before our session is
+        # flushed (and the version of the storage node is compared).
+        update_index = database._update_index
+        calls = []
+
+        def wrapper(session, node, key, obj):
+            calls.append(key)
+            update_index(session, node, key, obj)
+            if len(calls) == 1:
+                session.execute(models.PathIndex.__table__.insert(),
+                                {'node_id': node.id, 'path': key})
+
+        data = tools.generate_random_data()
+        with mock.patch.object(database, '_update_index', wrapper):
+            rv = self.file.put(tools.root, '/f1', data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data)
+
+    def _concurrent_blob(self, before_lookup):
+        # Simulates a concurrent upload of the same content, which stores its
+        # Blob (and manifest) either right before or right after our lookup.
+        find_or_create_blob = put._find_or_create_blob
+        calls = []
+
+        def store_concurrent_blob(filehash):
+            session = datastore.api.Session.session_factory()
+            session.add(models.Blob(hash=filehash))
+            session.add_all(models.BlobChunk(
+                number=obj.number, blob_hash=obj.blob_hash,
+                chunk_hash=obj.chunk_hash, iv=obj.iv, size=obj.size
+            ) for obj in g.db_session.new if isinstance(obj, models.BlobChunk))
+            session.commit()
+            session.close()
+
+        def wrapper(root, path_, filehash, *args):
+            calls.append(filehash)
+            if len(calls) == 1 and before_lookup:
+                store_concurrent_blob(filehash)
+            blob = find_or_create_blob(root, path_, filehash, *args)
+            if len(calls) == 1 and not before_lookup:
+                store_concurrent_blob(filehash)
+            return blob
+        return mock.patch.object(put, '_find_or_create_blob', wrapper), calls
+
+    def test_put_concurrent_blob(self):
+        data = tools.generate_random_data()
+        patcher, calls = self._concurrent_blob(False)
+        with mock.patch.dict(config.storage, encryption=False):
+            with patcher:
+                rv = self.file.put(tools.root, '/f1', data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(datastore.api.Session().query(models.Blob).count(), 1)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data)
+
+    def test_put_concurrent_chunked_blob(self):
+        data = tools.generate_random_data(4096)
+        patcher, calls = self._concurrent_blob(True)
+        sizes = dict(min_size=64, avg_size=256, max_size=1024)
+        with mock.patch.dict(config.storage, chunking=True):
+            with mock.patch.multiple(chunking, **sizes):
+                with patcher:
+                    rv = self.file.put(tools.root, '/f1', data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data)
+
     def test_put_with_same_name_directory(self):
         rv = self.fileops.create_folder(tools.root, 'test')
         self.assertEqual(rv.status_code, 200)
@@ -492,6 +1028,18 @@ class FileRevisionsTestCase(FileTestCase):
         rv = self.file.revisions(tools.root, '/d1/../f1')
         self.assertEqual(rv.status_code, 403)
 
+    def test_copy_similar_dir(self):
+        # Copying to a directory which name only differs from another one by a
+        # LIKE wildcard leaves the history of the other one untouched.
+        rv = self.fileops.create_folder(tools.root, '/a-b')
+        for data in ['1', '2']:
+            rv = self.file.put(tools.root, '/a-b/f', data)
+        rv = self.fileops.create_folder(tools.root, '/src')
+        rv = self.fileops.copy(tools.root, '/src', '/a_b')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.file.revisions(tools.root, '/a-b/f')
+        self.assertEqual(len(rv.json), 2)
+
     def test_default_limit(self):
         for i in xrange(15):
             rv = self.file.put(tools.root, '/f1', str(i))
@@ -512,6 +1060,25 @@ class FileRevisionsTestCase(FileTestCase):
         for i, item in enumerate(reversed(rv.json)):
             self.assertValidFileMetadata(item, tools.root, '/f1', str(i))
 
+    def test_copy(self):
+        # The history of a file follows its copies, and replaces the history
+        # of the deleted file it overwrites.
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        for data in ['1', '2', '3']:
+            rv = self.file.put(tools.root, '/d1/f1', data)
+        rv = self.file.put(tools.root, '/f2', '4')
+        rv = self.fileops.delete(tools.root, '/f2')
+        rv = self.fileops.copy(tools.root, '/d1/f1', '/f2')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.fileops.copy(tools.root, '/d1', '/d2')
+        self.assertEqual(rv.status_code, 200)
+
+        expected = self.file.revisions(tools.root, '/d1/f1').json
+        for path in ['/f2', '/d2/f1']:
+            rv = self.file.revisions(tools.root, path)
+            self.assertEqual([md['rev'] for md in rv.json],
+                             [md['rev'] for md in expected])
+
     def test_dir(self):
         rv = self.fileops.create_folder(tools.root, 'd1')
         self.assertEqual(rv.status_code, 200)
@@ -532,6 +1099,19 @@ class FileRevisionsTestCase(FileTestCase):
         rv = self.file.revisions(tools.root, 'f1', rev_limit=1001)
         self.assertEqual(rv.status_code, 406)
 
+    def test_pagination(self):
+        for _ in range(3):
+            rv = self.file.put(tools.root, 'f1', tools.generate_random_data())
+        expected = self.file.revisions(tools.root, 'f1').json
+
+        revisions, kwargs = [], {'rev_limit': 2, 'stream': 'true'}
+        for count in [2, 1]:
+            rv = self.file.revisions(tools.root, 'f1', **kwargs)
+            self.assertEqual(len(rv.json), count)
+            revisions.extend(rv.json)
+            kwargs['cursor'] = rv.headers['x-datastore-cursor']
+        self.assertEqual(revisions, expected)
+
     def test_std(self):
         rv = self.file.put(tools.root, 'f1', tools.generate_random_data())
         self.assertEqual(rv.status_code, 200)
@@ -646,6 +1226,36 @@ class FileLinkTestCase(FileTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.data, data)
 
+    def test_get_link_other_user(self):
+        # Another user downloads the link first: the file is decrypted with
+        # the key of its owner, and cached as such.
+        data = tools.generate_random_data()
+        rv = self.file.put(tools.root, 'f1', data)
+        link = self.file.shares(tools.root, 'f1').json['link']
+
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        offload = {'header': 'X-Sendfile', 'cache_root': cache_root}
+        other_user = {'email': 'other', 'password': 'o' * 32}
+        with mock.patch.dict(config.storage, offload=offload):
+            self.user.logout()
+            self.user.create(other_user)
+            self.user.login(other_user)
+            rv = self.file.app.get(link)
+            self.assertEqual(rv.status_code, 200)
+            self.user.logout()
+
+            self.user.login(self.user_data)
+            rv = self.file.get(tools.root, 'f1')
+            self.assertEqual(rv.status_code, 200)
+        with open(rv.headers['X-Sendfile'], 'rb') as cached_file:
+            self.assertEqual(cached_file.read(), data)
+
+        self.user.logout()
+        self.user.login(other_user)
+        rv = self.file.app.get(link)
+        self.assertEqual(rv.data, data)
+
 
 class SearchTestCase(FileTestCase):
 
@@ -680,6 +1290,60 @@ class SearchTestCase(FileTestCase):
         rv = self.file.search(tools.root, 'd1', query='abc', file_limit=1001)
         self.assertEqual(rv.status_code, 406)
 
+    def test_pagination(self):
+        rv = self.fileops.create_folder(tools.root, 'd1')
+        for index in range(5):
+            path = 'd1/abc%d' % index
+            rv = self.file.put(tools.root, path, tools.generate_random_data())
+
+        paths, kwargs = [], {'query': 'abc', 'file_limit': 2}
+        for count in [2, 2, 1]:
+            rv = self.file.search(tools.root, 'd1', **kwargs)
+            self.assertEqual(len(rv.json), count)
+            paths.extend(md['path'] for md in rv.json)
+            kwargs['cursor'] = rv.headers['x-datastore-cursor']
+        self.assertEqual(paths, ['/d1/abc%d' % index for index in range(5)])
+
+        rv = self.file.search(tools.root, 'd1', query='abc', stream='true')
+        self.assertEqual([md['path'] for md in rv.json], paths)
+        rv = self.file.search(tools.root, 'd1', query='abc', cursor='_')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_query_metadata(self):
+        # Results are built from the index, and match the metadata endpoint.
+        rv = self.file.search(tools.root, '', query='dark')
+        self.assertEqual(len(rv.json), 2)
+        for md in rv.json:
+            rv = self.file.metadata(tools.root, md['path'], list=False)
+            del rv.json['api-version']
+            self.assertEqual(md, rv.json)
+
+    def test_query_batches(self):
+        # Matching entries are searched once, and then retrieved by batches.
+        for index in range(5):
+            rv = self.file.put(tools.root, 'plop3/abc%d' % index, str(index))
+        search_index = functools.partial(snapshot.search_index, batch_size=2)
+        with mock.patch.object(snapshot, 'search_index', search_index):
+            with mock.patch.object(database, 'search_entries',
+                                   wraps=database.search_entries) as entries:
+                rv = self.file.search(tools.root, '', query='abc')
+        self.assertEqual(len(rv.json), 5)
+        self.assertEqual(entries.call_count, 1)
+
+    def test_query_limit(self):
+        # Candidates are only checked until file_limit results are found.
+        for index in range(5):
+            rv = self.file.put(tools.root, 'plop3/abc%d' % index, str(index))
+        search_index = functools.partial(snapshot.search_index, batch_size=2)
+        with mock.patch.object(snapshot, 'search_index', search_index):
+            with mock.patch.object(database, 'tools',
+                                   wraps=database.tools) as api_tools:
+                rv = self.file.search(tools.root, '', query='abc',
+                                      file_limit=2)
+        self.assertEqual([md['path'] for md in rv.json],
+                         ['/plop3/abc0', '/plop3/abc1'])
+        self.assertEqual(api_tools.last_element.call_count, 2)
+
     def test_query_minimum(self):
         rv = self.file.search(tools.root, '', query='a')
         self.assertEqual(rv.status_code, 400)
@@ -697,6 +1361,30 @@ class SearchTestCase(FileTestCase):
         self.assertValidFileMetadata(rv.json[1], tools.root,
                                      '/plop3/dark', 'dark')
 
+    def test_query_changes(self):
+        rv = self.fileops.move(tools.root, 'plop3/meddle', 'foo1/meddle2')
+        rv = self.fileops.delete(tools.root, 'foo1/bar2')
+        rv = self.file.search(tools.root, '', query='dd')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.file.search(tools.root, '', query='eddle')
+        self.assertEqual([md['path'] for md in rv.json], ['/foo1/meddle2'])
+        rv = self.file.search(tools.root, '', query='dark')
+        self.assertEqual([md['path'] for md in rv.json], ['/plop3/dark'])
+        rv = self.file.search(tools.root, '', query='dark',
+                              include_deleted='true')
+        self.assertEqual(len(rv.json), 2)
+
+    def test_query_similar_dirs(self):
+        # Directories which names only differ by a LIKE wildcard or by case
+        # don't share their index entries.
+        for path, similar in [('/my-docs', '/my_docs'), ('/docs', '/Docs')]:
+            rv = self.fileops.create_folder(tools.root, path)
+            rv = self.file.put(tools.root, path + '/file1', 'file1')
+            rv = self.fileops.create_folder(tools.root, similar)
+            self.assertEqual(rv.status_code, 200)
+            rv = self.file.search(tools.root, path, query='file1')
+            self.assertEqual([md['path'] for md in rv.json], [path + '/file1'])
+
     def test_query_subdir(self):
         rv = self.file.search(tools.root, 'foo1/bar2/', query='dark')
         self.assertEqual(len(rv.json), 1)
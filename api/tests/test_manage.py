@@ -0,0 +1,217 @@
+import argparse
+from datetime import datetime, timedelta
+import mock
+import os
+import shutil
+import tempfile
+
+import datastore.api
+from datastore.api import config, file_store, manage
+from datastore.api.errors import BasicError
+from datastore.api.helpers import chunking, database
+from datastore import models
+
+import tools
+
+
+class ManageTestCase(tools.FiledepotLoggedInTestCase):
+
+    def setUp(self):
+        super(ManageTestCase, self).setUp()
+        self.session = datastore.api.Session()
+
+    def tearDown(self):
+        datastore.api.Session.remove()
+        super(ManageTestCase, self).tearDown()
+
+    def test_rebuild_path_index(self):
+        data = tools.generate_random_data()
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        rv = self.file.put(tools.root, '/d1/f1', data)
+        self.assertEqual(rv.status_code, 200)
+
+        query = self.session.query(models.PathIndex.path)
+        paths = set(path for path, in query)
+        self.session.query(models.PathIndex).delete()
+        self.session.commit()
+
+        manage.rebuild_path_index(self.session, None)
+        self.assertEqual(set(path for path, in query), paths)
+        rv = self.file.get(tools.root, '/d1/f1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, data)
+
+    def test_rebuild_path_trigrams(self):
+        rv = self.file.put(tools.root, '/file', tools.generate_random_data())
+        self.session.query(models.PathTrigram).delete()
+        self.session.commit()
+        rv = self.file.search(tools.root, '', query='fil')
+        self.assertEqual(rv.json, [])
+
+        manage.rebuild_path_index(self.session, None)
+        rv = self.file.search(tools.root, '', query='fil')
+        self.assertEqual([md['path'] for md in rv.json], ['/file'])
+
+    def test_purge_cache(self):
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        offload = {'cache_location': '/_cache/', 'cache_root': cache_root}
+        for path in ['/f1', '/f2']:
+            rv = self.file.put(tools.root, path, tools.generate_random_data())
+        with mock.patch.dict(config.storage, offload=offload):
+            for path in ['/f1', '/f2']:
+                rv = self.file.get(tools.root, path)
+            location = rv.headers['X-Accel-Redirect']
+            filepath = os.path.join(cache_root, location[len('/_cache/'):])
+            os.utime(filepath, (0, 0))
+
+            args = argparse.Namespace(max_age=3600)
+            manage.purge_cache(self.session, args)
+        filenames = [name for _, _, names in os.walk(cache_root)
+                     for name in names]
+        self.assertEqual(len(filenames), 1)
+        self.assertFalse(os.path.exists(filepath))
+
+    def test_rebuild_revisions(self):
+        rv = self.fileops.create_folder(tools.root, '/d1')
+        for data in ['1', '2', '3']:
+            rv = self.file.put(tools.root, '/d1/f1', data)
+        rv = self.fileops.move(tools.root, '/d1', '/d2')
+        expected = self.file.revisions(tools.root, '/d2/f1').json
+        self.assertEqual(len(expected), 3)
+
+        self.session.query(models.Revision).delete()
+        self.session.commit()
+        manage.rebuild_revisions(self.session, None)
+        rv = self.file.revisions(tools.root, '/d2/f1')
+        self.assertEqual(rv.json, expected)
+
+    def test_backfill_blob_stats(self):
+        data = tools.generate_random_data()
+        rv = self.file.put(tools.root, '/f1', data)
+        self.assertEqual(rv.status_code, 200)
+
+        self.session.query(models.Blob).update({'size': None, 'created': None})
+        self.session.commit()
+
+        args = argparse.Namespace(batch_size=1)
+        manage.backfill_blob_stats(self.session, args)
+        blob = self.session.query(models.Blob).one()
+        self.assertEqual(blob.size, len(data))
+        self.assertIsNotNone(blob.created)
+
+    def test_sweep_expired(self):
+        rv = self.file.put(tools.root, '/f1', tools.generate_random_data())
+        rv = self.file.shares(tools.root, '/f1')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.file.chunked_upload('_')
+        id_ = rv.json['upload_id']
+        rv = self.file.chunked_upload('_', part=0)
+        self.assertEqual(rv.status_code, 200)
+
+        # Only the share link and the first upload are expired.
+        expired = datetime.utcnow() - timedelta(seconds=1)
+        self.session.query(models.BlobRef).update({'expires': expired})
+        self.session.query(models.ChunkedUpload) \
+            .filter(models.ChunkedUpload.upload_id == id_) \
+            .update({'expires': expired})
+        self.session.commit()
+
+        manage.sweep_expired(self.session, argparse.Namespace(batch_size=1))
+        self.assertEqual(self.session.query(models.BlobRef).count(), 0)
+        uploads = self.session.query(models.ChunkedUpload).all()
+        self.assertEqual([u.upload_id for u in uploads], [rv.json['upload_id']])
+        self.assertEqual(self.session.query(models.ChunkedUploadPart).count(),
+                         1)
+        self.assertIsNone(file_store.retrieve_chunk_stream(id_))
+
+    def test_sweep_renewed_link(self):
+        rv = self.file.put(tools.root, '/f1', tools.generate_random_data())
+        rv = self.file.shares(tools.root, '/f1')
+        expired = datetime.utcnow() - timedelta(seconds=1)
+        self.session.query(models.BlobRef).update({'expires': expired})
+        self.session.commit()
+
+        # The link is renewed once selected, before being deleted.
+        query = self.session.query
+
+        def renew_query(*entities):
+            if entities == (models.BlobRef,):
+                renewed = datetime.utcnow() + timedelta(days=1)
+                query(models.BlobRef).update({'expires': renewed})
+            return query(*entities)
+
+        with mock.patch.object(self.session, 'query', renew_query):
+            manage.sweep_expired(self.session,
+                                 argparse.Namespace(batch_size=1))
+        self.assertEqual(self.session.query(models.BlobRef).count(), 1)
+
+    def test_collect_uncommitted_blobs(self):
+        data = [tools.generate_random_data() for _ in range(3)]
+        rv = self.file.put(tools.root, '/f1', data[0])
+        rv = self.file.put(tools.root, '/f1', data[1])
+        rv = self.file.put(tools.root, '/f2', data[2])
+        rv = self.fileops.delete(tools.root, '/f2')
+        self.assertEqual(rv.status_code, 200)
+
+        # Simulate old and recent orphans, with or without a Blob row.
+        old_date = datetime.now() - timedelta(hours=2)
+        stored = file_store.store[tools.root]
+        reachable = set(stored)
+        stored['00' + 'a' * 38] = (old_date, '_')
+        stored['ff' + 'b' * 38] = (old_date, '_')
+        stored['ff' + 'c' * 38] = (datetime.now(), '_')
+        self.session.add(models.Blob(hash='ff' + 'b' * 38))
+        self.session.commit()
+
+        args = argparse.Namespace(batch_size=2, min_age=3600, prefix='00',
+                                  rate=0)
+        manage.collect_uncommitted_blobs(self.session, args)
+        self.assertEqual(set(stored), reachable | set(['ff' + 'c' * 38]))
+        self.assertEqual(self.session.query(models.Blob).count(), 3)
+
+        rv = self.file.revisions(tools.root, '/f1')
+        self.assertEqual(len(rv.json), 2)
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data[1])
+
+    def test_collect_uncommitted_blobs_duplicate(self):
+        # An old orphan reused as a duplicate is spared until it is committed.
+        data = tools.generate_random_data()
+        with mock.patch.dict(config.storage, deduplication=True):
+            rv = self.file.put(tools.root, '/f1', data)
+        stored = file_store.store[tools.root]
+        old_date = datetime.now() - timedelta(hours=2)
+        for hash_, (_, content) in stored.items():
+            stored[hash_] = (old_date, content)
+        self.session.query(models.BlobLink).delete()
+        self.session.commit()
+
+        with mock.patch.dict(config.storage, deduplication=True):
+            with mock.patch.object(database, 'run_commit',
+                                   side_effect=BasicError(503, '_')):
+                rv = self.file.put(tools.root, '/f2', data)
+                self.assertEqual(rv.status_code, 503)
+        args = argparse.Namespace(batch_size=100, min_age=3600, prefix='00',
+                                  rate=0)
+        manage.collect_uncommitted_blobs(self.session, args)
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(self.session.query(models.Blob).count(), 1)
+
+    def test_collect_uncommitted_blobs_chunks(self):
+        data = tools.generate_random_data(4096)
+        sizes = dict(min_size=64, avg_size=256, max_size=1024)
+        with mock.patch.dict(config.storage, chunking=True):
+            with mock.patch.multiple(chunking, **sizes):
+                rv = self.file.put(tools.root, '/f1', data)
+        query = self.session.query(models.BlobChunk.chunk_hash)
+        chunk_hashes = set(hash_ for hash_, in query)
+        self.assertGreater(len(chunk_hashes), 1)
+
+        # Chunks are only referenced by the manifest of their blob.
+        args = argparse.Namespace(batch_size=100, min_age=0, prefix='00',
+                                  rate=0)
+        manage.collect_uncommitted_blobs(self.session, args)
+        self.assertLessEqual(chunk_hashes, set(file_store.store[tools.root]))
+        rv = self.file.get(tools.root, '/f1')
+        self.assertEqual(rv.data, data)
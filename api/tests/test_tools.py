@@ -0,0 +1,27 @@
+from . import unittest
+
+from datastore.api import tools
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = tools.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_repeated_access(self):
+        cache = tools.LRUCache(3)
+        for i in range(100):
+            cache.set('a', i)
+            cache.get('a')
+        for key in 'bcd':
+            cache.set(key, key)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual([cache.get(key) for key in 'bcd'], list('bcd'))
+        self.assertTrue(len(cache._order) <= 2 * cache.size)
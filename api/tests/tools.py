@@ -6,7 +6,7 @@ import random
 from . import unittest
 
 import datastore.api
-from datastore.api.helpers import display
+from datastore.api.helpers import display, snapshot
 
 
 root = 'sandbox'
@@ -74,9 +74,19 @@ class File(object):
         uri = '/'.join(['/commit_chunked_upload', root, path.lstrip('/')])
         return self.app.post(uri, data=kwargs)
 
-    def get(self, root, path=''):
+    @with_json_data
+    def delta(self, root, **kwargs):
+        uri = '/'.join(['/delta', root])
+        return self.app.get(uri, query_string=kwargs)
+
+    @with_json_data
+    def longpoll_delta(self, root, **kwargs):
+        uri = '/'.join(['/longpoll_delta', root])
+        return self.app.get(uri, query_string=kwargs)
+
+    def get(self, root, path='', **kwargs):
         uri = '/'.join(['/files', root, path.lstrip('/')])
-        return self.app.get(uri)
+        return self.app.get(uri, **kwargs)
 
     @with_json_data
     def metadata(self, root=None, path=None, **kwargs):
@@ -116,6 +126,11 @@ class Fileop(object):
     def __init__(self, app):
         self.app = app
 
+    @with_json_data
+    def batch(self, root, operations):
+        data = {'root': root, 'operations': json.dumps(operations)}
+        return self.app.post('/fileops/batch', data=data)
+
     @with_json_data
     def copy(self, root, from_path, to_path):
         data = {'root': root, 'from_path': from_path, 'to_path': to_path}
@@ -177,8 +192,11 @@ class FiledepotTestCase(unittest.TestCase):
                                 'Default SHA1 returned for a non-empty file')
 
     def setUp(self):
-        # Reset the database engine
+        # Reset the database engine, and the snapshots cached for the previous
+        # database.
         datastore.api.create_session_factory()
+        datastore.api.tree_cache.store.clear()
+        snapshot.lru.clear()
 
         app = datastore.api.app.test_client()
 
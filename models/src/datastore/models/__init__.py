@@ -19,10 +19,14 @@ def session_maker(database, database_options):
 
 
 from datastore.models.blob import Blob
+from datastore.models.blob_chunk import BlobChunk
 from datastore.models.blob_ref import BlobRef
 from datastore.models.blob_trees import BlobLink, TreeLink
-from datastore.models.chunked_upload import ChunkedUpload
+from datastore.models.change import Change
+from datastore.models.chunked_upload import ChunkedUpload, ChunkedUploadPart
 from datastore.models.commit import Commit
+from datastore.models.path_index import PathIndex, PathTrigram
+from datastore.models.revision import Revision
 from datastore.models.tree import Tree
 from datastore.models.user import Node, User
 
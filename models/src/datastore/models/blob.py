@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String
+from sqlalchemy.orm import relationship
 
 from datastore.models import Base
 
@@ -9,7 +10,27 @@ class Blob(Base):
 
     id = Column(Integer, primary_key=True)
     iv = Column(Integer, index=False)
-    hash = Column(String(40), index=True)
+    # Blobs are shared by all the files with the same content: concurrent
+    # uploads of a given content race to create the single row for its hash.
+    hash = Column(String(40), index=True, unique=True)
+
+    # Identifies the plaintext of the blob when deduplication is enabled (see
+    # datastore.api.files.put.make_content_hasher).
+    content_key = Column(String(40), index=True)
+
+    # File statistics, recorded when the blob is registered in order for the
+    # metadata not to require a file store access.
+    size = Column(BigInteger)
+    created = Column(DateTime)
+
+    # Blobs stored as content-defined chunks have no file of their own: their
+    # hash identifies their manifest, which is empty for other blobs.
+    chunks = relationship(
+        'BlobChunk',
+        primaryjoin='Blob.hash == foreign(BlobChunk.blob_hash)',
+        order_by='BlobChunk.number',
+        viewonly=True
+    )
 
     def __repr__(self):
         return "<Blob('%r, %r')>" % (self.id, self.hash)
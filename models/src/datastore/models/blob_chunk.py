@@ -0,0 +1,34 @@
+from sqlalchemy import BigInteger, Column, Integer, String
+from sqlalchemy.schema import UniqueConstraint
+
+from datastore.models import Base
+
+
+class BlobChunk(Base):
+    """An entry of the manifest of a Blob stored as content-defined chunks
+    (see datastore.api.helpers.chunking). The manifest of a blob is the ordered
+    list of the chunks which concatenated plaintext is the blob content.
+    """
+
+    __tablename__ = "fd_blob_chunk"
+    __table_args__ = (
+        UniqueConstraint('blob_hash', 'number', name='_blob_hash_number_uc'),
+        {'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    number = Column(Integer)
+
+    # Manifests are identified by the hash of their Blob.
+    blob_hash = Column(String(40), index=True)
+    chunk_hash = Column(String(40), index=True)
+
+    # Each chunk is encrypted on its own, with a counter derived from its
+    # content (a 128 bits value in hexadecimal), or left in clear when the
+    # blob isn't encrypted.
+    iv = Column(String(32))
+    size = Column(BigInteger)
+
+    def __repr__(self):
+        return "<BlobChunk(%r, %r, %r)>" % \
+            (self.blob_hash, self.number, self.chunk_hash)
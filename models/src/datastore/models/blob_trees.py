@@ -25,7 +25,7 @@ class BlobLink(Base):
         Tree,
         backref=backref(
             'sub_files',
-            lazy=False,
+            lazy='select',
             collection_class=attribute_mapped_collection('path')
         )
     )
@@ -39,7 +39,19 @@ class BlobLink(Base):
     def iv(self):
         return self.blob.iv
 
-    def copy(self):  # pragma: no cover
+    @property
+    def chunks(self):
+        return self.blob.chunks
+
+    @property
+    def size(self):
+        return self.blob.size
+
+    @property
+    def created(self):
+        return self.blob.created
+
+    def copy(self):
         # When creating a new tree, we want to copy the previous tree content
         # without copying the whole mapped object relationships.
         return BlobLink(
@@ -64,10 +76,10 @@ class TreeLink(Base):
     tree_id = Column(Integer, ForeignKey('fd_tree.id'))
     parent_id = Column(Integer, ForeignKey('fd_tree.id'))
 
-    # Relationships. Note that the parent relationship uses a lazy=False on
-    # its sub_trees backref in order for the tree retrieval to automatically
-    # retrieve all of its children (there is no point in loading a Tree by
-    # itself as the object holds no information).
+    # Relationships. Note that the sub_trees and sub_files backrefs are loaded
+    # lazily, one directory level at a time: eager loading them would load the
+    # whole hierarchy below any retrieved Tree. Code paths which need several
+    # levels load them in batch (see helpers.database.load_children).
     tree = relationship(
         Tree,
         primaryjoin=Tree.id == tree_id
@@ -76,24 +88,21 @@ class TreeLink(Base):
         Tree,
         backref=backref(
             'sub_trees',
-            lazy=False,
+            lazy='select',
             collection_class=attribute_mapped_collection('path')
         ),
         primaryjoin=Tree.id == parent_id
     )
 
-    def copy(self):  # pragma: no cover
-        # When creating a new tree, we want to copy the previous tree content
-        # without copying the whole mapped object relationships.
-        new_link = TreeLink(
-            tree=Tree(created=self.tree.created),
+    def copy(self):
+        # Directories are copied on write: the new link shares the content of
+        # the original one, which is only copied once it gets modified (see
+        # helpers.database.copy_hierarchy).
+        return TreeLink(
+            tree=self.tree,
             path=self.path,
-            tree_id=self.tree_id,
-            parent_id=self.parent_id,
             is_deleted=self.is_deleted
         )
-        self.tree.copy_to(new_link.tree)
-        return new_link
 
     def debug(self, indent=0):
         self.tree.debug(self.path)  # pragma: no cover
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy.orm import relationship
+
+from datastore.models import Base
+
+
+class Change(Base):
+    """A Change records that the object at a given path of a storage node was
+    added, modified or deleted, along with its descendants for a directory.
+
+    The changes of a node ordered by id form a journal, which clients replay
+    from a cursor to synchronize (see datastore.api.files.delta).
+    """
+
+    __tablename__ = "fd_change"
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(1024))
+
+    node_id = Column(Integer, ForeignKey('fd_nodes.id'), index=True)
+    node = relationship('Node')
+
+    def __repr__(self):
+        return "<Change(%r, %r, %r)>" % (self.id, self.node_id, self.path)
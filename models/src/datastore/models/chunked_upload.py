@@ -1,5 +1,7 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Integer, \
+    LargeBinary, String
+from sqlalchemy.orm import backref, relationship
+from sqlalchemy.schema import UniqueConstraint
 
 
 from datastore.models import Base
@@ -21,6 +23,45 @@ class ChunkedUpload(Base):
     offset = Column(Integer)
     expires = Column(DateTime)
 
+    # Sequential chunks are encrypted and hashed as they are received: we keep
+    # the IV of the upload, the SHA1 state of the received content which gives
+    # the blob hash when the upload is committed, and the SHA1 state of the
+    # plaintext when deduplication is enabled (see helpers.hashing).
+    iv = Column(Integer)
+    hash_state = Column(LargeBinary)
+    content_state = Column(LargeBinary)
+
     def __repr__(self):
         return "<ChunkedUpload(%r, %r, %r)>" % \
             (self.id, self.owner_id, self.expires)
+
+
+class ChunkedUploadPart(Base):
+    """A numbered part of a multipart ChunkedUpload. Parts are stored
+    independently, so that they can be received in any order or concurrently,
+    and are assembled by increasing number when the upload is committed.
+    """
+
+    __tablename__ = "fd_chunkedupload_part"
+    __table_args__ = (
+        UniqueConstraint('upload_id', 'number', name='_upload_id_number_uc'),
+        {'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    number = Column(Integer)
+    size = Column(BigInteger)
+
+    upload_id = Column(Integer, ForeignKey('fd_chunkedupload.id'))
+    upload = relationship(
+        ChunkedUpload,
+        backref=backref(
+            'parts',
+            cascade='all, delete-orphan',
+            order_by=number
+        )
+    )
+
+    def __repr__(self):
+        return "<ChunkedUploadPart(%r, %r, %r)>" % \
+            (self.id, self.upload_id, self.number)
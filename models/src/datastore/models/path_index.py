@@ -0,0 +1,67 @@
+from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy.orm import relationship
+from sqlalchemy.schema import Index, UniqueConstraint
+
+from datastore.models import Base
+
+
+class PathIndex(Base):
+    """A PathIndex entry materializes the full path of an object in the head
+    commit of a storage node. It allows any object to be retrieved with a
+    single indexed query, regardless of its depth in the hierarchy.
+
+    A given path may identify both a file and a directory, which is why each
+    entry holds an optional link to each kind of object.
+    """
+
+    __tablename__ = "fd_path_index"
+    __table_args__ = (
+        UniqueConstraint('node_id', 'path', name='_node_id_path_uc'),
+        {'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(1024))
+
+    node_id = Column(Integer, ForeignKey('fd_nodes.id'))
+    tree_link_id = Column(Integer, ForeignKey('fd_tree_trees.id'))
+    blob_link_id = Column(Integer, ForeignKey('fd_blob_trees.id'))
+
+    # Relationships: links are always loaded along with the index entry as
+    # they are the very reason we are querying the index.
+    node = relationship('Node')
+    tree_link = relationship('TreeLink', lazy='joined')
+    blob_link = relationship('BlobLink', lazy='joined')
+
+    # The trigrams of the entry name, which never changes for a given entry.
+    trigrams = relationship('PathTrigram', cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return "<PathIndex(%r, %r, %r, %r, %r)>" % \
+            (self.id, self.node_id, self.path, self.tree_link_id,
+             self.blob_link_id)
+
+
+class PathTrigram(Base):
+    """A PathTrigram is one of the three characters sequences of the name of a
+    PathIndex entry. Any name containing a given string contains each of its
+    trigrams, which allows substring search to be an indexed query.
+    """
+
+    __tablename__ = "fd_path_trigram"
+    __table_args__ = (
+        Index('ix_path_trigram_node_id_trigram', 'node_id', 'trigram'),
+        {'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    trigram = Column(String(3))
+
+    # The node is denormalized in order for lookups to be restricted to a given
+    # storage node using the index.
+    node_id = Column(Integer, ForeignKey('fd_nodes.id'))
+    entry_id = Column(Integer, ForeignKey('fd_path_index.id'), index=True)
+
+    def __repr__(self):
+        return "<PathTrigram(%r, %r, %r)>" % \
+            (self.id, self.entry_id, self.trigram)
@@ -0,0 +1,35 @@
+from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy.orm import relationship
+from sqlalchemy.schema import Index
+
+from datastore.models import Base
+
+
+class Revision(Base):
+    """A Revision records that a new content was written to the file at a
+    given path of a storage node. The revisions of a path ordered by id form
+    its history, which is listed with a single indexed query rather than by
+    following the BlobLink.parent chain.
+
+    Copying (or moving) a file copies its history along with it.
+    """
+
+    __tablename__ = "fd_revision"
+    __table_args__ = (
+        Index('ix_revision_node_id_path', 'node_id', 'path'),
+        {'mysql_engine': 'InnoDB'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(1024))
+
+    node_id = Column(Integer, ForeignKey('fd_nodes.id'))
+    blob_id = Column(Integer, ForeignKey('fd_blob.id'))
+
+    # The blob holds the size and creation date of the revision.
+    node = relationship('Node')
+    blob = relationship('Blob', lazy='joined')
+
+    def __repr__(self):
+        return "<Revision(%r, %r, %r, %r)>" % \
+            (self.id, self.node_id, self.path, self.blob_id)
@@ -1,6 +1,7 @@
 from datetime import datetime
+import hashlib
 
-from sqlalchemy import Column, DateTime, Integer
+from sqlalchemy import Column, DateTime, Integer, String
 
 from datastore.models import Base
 
@@ -12,7 +13,32 @@ class Tree(Base):
     id = Column(Integer, primary_key=True)
     created = Column(DateTime, default=datetime.utcnow())
 
-    def copy_to(self, dest):  # pragma: no cover
+    # Directory content hash, which helps clients determine if anything has
+    # changed. It is maintained on each commit (see update_hash).
+    hash = Column(String(40))
+
+    def compute_hash(self):
+        """Compute the directory content hash, which takes into account:
+            - each sub directory name and deleted status
+            - each sub file name, deleted status and hash.
+
+        As a result, the hash changes only if any top level element changes,
+        without taking sub directories content into account.
+        """
+        hash_ = hashlib.sha1()
+        for _, subd in sorted(self.sub_trees.items()):
+            hash_.update(str((subd.path, subd.is_deleted)))
+        for _, subf in sorted(self.sub_files.items()):
+            hash_.update(str((subf.path, subf.is_deleted, subf.blob.hash)))
+        return hash_.hexdigest()
+
+    def update_hash(self):
+        self.hash = self.compute_hash()
+
+    def copy_to(self, dest):
+        """Fill dest with copies of the links of this directory, which point
+        to the same files and sub directories.
+        """
         value_copy = lambda d: dict((k, v.copy()) for k, v in d.items())
         dest.sub_files = value_copy(self.sub_files)
         dest.sub_trees = value_copy(self.sub_trees)
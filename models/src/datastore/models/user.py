@@ -42,6 +42,10 @@ class Node(Base):
         backref='node'
     )
 
+    # Incremented by every commit: a commit is only stored if the version did
+    # not change since it was started (see database.store_commit).
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+
     # Each user has a collection of nodes which maps to the root commit for
     # each storage node (i.e.: 'main', 'test', ...). This way, each node has
     # its own history and commit log.
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import argparse
+import os
+import time
+
+
+config_path = os.environ['DATASTORE_API_CONFIG_PATH'] = '../api/conf/'
+
+BACKENDS = ['pycrypto', 'openssl']
+
+
+def import_backend(name):
+    module = 'datastore.api.cipher.aes_{}'.format(name)
+    return __import__(module, fromlist=[None])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', help='Data size (MB)', default=256,
+                        type=int)
+    parser.add_argument('-b', '--block-size', help='Read size (KB)',
+                        default=64, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.size <= 0 or args.block_size <= 0:
+        print 'Sizes must be strictly positive'
+        return
+
+    print '[+] Generating random key and data block'
+    key = os.urandom(32)
+    block = os.urandom(args.block_size * 1024)
+    iterations = args.size * 1024 // args.block_size
+
+    for name in BACKENDS:
+        try:
+            backend = import_backend(name)
+        except ImportError as e:
+            print '[-] {}: not available ({})'.format(name, e)
+            continue
+
+        ctr = backend.new_ctr(key, 0)
+        start = time.time()
+        for i in range(iterations):
+            ctr.encrypt(block)
+        elapsed = time.time() - start
+        print '[+] {}: {:.1f} MB/s'.format(name, args.size / elapsed)
+
+
+if __name__ == "__main__":
+    main()